@@ -3,12 +3,15 @@ Modulo que contiene la interfaz gráfica de usuario.
 """
 
 import os
+import threading
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
-from tkinter import filedialog, messagebox, colorchooser, Label
+from tkinter import filedialog, messagebox, colorchooser, Label, ttk
 import fitz  # PyMuPDF para validar PDFs
-from PIL import Image,ImageTk
-from marcar_agua_pdf import anadir_marca_agua_a_pdf, vista_previa_pdf  # Importamos la función desde el otro fichero
+from PIL import ImageTk
+from marcar_agua_pdf import anadir_marca_agua_a_pdf, vista_previa_pdf_imagen, ProcesoCancelado  # Importamos la función desde el otro fichero
 
 __author__ = "Adrian Mateos"
 __copyright__ = "Copyright 2025"
@@ -23,19 +26,16 @@ def seleccionar_pdf_entrada():
     """Abre un diálogo para seleccionar el PDF de entrada y valida que sea un archivo PDF válido."""
     ruta = filedialog.askopenfilename(filetypes=[("Archivos PDF", "*.pdf")])
     if ruta:
-        try:
-            fitz.open(ruta).close()  # Intenta abrir el PDF para verificar que no esté corrupto
-            entrada_var.set(ruta)
-        except Exception:
-            messagebox.showerror("Error", "El archivo PDF seleccionado está corrupto o no es válido.")
+        # Intenta abrir el PDF para verificar que no esté corrupto
+        _comprobar_en_hilo_fitz(ruta, lambda: entrada_var.set(ruta),
+                                "El archivo PDF seleccionado está corrupto o no es válido.")
 
 
 def seleccionar_imagen():
     """Abre un diálogo para seleccionar una imagen valida."""
     ruta = filedialog.askopenfilename(filetypes=[("Imágenes en jpg, jpeg o png", "*.jpg;*.jpeg;*.png")])
     if ruta:
-        try:
-            fitz.open(ruta).close()  # Intenta la imagen para ver que no está corrupta
+        def usar_imagen():
             entrada_imagen_var.set(ruta)
             entrada_texto.config(state="disabled")
             #texto_var.set("")
@@ -45,8 +45,8 @@ def seleccionar_imagen():
             marco_color.config(state="disabled")
             entrada_mayus.config(state="disabled")
             entrada_minus.config(state="disabled")
-        except Exception:
-            messagebox.showerror("Error", "La imágen está corrupta o no es válida.")
+        # Intenta abrir la imagen para ver que no está corrupta
+        _comprobar_en_hilo_fitz(ruta, usar_imagen, "La imágen está corrupta o no es válida.")
 
 
 def quitar_imagen():
@@ -87,6 +87,288 @@ def validar_longitud_texto(*args):
         texto_var.set(texto_var.get()[:30])  # Recorta el texto a 30 caracteres
 
 
+# Los trabajos pesados se ejecutan en hilos aparte para no bloquear la ventana.
+# PyMuPDF no admite que varios hilos lo usen a la vez, así que todo lo que abre pdfs (comprobar ficheros, marcar,
+# vista previa y miniaturas) pasa por un único hilo; una vista previa pedida durante un marcado espera a que termine.
+ejecutor_fitz = ThreadPoolExecutor(max_workers=1)
+# Evento que el botón "Cancelar" activa para detener el marcado entre página y página
+cancelar_evento = threading.Event()
+# Progreso del trabajo actual (páginas hechas, total). Lo escribe el hilo de trabajo y lo lee el bucle de Tk
+estado_progreso = [0, 0]
+# Estado de la vista previa en vivo: after() pendiente, si hay una vista previa calculándose y si hay que repetirla
+estado_vista_previa = {"programada": None, "en_curso": False, "repetir": False}
+# Tamaño del visor de la vista previa, la página se renderiza directamente a este tamaño
+TAMANO_VISTA_PREVIA = (400, 500)
+# Tira de miniaturas de todas las páginas. Solo se renderizan las que están a la vista, en el mismo hilo que la
+# vista previa, y se guardan las últimas MAX_MINIATURAS, así el coste no depende de la longitud del pdf
+TAMANO_MINIATURA = (60, 84)
+SEPARACION_MINIATURAS = 10
+MAX_MINIATURAS = 48
+# Estado de la tira: pdf y número de páginas, parámetros de la marca de agua con los que se renderiza, página
+# mostrada en la vista previa, miniaturas ya renderizadas (LRU), renders pendientes y after() de recogida pendiente
+estado_miniaturas = {"ruta": None, "paginas": 0, "parametros": None, "pagina_actual": 0,
+                     "imagenes": OrderedDict(), "pendientes": {}, "recogida": None}
+
+
+def _informar_progreso(paginas_hechas, total):
+    """Función de progreso que se pasa a anadir_marca_agua_a_pdf. Se ejecuta en el hilo de trabajo."""
+    estado_progreso[0], estado_progreso[1] = paginas_hechas, total
+    return not cancelar_evento.is_set()
+
+
+def _esperar_resultado(futuro, al_terminar):
+    """Comprueba periódicamente desde el bucle de Tk si un trabajo en segundo plano ha terminado."""
+    if not futuro.done():
+        if estado_progreso[1]:
+            barra_progreso.config(maximum=estado_progreso[1], value=estado_progreso[0])
+            progreso_texto_var.set(f"Página {estado_progreso[0]} de {estado_progreso[1]}")
+        root.after(100, _esperar_resultado, futuro, al_terminar)
+        return
+    al_terminar(futuro)
+
+
+def _comprobar_en_hilo_fitz(ruta, al_abrir, mensaje_error):
+    """Comprueba en el hilo de fitz que el fichero se puede abrir y después llama a al_abrir, o muestra mensaje_error."""
+    futuro = ejecutor_fitz.submit(lambda: fitz.open(ruta).close())
+    root.after(50, _esperar_resultado, futuro,
+               lambda f: messagebox.showerror("Error", mensaje_error) if f.exception() else al_abrir())
+
+
+def _mostrar_vista_previa(futuro, en_vivo=False):
+    """Muestra en la interfaz el resultado de la vista previa calculada en segundo plano."""
+    boton_vista_previa.config(state="normal")
+    estado_vista_previa["en_curso"] = False
+    # Si los parámetros han cambiado mientras se calculaba, se vuelve a calcular solo la última versión
+    if estado_vista_previa["repetir"]:
+        estado_vista_previa["repetir"] = False
+        _vista_previa_en_vivo()
+
+    try:
+        imagen_pil = futuro.result()
+    except Exception as e:
+        # En la vista previa en vivo no se muestran errores para no interrumpir al usuario mientras ajusta
+        if not en_vivo:
+            messagebox.showerror("Error", f"Ocurrió un error generando la vista previa: {str(e)}")
+        return
+
+    if imagen_pil:
+        imagen_pil.thumbnail(TAMANO_VISTA_PREVIA)
+        imagen_tk = ImageTk.PhotoImage(imagen_pil)
+
+        if hasattr(marco_imagen, "imagen_label"):
+            marco_imagen.imagen_label.config(image=imagen_tk)
+            marco_imagen.imagen_label.image = imagen_tk
+        else:
+            marco_imagen.imagen_label = Label(marco_imagen, image=imagen_tk)
+            marco_imagen.imagen_label.image = imagen_tk
+            marco_imagen.imagen_label.pack()
+
+
+def _lanzar_vista_previa(parametros, en_vivo=False):
+    """Calcula la vista previa en segundo plano. Si ya hay una en curso, se repetirá al terminar."""
+    if estado_vista_previa["en_curso"]:
+        estado_vista_previa["repetir"] = True
+        return
+    estado_vista_previa["en_curso"] = True
+    boton_vista_previa.config(state="disabled")
+    futuro = ejecutor_fitz.submit(vista_previa_pdf_imagen, tamano_maximo=TAMANO_VISTA_PREVIA,
+                                  numero_pagina=estado_miniaturas["pagina_actual"], **parametros)
+    root.after(50, _esperar_resultado, futuro, lambda f: _mostrar_vista_previa(f, en_vivo))
+
+
+def _paso_miniaturas():
+    """Ancho que ocupa cada miniatura en la tira, separación incluida."""
+    return TAMANO_MINIATURA[0] + SEPARACION_MINIATURAS
+
+
+def _paginas_visibles():
+    """Devuelve las páginas cuyas miniaturas se ven en la tira, más una a cada lado para adelantarse al desplazamiento."""
+    total = estado_miniaturas["paginas"]
+    if not total:
+        return range(0)
+    inicio, fin = canvas_miniaturas.xview()
+    return range(max(0, int(inicio * total) - 1), min(total, int(fin * total) + 2))
+
+
+def _dibujar_miniatura(pagina):
+    """Dibuja en la tira la miniatura de una página, o un recuadro vacío si todavía no está renderizada."""
+    etiquetas = ("miniatura", f"pagina{pagina}")
+    canvas_miniaturas.delete(f"pagina{pagina}")
+    ancho, alto = TAMANO_MINIATURA
+    x = pagina * _paso_miniaturas() + SEPARACION_MINIATURAS // 2
+    imagen = estado_miniaturas["imagenes"].get(pagina)
+    if imagen is None:
+        canvas_miniaturas.create_rectangle(x, 4, x + ancho, 4 + alto, outline="gray", tags=etiquetas)
+    else:
+        canvas_miniaturas.create_image(x + ancho // 2, 4 + alto // 2, image=imagen, tags=etiquetas)
+    if pagina == estado_miniaturas["pagina_actual"]:
+        canvas_miniaturas.create_rectangle(x - 2, 2, x + ancho + 2, 6 + alto, outline="blue", width=2, tags=etiquetas)
+    canvas_miniaturas.create_text(x + ancho // 2, alto + 14, text=str(pagina + 1), font=("Arial", 7), tags=etiquetas)
+
+
+def _actualizar_miniaturas(*args):
+    """Pide las miniaturas que están a la vista y cancela las pendientes que ya no se ven."""
+    parametros = estado_miniaturas["parametros"]
+    if parametros is None:
+        return
+    visibles = _paginas_visibles()
+    pendientes = estado_miniaturas["pendientes"]
+    # Un render que todavía no ha empezado se cancela si su página ha salido de la vista
+    for pagina, futuro in list(pendientes.items()):
+        if pagina not in visibles and futuro.cancel():
+            del pendientes[pagina]
+    for pagina in visibles:
+        if pagina in estado_miniaturas["imagenes"]:
+            estado_miniaturas["imagenes"].move_to_end(pagina)
+        elif pagina not in pendientes:
+            # Las miniaturas no pasan por las cachés de la vista previa, así no expulsan la página que se está
+            # mostrando; ya se guardan aquí las últimas MAX_MINIATURAS
+            pendientes[pagina] = ejecutor_fitz.submit(vista_previa_pdf_imagen, tamano_maximo=TAMANO_MINIATURA,
+                                                      numero_pagina=pagina, usar_cache=False, **parametros)
+        _dibujar_miniatura(pagina)
+    if pendientes and estado_miniaturas["recogida"] is None:
+        estado_miniaturas["recogida"] = root.after(50, _recoger_miniaturas)
+
+
+def _recoger_miniaturas():
+    """Muestra las miniaturas ya renderizadas y expulsa las más antiguas si se supera MAX_MINIATURAS."""
+    estado_miniaturas["recogida"] = None
+    pendientes = estado_miniaturas["pendientes"]
+    imagenes = estado_miniaturas["imagenes"]
+    for pagina, futuro in list(pendientes.items()):
+        if not futuro.done():
+            continue
+        del pendientes[pagina]
+        try:
+            imagen_pil = futuro.result()
+        except Exception:
+            # Como en la vista previa en vivo, los errores de una miniatura no se muestran (o está cancelada)
+            continue
+        imagenes[pagina] = ImageTk.PhotoImage(imagen_pil)
+        while len(imagenes) > MAX_MINIATURAS:
+            expulsada, _ = imagenes.popitem(last=False)
+            _dibujar_miniatura(expulsada)
+        _dibujar_miniatura(pagina)
+    if pendientes:
+        estado_miniaturas["recogida"] = root.after(50, _recoger_miniaturas)
+
+
+def _preparar_miniaturas(parametros):
+    """
+    Reinicia la tira de miniaturas si han cambiado el pdf o la marca de agua. No pide ninguna miniatura: se
+    piden después con _actualizar_miniaturas, una vez enviada la vista previa principal, para que no espere
+    detrás de ellas en el hilo de fitz.
+    """
+    if parametros == estado_miniaturas["parametros"]:
+        return
+    # Lo pendiente y lo ya renderizado corresponde a la marca de agua anterior
+    for futuro in estado_miniaturas["pendientes"].values():
+        futuro.cancel()
+    estado_miniaturas["pendientes"] = {}
+    estado_miniaturas["imagenes"].clear()
+    canvas_miniaturas.delete("miniatura")
+    if parametros["ruta_entrada_pdf"] != estado_miniaturas["ruta"]:
+        # Las páginas se cuentan en el hilo de fitz, hasta entonces la tira queda vacía
+        ruta = parametros["ruta_entrada_pdf"]
+        estado_miniaturas.update(ruta=ruta, paginas=0, pagina_actual=0)
+        canvas_miniaturas.configure(scrollregion=(0, 0, 0, 0))
+        futuro = ejecutor_fitz.submit(_contar_paginas, ruta)
+        root.after(50, _esperar_resultado, futuro, lambda f: _mostrar_paginas_miniaturas(f, ruta))
+    estado_miniaturas["parametros"] = parametros
+
+
+def _contar_paginas(ruta):
+    """Devuelve el número de páginas de un pdf. Se ejecuta en el hilo de fitz."""
+    with fitz.open(ruta) as documento:
+        return len(documento)
+
+
+def _mostrar_paginas_miniaturas(futuro, ruta):
+    """Ajusta la tira al número de páginas ya contado, si el pdf no ha cambiado mientras tanto."""
+    if ruta != estado_miniaturas["ruta"]:
+        return
+    try:
+        paginas = futuro.result()
+    except Exception:
+        paginas = 0
+    estado_miniaturas["paginas"] = paginas
+    canvas_miniaturas.configure(scrollregion=(0, 0, paginas * _paso_miniaturas(), TAMANO_MINIATURA[1] + 24))
+    canvas_miniaturas.xview_moveto(0)
+    _actualizar_miniaturas()
+
+
+def _vaciar_miniaturas():
+    """Deja la tira de miniaturas vacía, sin pdf."""
+    for futuro in estado_miniaturas["pendientes"].values():
+        futuro.cancel()
+    estado_miniaturas.update(ruta=None, paginas=0, parametros=None, pagina_actual=0, pendientes={})
+    estado_miniaturas["imagenes"].clear()
+    canvas_miniaturas.delete("miniatura")
+    canvas_miniaturas.configure(scrollregion=(0, 0, 0, 0))
+
+
+def _desplazar_miniaturas(inicio, fin):
+    """Se llama al desplazar la tira: mueve la barra y pide las miniaturas que han entrado en la vista."""
+    scrollbar_miniaturas.set(inicio, fin)
+    _actualizar_miniaturas()
+
+
+def seleccionar_miniatura(event):
+    """Muestra en la vista previa la página cuya miniatura se ha pulsado."""
+    pagina = int(canvas_miniaturas.canvasx(event.x) // _paso_miniaturas())
+    if not 0 <= pagina < estado_miniaturas["paginas"] or estado_miniaturas["parametros"] is None:
+        return
+    anterior, estado_miniaturas["pagina_actual"] = estado_miniaturas["pagina_actual"], pagina
+    _dibujar_miniatura(anterior)
+    _dibujar_miniatura(pagina)
+    _lanzar_vista_previa(estado_miniaturas["parametros"], en_vivo=True)
+
+
+def _parametros_vista_previa():
+    """Lee de la interfaz los parámetros de la vista previa. Devuelve None si falta el pdf o la marca de agua."""
+    if not os.path.isfile(entrada_var.get()):
+        return None
+    hay_imagen = os.path.isfile(entrada_imagen_var.get())
+    if not hay_imagen and (not texto_var.get().strip() or not color_var.get()):
+        return None
+    try:
+        # Con una imagen el color no se usa
+        color = (0, 0, 0) if hay_imagen else eval(color_var.get())
+        return dict(
+            ruta_entrada_pdf=entrada_var.get(),
+            texto_marca_agua=texto_var.get(),
+            tamano_fuente=tamano_var.get(),
+            opacidad_texto=opacidad_var.get(),
+            texto_mayusculas=mayusculas_var.get(),
+            color_texto=color,
+            blanco_y_negro=bn_var.get(),
+            ruta_imagen=entrada_imagen_var.get()
+        )
+    except (tk.TclError, SyntaxError, ValueError):
+        return None
+
+
+def _vista_previa_en_vivo():
+    """Actualiza la vista previa con los parámetros actuales, si ya están completos."""
+    estado_vista_previa["programada"] = None
+    parametros = _parametros_vista_previa()
+    if parametros is not None:
+        _preparar_miniaturas(parametros)
+        _lanzar_vista_previa(parametros, en_vivo=True)
+        _actualizar_miniaturas()
+
+
+def programar_vista_previa(*args):
+    """
+    Se llama cada vez que cambia un parámetro de la marca de agua. Espera a que el usuario deje de
+    mover los controles durante un momento antes de actualizar la vista previa, así al arrastrar
+    un deslizador no se acumulan vistas previas que ya no sirven.
+    """
+    if estado_vista_previa["programada"] is not None:
+        root.after_cancel(estado_vista_previa["programada"])
+    estado_vista_previa["programada"] = root.after(250, _vista_previa_en_vivo)
+
+
 def generar_vista_previa():
     """Genera una vista previa de la marca de agua."""
 
@@ -105,34 +387,45 @@ def generar_vista_previa():
     if os.path.isfile(entrada_imagen_var.get()) and not color_var.get():
         color_var.set((0,0,0))
 
-    try:
-        # Generar vista previa
-        imagen_previa = vista_previa_pdf(
-            ruta_entrada_pdf=entrada_var.get(),
-            texto_marca_agua=texto_var.get(),
-            tamano_fuente=tamano_var.get(),
-            opacidad_texto=opacidad_var.get(),
-            texto_mayusculas=mayusculas_var.get(),
-            color_texto=eval(color_var.get()),
-            blanco_y_negro=bn_var.get(),
-            ruta_imagen=entrada_imagen_var.get()
-        )
+    # Las variables de Tk solo se leen desde el hilo principal, antes de lanzar el trabajo
+    parametros = _parametros_vista_previa()
+    if parametros is None:
+        messagebox.showerror("Error", mensaje_de_error)
+        return
 
-        if imagen_previa:
-            imagen_pil = Image.open(imagen_previa)
-            imagen_pil.thumbnail((400, 500))
-            imagen_tk = ImageTk.PhotoImage(imagen_pil)
-            
-            if hasattr(marco_imagen, "imagen_label"):
-                marco_imagen.imagen_label.config(image=imagen_tk)
-                marco_imagen.imagen_label.image = imagen_tk
-            else:
-                marco_imagen.imagen_label = Label(marco_imagen, image=imagen_tk)
-                marco_imagen.imagen_label.image = imagen_tk
-                marco_imagen.imagen_label.pack()
-    
+    # Generar vista previa en segundo plano, antes que las miniaturas
+    _preparar_miniaturas(parametros)
+    _lanzar_vista_previa(parametros)
+    _actualizar_miniaturas()
+
+
+def _terminar_ejecucion(futuro):
+    """Informa del resultado del marcado calculado en segundo plano y deja la interfaz lista de nuevo."""
+    boton_ejecutar.config(state="normal")
+    boton_cancelar.config(state="disabled")
+    # Las vistas previas también esperan con _esperar_resultado y no deben volver a mostrar este progreso
+    estado_progreso[0], estado_progreso[1] = 0, 0
+    barra_progreso.config(value=0)
+    progreso_texto_var.set("")
+    try:
+        futuro.result()
+    except ProcesoCancelado:
+        messagebox.showinfo("Cancelado", "Se ha cancelado el proceso. No se ha guardado ningún archivo.")
+        return
     except Exception as e:
-        messagebox.showerror("Error", f"Ocurrió un error generando la vista previa: {str(e)}")
+        messagebox.showerror("Error", f"Ocurrió un error: {str(e)}\nPara más información contacte con el desarrollador.")
+        return
+
+    messagebox.showinfo("Éxito", f"PDF procesado correctamente.\nEl archivo se ha guardado en:\n{salida_var.get()}")
+    nombre_archivo_var.set("")
+    salida_var.set("Aún no se ha elegido un lugar de guardado")
+
+
+def cancelar():
+    """Pide al trabajo en curso que se detenga al terminar la página actual."""
+    cancelar_evento.set()
+    boton_cancelar.config(state="disabled")
+    progreso_texto_var.set("Cancelando...")
 
 
 def ejecutar():
@@ -150,7 +443,7 @@ def ejecutar():
             color_var.set((0,0,0))
 
         #Parámetros para la función
-        anadir_marca_agua_a_pdf(
+        parametros = dict(
             ruta_entrada_pdf=entrada_var.get(),
             ruta_salida_pdf=salida_var.get(),
             texto_marca_agua=texto_var.get(),
@@ -159,14 +452,21 @@ def ejecutar():
             texto_mayusculas=mayusculas_var.get(),
             color_texto=eval(color_var.get()),  # Convierte el string en tupla
             blanco_y_negro=bn_var.get(),
-            ruta_imagen=entrada_imagen_var.get()
+            ruta_imagen=entrada_imagen_var.get(),
+            progreso=_informar_progreso
         )
-
-        messagebox.showinfo("Éxito", f"PDF procesado correctamente.\nEl archivo se ha guardado en:\n{salida_var.get()}")
-        nombre_archivo_var.set("")
-        salida_var.set("Aún no se ha elegido un lugar de guardado")
     except Exception as e:
         messagebox.showerror("Error", f"Ocurrió un error: {str(e)}\nPara más información contacte con el desarrollador.")
+        return
+
+    # Ejecuta el marcado en segundo plano y consulta su progreso desde el bucle de Tk
+    cancelar_evento.clear()
+    estado_progreso[0], estado_progreso[1] = 0, 0
+    boton_ejecutar.config(state="disabled")
+    boton_cancelar.config(state="normal")
+    progreso_texto_var.set("Preparando la marca de agua...")
+    futuro = ejecutor_fitz.submit(anadir_marca_agua_a_pdf, **parametros)
+    root.after(100, _esperar_resultado, futuro, _terminar_ejecucion)
 
 def reiniciar():
     """Restablece todos los valores de entrada."""
@@ -191,6 +491,7 @@ def reiniciar():
     if hasattr(marco_imagen, "imagen_label"):
         marco_imagen.imagen_label.destroy()
         del marco_imagen.imagen_label
+    _vaciar_miniaturas()
 
 
 # Crear ventana principal
@@ -261,10 +562,15 @@ mayusculas_var = tk.BooleanVar(value=False)
 color_var = tk.StringVar()
 bn_var = tk.BooleanVar(value=False)
 nombre_archivo_var = tk.StringVar()
+progreso_texto_var = tk.StringVar()
 
 # Asociar la validación a la variable de texto
 texto_var.trace_add("write", validar_longitud_texto)
 
+# Actualizar la vista previa en vivo cuando cambia cualquier parámetro de la marca de agua
+for variable in (entrada_var, entrada_imagen_var, texto_var, tamano_var, opacidad_var, mayusculas_var, color_var, bn_var):
+    variable.trace_add("write", programar_vista_previa)
+
 # --------------------------------WIDGETS FRAME IZQUERDO----------------------------------------
 marco_cuadrado_pdf = tk.Frame(frame_interior_izq, padx=10, pady=10, relief="solid", bd=1)
 marco_cuadrado_pdf.pack(padx=10, pady=4, fill="x")
@@ -364,12 +670,23 @@ tk.Checkbutton(marco_cuadrado_bn, text="¿Desea convertir el pdf a Blanco y Negr
 #-----------------------------------------------------------------------------------------------
 
 button_frame = tk.Frame(frame_interior_izq)
-tk.Button(button_frame, text="Ejecutar", command=ejecutar, bg="green", fg="white", font=("Arial", 9, "bold")).pack(side="left", padx=5)
-tk.Button(button_frame, command=generar_vista_previa, text="Ver vista previa", bg="blue", fg="white", font=("Arial", 9, "bold")).pack(side="left", padx=5)
+boton_ejecutar = tk.Button(button_frame, text="Ejecutar", command=ejecutar, bg="green", fg="white", font=("Arial", 9, "bold"))
+boton_ejecutar.pack(side="left", padx=5)
+boton_vista_previa = tk.Button(button_frame, command=generar_vista_previa, text="Ver vista previa", bg="blue", fg="white", font=("Arial", 9, "bold"))
+boton_vista_previa.pack(side="left", padx=5)
 tk.Button(button_frame, text="Empezar de nuevo", command=reiniciar, bg="red", fg="white", font=("Arial", 9, "bold")).pack(side="left", padx=5)
 button_frame.pack(side="left")
 button_frame.pack(pady=10)
 #-----------------------------------------------------------------------------------------------
+
+marco_progreso = tk.Frame(frame_interior_izq)
+barra_progreso = ttk.Progressbar(marco_progreso, orient="horizontal", length=250, mode="determinate")
+barra_progreso.pack(side="left", padx=5)
+boton_cancelar = tk.Button(marco_progreso, text="Cancelar", command=cancelar, state="disabled")
+boton_cancelar.pack(side="left", padx=5)
+marco_progreso.pack(anchor="w", padx=10)
+tk.Label(frame_interior_izq, textvariable=progreso_texto_var, font=("Arial", 8)).pack(anchor="w", padx=15)
+#-----------------------------------------------------------------------------------------------
 #------------------------WIDGETS FRAME DERECHO---------------------------------------------------
 
 tk.Label(frame_interior_der, text="Visualizador de vista previa", font=("Arial", 9, "underline")).pack(anchor="w")
@@ -378,6 +695,16 @@ tk.Label(frame_interior_der, text="Visualizador de vista previa", font=("Arial",
 marco_imagen = tk.Frame(frame_interior_der, width=400, height=500, relief="flat", bd=0, bg="white")
 marco_imagen.pack(anchor="nw", padx=10, pady=5)
 
+# Tira de miniaturas de las páginas. Al pulsar una se muestra esa página en la vista previa
+tk.Label(frame_interior_der, text="Páginas", font=("Arial", 9, "underline")).pack(anchor="w")
+canvas_miniaturas = tk.Canvas(frame_interior_der, width=400, height=TAMANO_MINIATURA[1] + 24, bg="white",
+                              highlightthickness=0)
+canvas_miniaturas.pack(anchor="nw", padx=10)
+scrollbar_miniaturas = tk.Scrollbar(frame_interior_der, orient="horizontal", command=canvas_miniaturas.xview)
+scrollbar_miniaturas.pack(anchor="nw", padx=10, fill="x")
+canvas_miniaturas.configure(xscrollcommand=_desplazar_miniaturas, scrollregion=(0, 0, 0, 0))
+canvas_miniaturas.bind("<Button-1>", seleccionar_miniatura)
+
 #------------------------------------------------------------------------------------------------------
 
 # Configurar el scroll para el frame izquierdo
@@ -402,6 +729,10 @@ def _on_mousewheel(event):
             canvas_izq.xview_scroll(int(-1 * (event.delta / 120)), "units")
         else:
             canvas_izq.yview_scroll(int(-1 * (event.delta / 120)), "units")
+    # Sobre la tira de miniaturas la rueda desplaza en horizontal
+    elif (canvas_miniaturas.winfo_rootx() <= x_canvas_izq <= canvas_miniaturas.winfo_rootx() + canvas_miniaturas.winfo_width() and
+          canvas_miniaturas.winfo_rooty() <= y_canvas_izq <= canvas_miniaturas.winfo_rooty() + canvas_miniaturas.winfo_height()):
+        canvas_miniaturas.xview_scroll(int(-1 * (event.delta / 120)), "units")
 
 root.bind_all("<MouseWheel>", _on_mousewheel)
 
@@ -409,6 +740,8 @@ root.bind_all("<MouseWheel>", _on_mousewheel)
 def cerrar_programa():
     """Función que se ejecuta al cerrar la ventana para limpiar y salir."""
     print("Cerrando programa...")  #Mensaje opcional
+    cancelar_evento.set()  #Detiene el marcado en curso, si lo hay, al terminar la página actual
+    ejecutor_fitz.shutdown(wait=False, cancel_futures=True)
     root.quit()  #Detiene el loop de Tkinter
     root.destroy()  #Cierra la ventana completamente
     exit()  #Asegura que todo el proceso termine
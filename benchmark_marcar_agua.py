@@ -0,0 +1,779 @@
+"""
+Modulo que contiene pruebas de rendimiento para el marcado de agua de pdfs.
+Los pdfs de prueba se generan de forma sintética, por lo que no se necesita ningún fichero externo.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fitz
+from PIL import Image, ImageChops
+from marcar_agua_pdf import (anadir_marca_agua_a_pdf, vista_previa_pdf, vista_previa_pdf_imagen, cache_marcas_agua,
+                             _crear_marca_agua, _crear_marca_agua_imagen, _renderizar_pagina_base, _obtener_marca_agua,
+                             _disposicion_mosaico, _capas_vista_previa, PERFILES_GUARDADO, MIN_PAGINAS_POR_PROCESO,
+                             __version__ as __version_marca_agua__)
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+
+#Tamaños de página (ancho, alto en puntos) que se alternan en los pdfs de tamaños mezclados:
+#A4, carta, A3 apaisado y A5
+TAMANOS_MEZCLADOS = ((595, 842), (612, 792), (1191, 842), (420, 595))
+
+
+def _generar_pdf_sintetico(ruta_pdf: str, num_paginas: int, ancho: float = 595, alto: float = 842,
+                           con_imagenes: bool = False, tamanos_mezclados: bool = False):
+    """
+    Función que genera un pdf de texto con el número de páginas indicado.
+
+    Parameters:
+    ----------
+    - ruta_pdf (str): Ruta donde se guardará el pdf generado.
+    - num_paginas (int): Número de páginas del pdf.
+    - ancho (float): Ancho de cada página en puntos. A4 por defecto.
+    - alto (float): Alto de cada página en puntos. A4 por defecto.
+    - con_imagenes (bool): True añade a cada página una imagen JPEG distinta que la ocupa entera,
+      como en un pdf escaneado. False por defecto.
+    - tamanos_mezclados (bool): True alterna los tamaños de TAMANOS_MEZCLADOS e ignora ancho y alto.
+      False por defecto.
+    """
+
+    documento = fitz.open()
+    for numero in range(num_paginas):
+        if tamanos_mezclados:
+            ancho, alto = TAMANOS_MEZCLADOS[numero % len(TAMANOS_MEZCLADOS)]
+        pagina = documento.new_page(width=ancho, height=alto)
+        if con_imagenes:
+            #Ruido distinto en cada página para que las imágenes no se puedan compartir entre páginas
+            escaneo = Image.effect_noise((int(ancho * 2), int(alto * 2)), 20 + numero % 50).convert("RGB")
+            buffer_imagen = io.BytesIO()
+            escaneo.save(buffer_imagen, format="JPEG", quality=75)
+            pagina.insert_image(pagina.rect, stream=buffer_imagen.getvalue())
+        pagina.insert_text((72, 72), f"Página de prueba {numero + 1}", fontsize=14)
+    documento.save(ruta_pdf)
+    documento.close()
+
+
+def _contar_teselas(ruta_pdf: str):
+    """
+    Función que cuenta las imágenes colocadas en todas las páginas de un pdf.
+
+    Parameters:
+    ----------
+    - ruta_pdf (str): Ruta del pdf a analizar.
+
+    Returns:
+    --------
+    - teselas (int): Número total de imágenes dibujadas en el pdf.
+    """
+
+    documento = fitz.open(ruta_pdf)
+    teselas = sum(len(pagina.get_image_info()) for pagina in documento)
+    documento.close()
+    return teselas
+
+
+def _contar_flujos(ruta_pdf: str):
+    """
+    Función que cuenta los objetos de imagen de un pdf y los bytes (sin comprimir) del resto de sus flujos,
+    que son los flujos de contenido de las páginas y de los Form XObject. No dependen de la máquina.
+
+    Parameters:
+    ----------
+    - ruta_pdf (str): Ruta del pdf a analizar.
+
+    Returns:
+    --------
+    - flujos (tuple[int, int]): Número de objetos de imagen y bytes del resto de flujos.
+    """
+
+    imagenes = bytes_contenido = 0
+    with fitz.open(ruta_pdf) as documento:
+        for xref in range(1, documento.xref_length()):
+            if not documento.xref_is_stream(xref):
+                continue
+            if documento.xref_get_key(xref, "Subtype")[1] == "/Image":
+                imagenes += 1
+            else:
+                bytes_contenido += len(documento.xref_stream(xref))
+    return imagenes, bytes_contenido
+
+
+def medir_coste_por_tesela(paginas: tuple[int, ...] = (5, 20, 80),
+                           tamano_fuente: int = 16,
+                           reutilizar_imagen: bool = True,
+                           modo_mosaico: str = "plantilla"):
+    """
+    Función que marca pdfs de distinto número de páginas y mide lo que añade la marca de agua por cada
+    tesela del mosaico: objetos de imagen, bytes de flujos de contenido, tamaño de salida y tiempo.
+
+    Parameters:
+    ----------
+    - paginas (tuple[int, ...]): Números de páginas de los pdfs a generar.
+    - tamano_fuente (int): Tamaño de la fuente de la marca de agua.
+    - reutilizar_imagen (bool): Se pasa tal cual a anadir_marca_agua_a_pdf.
+    - modo_mosaico (str): Se pasa tal cual a anadir_marca_agua_a_pdf. "plantilla" por defecto.
+
+    Returns:
+    --------
+    - resultados (list[dict]): Una entrada por pdf con páginas, teselas, imágenes, bytes y segundos.
+    """
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as directorio:
+        for num_paginas in paginas:
+            ruta_entrada = os.path.join(directorio, f"entrada_{num_paginas}.pdf")
+            ruta_salida = os.path.join(directorio, f"salida_{num_paginas}.pdf")
+            _generar_pdf_sintetico(ruta_entrada, num_paginas)
+
+            inicio = time.perf_counter()
+            anadir_marca_agua_a_pdf(ruta_entrada, ruta_salida, "Confidencial", tamano_fuente, 100,
+                                    ruta_imagen="", reutilizar_imagen=reutilizar_imagen, modo_mosaico=modo_mosaico)
+            segundos = time.perf_counter() - inicio
+
+            #Se descuenta lo que ya tenía el pdf original para medir solo lo que aporta la marca de agua
+            bytes_marca = os.path.getsize(ruta_salida) - os.path.getsize(ruta_entrada)
+            imagenes_entrada, contenido_entrada = _contar_flujos(ruta_entrada)
+            imagenes_salida, contenido_salida = _contar_flujos(ruta_salida)
+            teselas = _contar_teselas(ruta_salida)
+            resultados.append({
+                "paginas": num_paginas,
+                "teselas": teselas,
+                "imagenes": imagenes_salida - imagenes_entrada,
+                "bytes_contenido": contenido_salida - contenido_entrada,
+                "bytes_por_tesela": bytes_marca / teselas,
+                "ms_por_tesela": segundos * 1000 / teselas,
+            })
+    return resultados
+
+
+def comprobar_coste_por_tesela(tolerancia: float = 1.05, **kwargs):
+    """
+    Función que comprueba que el coste por tesela no crece con el número de páginas: el pdf más grande no
+    puede tener más objetos de imagen que el más pequeño, y cada tesela de más entre dos pdfs consecutivos
+    (bytes de flujos de contenido añadidos entre teselas añadidas) no puede costar más entre los dos más
+    grandes que entre los dos más pequeños. Se compara el coste de las teselas de más y no la media, porque
+    la media reparte el coste fijo de las plantillas y puede bajar aunque cada tesela cueste cada vez más.
+    Son recuentos del pdf de salida y no tiempos, así que el resultado es el mismo en cualquier máquina.
+    main la ejecuta tras la batería y falla si no se cumple. El tiempo por tesela solo se muestra.
+
+    Parameters:
+    ----------
+    - tolerancia (float): Máximo cociente permitido entre el coste de las teselas de más de los dos pdfs
+      más grandes y el de los dos más pequeños. 1.05 por defecto.
+    - kwargs: Se pasan tal cual a medir_coste_por_tesela. Hacen falta al menos tres números de páginas.
+
+    Returns:
+    --------
+    - correcto (bool): True si el coste por tesela no crece.
+    """
+
+    resultados = medir_coste_por_tesela(**kwargs)
+    if len(resultados) < 3:
+        raise ValueError("Hacen falta al menos tres números de páginas")
+    #Bytes de contenido de cada tesela de más respecto al pdf anterior
+    marginales = [(actual["bytes_contenido"] - anterior["bytes_contenido"]) / (actual["teselas"] - anterior["teselas"])
+                  for anterior, actual in zip(resultados, resultados[1:])]
+    for resultado, marginal in zip(resultados, [None] + marginales):
+        texto_marginal = f"{marginal:>8.3f}" if marginal is not None else f"{'-':>8}"
+        print(f"{resultado['paginas']:>6} páginas | {resultado['teselas']:>7} teselas | "
+              f"{resultado['imagenes']:>4} imágenes | {resultado['bytes_contenido']:>9} bytes de contenido | "
+              f"{texto_marginal} por tesela de más | {resultado['bytes_por_tesela']:>8.1f} bytes/tesela | "
+              f"{resultado['ms_por_tesela']:>7.3f} ms/tesela")
+
+    correcto = (resultados[-1]["imagenes"] <= resultados[0]["imagenes"]
+                and marginales[-1] <= marginales[0] * tolerancia)
+    print("Coste por tesela constante" if correcto else "El coste por tesela crece con el número de páginas")
+    return correcto
+
+
+def comparar_motores(num_paginas: int = 20, tamano_fuente: int = 30, modo_mosaico: str = "imagen"):
+    """
+    Función que compara el motor raster y el motor vectorial de la marca de agua de texto,
+    midiendo el tamaño del pdf de salida y el tiempo de procesado de cada uno.
+
+    Parameters:
+    ----------
+    - num_paginas (int): Número de páginas del pdf sintético.
+    - tamano_fuente (int): Tamaño de la fuente de la marca de agua.
+    - modo_mosaico (str): Se pasa tal cual a anadir_marca_agua_a_pdf.
+
+    Returns:
+    --------
+    - resultados (dict): Bytes de salida y segundos por cada motor.
+    """
+
+    resultados = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_entrada = os.path.join(directorio, "entrada.pdf")
+        _generar_pdf_sintetico(ruta_entrada, num_paginas)
+        for motor in ("raster", "vectorial"):
+            ruta_salida = os.path.join(directorio, f"salida_{motor}.pdf")
+            inicio = time.perf_counter()
+            anadir_marca_agua_a_pdf(ruta_entrada, ruta_salida, "Confidencial", tamano_fuente, 100,
+                                    ruta_imagen="", modo_mosaico=modo_mosaico, motor=motor)
+            resultados[motor] = {"bytes": os.path.getsize(ruta_salida),
+                                 "segundos": time.perf_counter() - inicio}
+            print(f"{motor:>10} | {resultados[motor]['bytes']:>10} bytes | {resultados[motor]['segundos']:>7.3f} s")
+    return resultados
+
+
+def medir_escalado_procesos(num_paginas: int = None,
+                            procesos: tuple[int, ...] = (1, 2, 4, 8),
+                            modo_gris: str = "vectorial"):
+    """
+    Función que mide las páginas por segundo del marcado de agua en blanco y negro según el número de
+    procesos. num_procesos solo reparte la conversión a gris, por eso se mide siempre con blanco_y_negro.
+
+    Parameters:
+    ----------
+    - num_paginas (int): Número de páginas del pdf sintético. Por defecto, las justas para que el mayor
+      número de procesos reciba MIN_PAGINAS_POR_PROCESO páginas cada uno y se usen todos.
+    - procesos (tuple[int, ...]): Números de procesos a probar.
+    - modo_gris (str): Se pasa tal cual a anadir_marca_agua_a_pdf. "vectorial" por defecto.
+
+    Returns:
+    --------
+    - resultados (dict): Páginas por segundo para cada número de procesos.
+    """
+
+    if num_paginas is None:
+        num_paginas = MIN_PAGINAS_POR_PROCESO * max(procesos)
+    resultados = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_entrada = os.path.join(directorio, "entrada.pdf")
+        _generar_pdf_sintetico(ruta_entrada, num_paginas, con_imagenes=True)
+        for num_procesos in procesos:
+            ruta_salida = os.path.join(directorio, f"salida_{num_procesos}.pdf")
+            inicio = time.perf_counter()
+            anadir_marca_agua_a_pdf(ruta_entrada, ruta_salida, "Confidencial", 30, 100, ruta_imagen="",
+                                    blanco_y_negro=True, modo_mosaico="plantilla", modo_gris=modo_gris,
+                                    num_procesos=num_procesos)
+            resultados[num_procesos] = num_paginas / (time.perf_counter() - inicio)
+            print(f"{num_procesos:>3} procesos | {resultados[num_procesos]:>8.1f} páginas/s")
+    return resultados
+
+
+def _iniciar_pico_memoria():
+    """
+    Función que prepara la medida del pico de memoria del proceso actual. Donde no hay /proc ni el
+    módulo resource (Windows) pone en marcha tracemalloc, que solo ve la memoria reservada por Python
+    y no la de MuPDF, y además ralentiza algo el marcado.
+    """
+
+    if not os.path.exists("/proc/self/status") and importlib.util.find_spec("resource") is None:
+        tracemalloc.start()
+
+
+def _pico_memoria_proceso():
+    """
+    Función que devuelve el pico de memoria residente del proceso actual en bytes. En Linux se lee
+    VmHWM, porque ru_maxrss conserva tras exec el pico del proceso padre y falsearía las medidas de
+    los procesos nuevos. Si _iniciar_pico_memoria ha puesto en marcha tracemalloc, se devuelve su pico.
+    """
+
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    try:
+        with open("/proc/self/status", encoding="ascii") as estado:
+            for linea in estado:
+                if linea.startswith("VmHWM:"):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    #resource no existe en Windows, por eso se importa aquí. ru_maxrss está en bytes en macOS y en kilobytes en el resto
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def _medir_pico_memoria(ruta_entrada: str, ruta_salida: str, parametros: dict):
+    """
+    Función que se ejecuta en un proceso nuevo, marca un pdf y devuelve el pico de memoria residente
+    de ese proceso en bytes.
+    """
+
+    _iniciar_pico_memoria()
+    anadir_marca_agua_a_pdf(ruta_entrada, ruta_salida, **parametros)
+    return _pico_memoria_proceso()
+
+
+def medir_memoria_por_paginas(paginas: tuple[int, ...] = (25, 100, 400),
+                              paginas_por_bloque: int = None,
+                              blanco_y_negro: bool = True):
+    """
+    Función que mide el pico de memoria residente al marcar pdfs escaneados de distinto número de páginas.
+    Cada medida se hace en un proceso nuevo para que no influyan las anteriores.
+
+    Parameters:
+    ----------
+    - paginas (tuple[int, ...]): Números de páginas de los pdfs a generar.
+    - paginas_por_bloque (int): Se pasa tal cual a anadir_marca_agua_a_pdf. None procesa todo en memoria.
+    - blanco_y_negro (bool): Se pasa tal cual a anadir_marca_agua_a_pdf. True por defecto.
+
+    Returns:
+    --------
+    - resultados (dict): Pico de memoria en bytes para cada número de páginas.
+    """
+
+    parametros = {"texto_marca_agua": "Confidencial", "tamano_fuente": 30, "opacidad_texto": 100,
+                  "ruta_imagen": "", "blanco_y_negro": blanco_y_negro, "modo_mosaico": "plantilla",
+                  "paginas_por_bloque": paginas_por_bloque}
+    resultados = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        for num_paginas in paginas:
+            ruta_entrada = os.path.join(directorio, f"entrada_{num_paginas}.pdf")
+            ruta_salida = os.path.join(directorio, f"salida_{num_paginas}.pdf")
+            _generar_pdf_sintetico(ruta_entrada, num_paginas, con_imagenes=True)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as ejecutor:
+                resultados[num_paginas] = ejecutor.submit(_medir_pico_memoria, ruta_entrada, ruta_salida,
+                                                          parametros).result()
+            print(f"{num_paginas:>6} páginas | {resultados[num_paginas] / 2**20:>8.1f} MB de pico")
+    return resultados
+
+
+def comparar_perfiles_guardado(num_paginas: int = 50, con_imagenes: bool = True):
+    """
+    Función que mide el tiempo de guardado y el tamaño de salida de cada perfil de guardado
+    sobre el mismo pdf ya marcado.
+
+    Parameters:
+    ----------
+    - num_paginas (int): Número de páginas del pdf sintético.
+    - con_imagenes (bool): Se pasa tal cual a _generar_pdf_sintetico. True por defecto.
+
+    Returns:
+    --------
+    - resultados (dict): Segundos de guardado y bytes de salida para cada perfil.
+    """
+
+    resultados = {}
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_entrada = os.path.join(directorio, "entrada.pdf")
+        ruta_marcado = os.path.join(directorio, "marcado.pdf")
+        _generar_pdf_sintetico(ruta_entrada, num_paginas, con_imagenes=con_imagenes)
+        anadir_marca_agua_a_pdf(ruta_entrada, ruta_marcado, "Confidencial", 30, 100, ruta_imagen="",
+                                perfil_guardado="rapido")
+        for perfil, opciones in PERFILES_GUARDADO.items():
+            ruta_salida = os.path.join(directorio, f"salida_{perfil}.pdf")
+            with fitz.open(ruta_marcado) as documento:
+                inicio = time.perf_counter()
+                documento.save(ruta_salida, **opciones)
+                segundos = time.perf_counter() - inicio
+            resultados[perfil] = {"segundos": segundos, "bytes": os.path.getsize(ruta_salida)}
+            print(f"{perfil:>12} | {segundos:>7.3f} s de guardado | {resultados[perfil]['bytes']:>10} bytes")
+    return resultados
+
+
+def _preparar_imagen_referencia(ruta_imagen: str, tamano: int, opacidad: int):
+    """
+    Preparación de la marca de agua de imagen sin optimizar (LANCZOS sobre la imagen completa y
+    alfa escalado pixel a pixel), que sirve de referencia para comparar la versión optimizada.
+    """
+
+    imagen = Image.open(ruta_imagen).convert("RGBA")
+    ancho, alto = imagen.size
+    imagen = imagen.resize((max(1, int(ancho * tamano / 100)), max(1, int(alto * tamano / 100))),
+                           Image.Resampling.LANCZOS)
+    r, g, b, a = imagen.split()
+    a = a.point(lambda p: (p * opacidad + 127) // 255)
+    return Image.merge("RGBA", (r, g, b, a)).rotate(45, expand=True)
+
+
+def medir_preparacion_imagen(lados: tuple[int, ...] = (256, 1024, 2048, 4096, 7680),
+                             tamano: int = 20,
+                             opacidad: int = 128,
+                             repeticiones: int = 3):
+    """
+    Función que mide el tiempo de preparación de una marca de agua de imagen (PNG y JPEG) para
+    distintos tamaños de la imagen original, comparando la referencia con _crear_marca_agua_imagen.
+    También informa de la mayor diferencia entre ambos resultados en cualquier canal.
+
+    Parameters:
+    ----------
+    - lados (tuple[int, ...]): Ancho en píxeles de las imágenes originales (proporción 16:9).
+    - tamano (int): Porcentaje de reducción de la marca de agua.
+    - opacidad (int): Opacidad de la marca de agua entre 0 y 255.
+    - repeticiones (int): Veces que se repite cada medida, se toma la mejor.
+
+    Returns:
+    --------
+    - resultados (list[dict]): Una entrada por imagen con formato, lado, milisegundos y diferencia máxima.
+    """
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as directorio:
+        for lado in lados:
+            origen = Image.effect_noise((lado, lado * 9 // 16), 40).convert("RGB")
+            for formato in ("PNG", "JPEG"):
+                ruta_imagen = os.path.join(directorio, f"logo_{lado}.{formato.lower()}")
+                origen.save(ruta_imagen, format=formato)
+                tiempos = {}
+                for nombre, funcion in (("referencia", _preparar_imagen_referencia),
+                                        ("optimizada", _crear_marca_agua_imagen)):
+                    mejor = float("inf")
+                    for _ in range(repeticiones):
+                        inicio = time.perf_counter()
+                        imagen = funcion(ruta_imagen, tamano, opacidad)
+                        mejor = min(mejor, time.perf_counter() - inicio)
+                    tiempos[nombre] = (mejor * 1000, imagen)
+                diferencia = max(extremo[1] for extremo in ImageChops.difference(tiempos["referencia"][1],
+                                                                                 tiempos["optimizada"][1]).getextrema())
+                resultados.append({"formato": formato, "lado": lado, "ms_referencia": tiempos["referencia"][0],
+                                   "ms_optimizada": tiempos["optimizada"][0], "diferencia_maxima": diferencia})
+                print(f"{formato:>5} {lado:>5}px | referencia {tiempos['referencia'][0]:>8.1f} ms | "
+                      f"optimizada {tiempos['optimizada'][0]:>8.1f} ms | diferencia máxima {diferencia}")
+    return resultados
+
+
+def _vista_previa_referencia(ruta_pdf: str, texto: str, tamano_fuente: int, tamano_maximo: tuple[int, int] = None):
+    """
+    Composición de la vista previa sin capa precompuesta (una composición por tesela sobre la página),
+    que sirve de referencia para comparar con vista_previa_pdf_imagen.
+    """
+
+    base, escala = _renderizar_pagina_base(ruta_pdf, os.path.getmtime(ruta_pdf), 0, False, tamano_maximo)
+    imagen = base.copy()
+    marca_agua, _ = _obtener_marca_agua(texto, tamano_fuente, 100, False, (255, 0, 0), None)
+    teselas = _disposicion_mosaico(round(base.width / escala, 2), round(base.height / escala, 2),
+                                   marca_agua.width, marca_agua.height, 10, 1)
+    if escala != 1.0:
+        marca_agua = marca_agua.resize((max(1, round(marca_agua.width * escala)), max(1, round(marca_agua.height * escala))),
+                                       Image.Resampling.BILINEAR)
+    for x, y, _, _ in teselas:
+        imagen.paste(marca_agua, (round(x * escala), round(y * escala)), marca_agua)
+    return imagen, len(teselas)
+
+
+def medir_vista_previa(tamanos_fuente: tuple[int, ...] = (8, 12, 16, 24, 40),
+                       tamanos_maximos: tuple = ((400, 500), None),
+                       repeticiones: int = 5):
+    """
+    Función que mide la latencia de la vista previa para distintas densidades de teselas, con la página
+    y la marca de agua ya en caché, como al mover los controles de la interfaz. Compara la composición
+    tesela a tesela de referencia con vista_previa_pdf_imagen la primera vez (tesela a tesela), la segunda
+    (cuando construye la capa precompuesta) y con la capa ya guardada. También informa de la mayor
+    diferencia en cualquier canal entre la referencia y las vistas previas.
+
+    Parameters:
+    ----------
+    - tamanos_fuente (tuple[int, ...]): Tamaños de fuente de la marca de agua. Cuanto menor, más teselas.
+    - tamanos_maximos (tuple): Tamaños máximos de la vista previa. None la genera a 72 ppp.
+    - repeticiones (int): Veces que se repite cada medida, se toma la mejor.
+
+    Returns:
+    --------
+    - resultados (list[dict]): Una entrada por caso con teselas y milisegundos de cada variante.
+    """
+
+    def mejor_tiempo(funcion, preparar=None):
+        mejor = float("inf")
+        for _ in range(repeticiones):
+            if preparar is not None:
+                preparar()
+            inicio = time.perf_counter()
+            funcion()
+            mejor = min(mejor, time.perf_counter() - inicio)
+        return mejor * 1000
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_pdf = os.path.join(directorio, "vista_previa.pdf")
+        _generar_pdf_sintetico(ruta_pdf, 1)
+        for tamano_maximo in tamanos_maximos:
+            for tamano_fuente in tamanos_fuente:
+                referencia, teselas = _vista_previa_referencia(ruta_pdf, "Confidencial", tamano_fuente, tamano_maximo)
+
+                def vista_previa():
+                    return vista_previa_pdf_imagen(ruta_pdf, "Confidencial", tamano_fuente, 100,
+                                                   tamano_maximo=tamano_maximo)
+
+                def primera_vista_previa():
+                    _capas_vista_previa.clear()
+                    return vista_previa()
+
+                diferencia = max(extremo[1] for imagen in (primera_vista_previa(), vista_previa(), vista_previa())
+                                 for extremo in ImageChops.difference(referencia, imagen).getextrema())
+                ms_referencia = mejor_tiempo(lambda: _vista_previa_referencia(ruta_pdf, "Confidencial", tamano_fuente,
+                                                                              tamano_maximo))
+                ms_primera = mejor_tiempo(primera_vista_previa)
+                ms_segunda = mejor_tiempo(vista_previa, preparar=primera_vista_previa)
+                ms_cache = mejor_tiempo(vista_previa)
+                resolucion = f"{referencia.width}x{referencia.height}"
+                resultados.append({"resolucion": resolucion, "tamano_fuente": tamano_fuente, "teselas": teselas,
+                                   "ms_referencia": ms_referencia, "ms_primera": ms_primera, "ms_capa_nueva": ms_segunda,
+                                   "ms_capa_cache": ms_cache, "diferencia_maxima": diferencia})
+                print(f"{resolucion:>9} | fuente {tamano_fuente:>2} | {teselas:>5} teselas | referencia "
+                      f"{ms_referencia:>7.2f} ms | primera {ms_primera:>7.2f} ms | capa nueva {ms_segunda:>7.2f} ms | "
+                      f"capa en caché {ms_cache:>7.2f} ms | diferencia máxima {diferencia}")
+    return resultados
+
+
+#Tipos de pdf sintético de la batería de pruebas y los argumentos de _generar_pdf_sintetico de cada uno
+TIPOS_PDF = {
+    "texto": {},
+    "imagenes": {"con_imagenes": True},
+    "mezclado": {"tamanos_mezclados": True},
+}
+
+#Métricas que se comparan con la referencia. En todas, un valor mayor es peor
+METRICAS_REGRESION = ("segundos", "pico_memoria", "bytes_salida")
+
+
+def _ejecutar_caso(ruta_entrada: str, ruta_salida: str, parametros: dict):
+    """
+    Función que se ejecuta en un proceso nuevo, marca un pdf y devuelve el tiempo empleado y el pico
+    de memoria residente de ese proceso en bytes.
+    """
+
+    _iniciar_pico_memoria()
+    inicio = time.perf_counter()
+    anadir_marca_agua_a_pdf(ruta_entrada, ruta_salida, **parametros)
+    return time.perf_counter() - inicio, _pico_memoria_proceso()
+
+
+def _casos_bateria(paginas: tuple[int, ...], tipos: tuple[str, ...], paginas_barrido: int,
+                   tamanos_fuente: tuple[int, ...], espaciados: tuple[tuple[int, int], ...]):
+    """
+    Función que genera los casos de la batería: cada tipo de pdf con cada número de páginas y los
+    parámetros por defecto, y un barrido de tamaño de fuente, espaciado y blanco y negro sobre el pdf
+    de texto de paginas_barrido páginas.
+
+    Returns:
+    --------
+    - casos (list[tuple[str, str, int, dict]]): Nombre, tipo de pdf, páginas y parámetros de cada caso.
+    """
+
+    casos = []
+    for tipo in tipos:
+        for num_paginas in paginas:
+            casos.append((f"anadir/{tipo}/{num_paginas}p", tipo, num_paginas, {}))
+    for tamano_fuente in tamanos_fuente:
+        for espaciado_ancho, espaciado_alto in espaciados:
+            for blanco_y_negro in (False, True):
+                nombre = (f"barrido/texto/{paginas_barrido}p/fuente{tamano_fuente}"
+                          f"/espaciado{espaciado_ancho}x{espaciado_alto}/bn{int(blanco_y_negro)}")
+                casos.append((nombre, "texto", paginas_barrido, {"tamano_fuente": tamano_fuente,
+                                                                 "espaciado_ancho": espaciado_ancho,
+                                                                 "espaciado_alto": espaciado_alto,
+                                                                 "blanco_y_negro": blanco_y_negro}))
+    return casos
+
+
+def _medir_funciones(directorio: str, repeticiones: int):
+    """
+    Función que mide en frío (con las cachés vacías) las funciones de las que depende la vista previa:
+    _crear_marca_agua, _crear_marca_agua_imagen y vista_previa_pdf. Se toma la mejor de las repeticiones.
+
+    Returns:
+    --------
+    - resultados (list[dict]): Nombre y segundos de cada función.
+    """
+
+    ruta_pdf = os.path.join(directorio, "vista_previa.pdf")
+    ruta_imagen = os.path.join(directorio, "logo.jpg")
+    _generar_pdf_sintetico(ruta_pdf, 1, con_imagenes=True)
+    Image.effect_noise((1920, 1080), 40).convert("RGB").save(ruta_imagen, format="JPEG")
+
+    def vista_previa_en_frio():
+        cache_marcas_agua.limpiar()
+        _renderizar_pagina_base.cache_clear()
+        _capas_vista_previa.clear()
+        vista_previa_pdf(ruta_pdf, "Confidencial", 30, 100)
+
+    funciones = (
+        ("funcion/_crear_marca_agua", lambda: _crear_marca_agua("Confidencial", 30, 100)),
+        ("funcion/_crear_marca_agua_imagen", lambda: _crear_marca_agua_imagen(ruta_imagen, 20, 100)),
+        ("funcion/vista_previa_pdf", vista_previa_en_frio),
+    )
+    resultados = []
+    for nombre, funcion in funciones:
+        mejor = float("inf")
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            funcion()
+            mejor = min(mejor, time.perf_counter() - inicio)
+        resultados.append({"nombre": nombre, "segundos": mejor})
+    return resultados
+
+
+def ejecutar_bateria(paginas: tuple[int, ...] = (10, 100, 1000),
+                     tipos: tuple[str, ...] = tuple(TIPOS_PDF),
+                     paginas_barrido: int = 100,
+                     tamanos_fuente: tuple[int, ...] = (16, 40),
+                     espaciados: tuple[tuple[int, int], ...] = ((10, 1), (60, 30)),
+                     repeticiones: int = 3):
+    """
+    Función que ejecuta la batería completa de pruebas de rendimiento. Cada llamada a
+    anadir_marca_agua_a_pdf se hace en un proceso nuevo para medir su pico de memoria sin que
+    influyan las anteriores. Los pdfs de entrada se generan una sola vez por tipo y número de páginas.
+
+    Parameters:
+    ----------
+    - paginas (tuple[int, ...]): Números de páginas de los pdfs de cada tipo.
+    - tipos (tuple[str, ...]): Tipos de pdf de TIPOS_PDF a probar.
+    - paginas_barrido (int): Páginas del pdf sobre el que se hace el barrido de parámetros.
+    - tamanos_fuente (tuple[int, ...]): Tamaños de fuente del barrido.
+    - espaciados (tuple[tuple[int, int], ...]): Espaciados (ancho, alto) del barrido.
+    - repeticiones (int): Repeticiones de las medidas de funciones sueltas, se toma la mejor.
+
+    Returns:
+    --------
+    - informe (dict): Entorno de la ejecución y lista de resultados, listo para guardarse en JSON.
+    """
+
+    parametros_base = {"texto_marca_agua": "Confidencial", "tamano_fuente": 30, "opacidad_texto": 100,
+                       "ruta_imagen": ""}
+    resultados = []
+    with tempfile.TemporaryDirectory() as directorio:
+        entradas = {}
+        contexto = multiprocessing.get_context("spawn")
+        for nombre, tipo, num_paginas, parametros in _casos_bateria(paginas, tipos, paginas_barrido,
+                                                                    tamanos_fuente, espaciados):
+            if (tipo, num_paginas) not in entradas:
+                entradas[(tipo, num_paginas)] = os.path.join(directorio, f"entrada_{tipo}_{num_paginas}.pdf")
+                _generar_pdf_sintetico(entradas[(tipo, num_paginas)], num_paginas, **TIPOS_PDF[tipo])
+            ruta_salida = os.path.join(directorio, "salida.pdf")
+            with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as ejecutor:
+                segundos, pico_memoria = ejecutor.submit(_ejecutar_caso, entradas[(tipo, num_paginas)], ruta_salida,
+                                                         {**parametros_base, **parametros}).result()
+            resultados.append({"nombre": nombre, "paginas": num_paginas, "segundos": segundos,
+                               "paginas_por_segundo": num_paginas / segundos, "pico_memoria": pico_memoria,
+                               "bytes_salida": os.path.getsize(ruta_salida)})
+            print(f"{nombre:<52} | {segundos:>8.3f} s | {num_paginas / segundos:>8.1f} pág/s | "
+                  f"{pico_memoria / 2**20:>7.1f} MB | {resultados[-1]['bytes_salida']:>10} bytes")
+        for resultado in _medir_funciones(directorio, repeticiones):
+            resultados.append(resultado)
+            print(f"{resultado['nombre']:<52} | {resultado['segundos'] * 1000:>8.1f} ms")
+
+    return {
+        "version": __version_marca_agua__,
+        "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "pymupdf": fitz.VersionBind,
+        "plataforma": platform.platform(),
+        "resultados": resultados,
+    }
+
+
+def comparar_con_referencia(informe: dict, referencia: dict, tolerancia: float = 0.2):
+    """
+    Función que compara un informe de la batería con otro guardado como referencia y muestra las
+    regresiones: métricas de METRICAS_REGRESION que empeoran más de la tolerancia indicada.
+    Los casos que solo aparecen en uno de los dos informes se ignoran.
+
+    Parameters:
+    ----------
+    - informe (dict): Informe actual, como lo devuelve ejecutar_bateria.
+    - referencia (dict): Informe de referencia.
+    - tolerancia (float): Empeoramiento relativo permitido. 0.2 (un 20 %) por defecto.
+
+    Returns:
+    --------
+    - regresiones (list[dict]): Caso, métrica, valor de referencia y valor actual de cada regresión.
+    """
+
+    anteriores = {resultado["nombre"]: resultado for resultado in referencia["resultados"]}
+    regresiones = []
+    for resultado in informe["resultados"]:
+        anterior = anteriores.get(resultado["nombre"])
+        if anterior is None:
+            continue
+        for metrica in METRICAS_REGRESION:
+            if metrica in resultado and anterior.get(metrica) and resultado[metrica] > anterior[metrica] * (1 + tolerancia):
+                regresiones.append({"nombre": resultado["nombre"], "metrica": metrica,
+                                    "referencia": anterior[metrica], "actual": resultado[metrica]})
+                print(f"REGRESIÓN {resultado['nombre']} | {metrica}: {anterior[metrica]:.4g} -> {resultado[metrica]:.4g} "
+                      f"({resultado[metrica] / anterior[metrica] - 1:+.0%})")
+    if not regresiones:
+        print(f"Sin regresiones respecto a la referencia ({referencia.get('fecha', 'sin fecha')}).")
+    return regresiones
+
+
+#Medidas sueltas que se pueden lanzar desde la línea de comandos con --medidas, con sus valores por defecto
+MEDIDAS = {
+    "motores": comparar_motores,
+    "procesos": medir_escalado_procesos,
+    "memoria": medir_memoria_por_paginas,
+    "perfiles": comparar_perfiles_guardado,
+    "imagen": medir_preparacion_imagen,
+    "vista_previa": medir_vista_previa,
+    "teselas": comprobar_coste_por_tesela,
+}
+
+
+def _crear_parser():
+    """Crea el analizador de argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Pruebas de rendimiento del marcado de agua de pdfs.")
+    parser.add_argument("--paginas", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Números de páginas de los pdfs sintéticos (de 10 a 5000).")
+    parser.add_argument("--tipos", nargs="+", choices=tuple(TIPOS_PDF), default=list(TIPOS_PDF))
+    parser.add_argument("--paginas-barrido", type=int, default=100,
+                        help="Páginas del pdf del barrido de fuente, espaciado y blanco y negro.")
+    parser.add_argument("--tamanos-fuente", type=int, nargs="+", default=[16, 40])
+    parser.add_argument("--espaciados", nargs="+", default=["10x1", "60x30"], help="Espaciados como ANCHOxALTO.")
+    parser.add_argument("--json", help="Fichero donde se guarda el informe.")
+    parser.add_argument("--referencia", help="Informe JSON con el que se compara. Devuelve 1 si hay regresiones.")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Empeoramiento relativo permitido.")
+    parser.add_argument("--medidas", nargs="+", choices=tuple(MEDIDAS),
+                        help="Ejecuta solo estas medidas sueltas en lugar de la batería.")
+    return parser
+
+
+def main(argumentos: list[str] = None):
+    """
+    Función principal de la batería de pruebas de rendimiento.
+
+    Parameters:
+    ----------
+    - argumentos (list[str]): Argumentos a analizar. Por defecto, los de sys.argv.
+
+    Returns:
+    --------
+    - codigo (int): 0 si el coste por tesela se mantiene constante y no hay regresiones respecto a la
+      referencia, 1 en caso contrario. Con --medidas, 1 si la de teselas no se cumple.
+    """
+
+    args = _crear_parser().parse_args(argumentos)
+    if args.medidas:
+        informe = {}
+        for nombre in args.medidas:
+            print(f"== {nombre}")
+            informe[nombre] = MEDIDAS[nombre]()
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as fichero:
+                json.dump(informe, fichero, indent=2, ensure_ascii=False)
+        return 0 if informe.get("teselas", True) else 1
+    espaciados = tuple(tuple(int(valor) for valor in espaciado.split("x")) for espaciado in args.espaciados)
+    informe = ejecutar_bateria(tuple(args.paginas), tuple(args.tipos), args.paginas_barrido,
+                               tuple(args.tamanos_fuente), espaciados)
+    informe["coste_por_tesela_constante"] = comprobar_coste_por_tesela()
+    codigo = 0 if informe["coste_por_tesela_constante"] else 1
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fichero:
+            json.dump(informe, fichero, indent=2, ensure_ascii=False)
+    if args.referencia:
+        with open(args.referencia, encoding="utf-8") as fichero:
+            referencia = json.load(fichero)
+        if comparar_con_referencia(informe, referencia, args.tolerancia):
+            codigo = 1
+    return codigo
+
+
+if __name__ == "__main__":
+    sys.exit(main())
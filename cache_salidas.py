@@ -0,0 +1,228 @@
+"""
+Modulo que contiene una caché en disco de pdfs ya marcados. Cada salida se guarda con el hash del pdf
+de entrada, de todos los parámetros de la marca de agua (incluido el contenido de la imagen) y del
+código que genera la salida, de modo que volver a marcar un pdf que no ha cambiado solo cuesta calcular ese hash.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import fitz
+from functools import lru_cache
+import marcar_agua_pdf
+from marcar_agua_pdf import _resolver_fuente
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+
+#Tamaño de los trozos en los que se leen los ficheros para calcular su hash
+TAMANO_LECTURA = 1024 * 1024
+
+
+def _hash_fichero(ruta: str):
+    """Devuelve el sha256 en hexadecimal del contenido de un fichero, leído por trozos."""
+    resumen = hashlib.sha256()
+    with open(ruta, "rb") as fichero:
+        for trozo in iter(lambda: fichero.read(TAMANO_LECTURA), b""):
+            resumen.update(trozo)
+    return resumen.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def _huella_codigo():
+    """
+    Devuelve el sha256 del código fuente de marcar_agua_pdf, que es el que genera los pdfs marcados, así
+    cualquier cambio en él invalida las entradas guardadas sin tener que acordarse de subir una versión.
+    Si el código fuente no está disponible (programa empaquetado) se usa la versión del módulo.
+    """
+
+    try:
+        return _hash_fichero(marcar_agua_pdf.__file__)
+    except (AttributeError, OSError):
+        return marcar_agua_pdf.__version__
+
+
+def _enlazar_o_copiar(origen: str, destino: str):
+    """Crea destino como enlace duro de origen, o lo copia si no es posible (otro disco, sistema sin enlaces)."""
+    try:
+        os.link(origen, destino)
+    except OSError:
+        shutil.copyfile(origen, destino)
+
+
+class CacheSalidas:
+    """
+    Clase que guarda en un directorio los pdfs ya marcados, identificados por su clave (ver clave).
+    Al superar max_bytes se eliminan las entradas usadas hace más tiempo. Los aciertos se devuelven
+    como enlaces duros siempre que se puede, sin copiar el pdf.
+
+    Los pdfs de salida comparten el fichero con la caché, por eso no deben modificarse en el sitio:
+    quien los vaya a sobrescribir debe escribir otro fichero y sustituirlos (como hace marcar_con_cache).
+
+    Parameters:
+    ----------
+    - directorio (str): Directorio de la caché. Se crea si no existe.
+    - max_bytes (int): Tamaño máximo de la caché en bytes. 1 GB por defecto.
+    """
+
+    def __init__(self, directorio: str, max_bytes: int = 2**30):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.aciertos = 0
+        self.fallos = 0
+        os.makedirs(directorio, exist_ok=True)
+
+    def clave(self, ruta_entrada_pdf: str, parametros: dict):
+        """
+        Método que calcula la clave de un marcado: sha256 del pdf de entrada, de los parámetros, del
+        contenido de la imagen de la marca de agua, de la fuente en uso, del código que genera la salida
+        y de la versión de PyMuPDF.
+
+        Parameters:
+        ----------
+        - ruta_entrada_pdf (str): Ruta del pdf a marcar.
+        - parametros (dict): Parámetros de la marca de agua, como los de MarcadorAgua.
+
+        Returns:
+        --------
+        - clave (str): Clave en hexadecimal.
+        """
+
+        parametros = dict(parametros)
+        ruta_imagen = parametros.pop("ruta_imagen", None)
+        descripcion = {
+            "entrada": _hash_fichero(ruta_entrada_pdf),
+            "parametros": parametros,
+            "imagen": _hash_fichero(ruta_imagen) if ruta_imagen and os.path.isfile(ruta_imagen) else None,
+            "fuente": _resolver_fuente(),
+            "codigo": _huella_codigo(),
+            "pymupdf": fitz.VersionBind,
+        }
+        return hashlib.sha256(json.dumps(descripcion, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _ruta(self, clave: str):
+        """Devuelve la ruta de la entrada de una clave, repartidas en subdirectorios por sus dos primeros caracteres."""
+        return os.path.join(self.directorio, clave[:2], clave + ".pdf")
+
+    def obtener(self, clave: str, ruta_salida_pdf: str):
+        """
+        Método que, si la clave está en la caché, deja su pdf en la ruta de salida.
+
+        Parameters:
+        ----------
+        - clave (str): Clave del marcado.
+        - ruta_salida_pdf (str): Ruta donde se dejará el pdf. Si ya existe, se sustituye.
+
+        Returns:
+        --------
+        - acierto (bool): True si estaba en la caché.
+        """
+
+        ruta = self._ruta(clave)
+        if not os.path.isfile(ruta):
+            self.fallos += 1
+            return False
+        #Se enlaza en un fichero temporal que sustituye a la salida de una vez, que puede ser el propio pdf de entrada
+        temporal = f"{ruta_salida_pdf}.{os.getpid()}.tmp"
+        _enlazar_o_copiar(ruta, temporal)
+        os.replace(temporal, ruta_salida_pdf)
+        #La fecha de modificación marca el último uso para la expulsión
+        os.utime(ruta)
+        self.aciertos += 1
+        return True
+
+    def guardar(self, clave: str, ruta_salida_pdf: str):
+        """
+        Método que añade a la caché un pdf recién marcado y expulsa las entradas más antiguas si se supera
+        el tamaño máximo. Varios procesos pueden guardar a la vez: cada entrada se escribe en un fichero
+        temporal propio y se mueve a su sitio de una vez.
+
+        Parameters:
+        ----------
+        - clave (str): Clave del marcado.
+        - ruta_salida_pdf (str): Ruta del pdf marcado.
+        """
+
+        ruta = self._ruta(clave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        _enlazar_o_copiar(ruta_salida_pdf, temporal)
+        os.replace(temporal, ruta)
+        self._expulsar()
+
+    def _expulsar(self):
+        """Método que elimina las entradas usadas hace más tiempo hasta que la caché no supera max_bytes."""
+        entradas = []
+        for subdirectorio in os.scandir(self.directorio):
+            if subdirectorio.is_dir():
+                for entrada in os.scandir(subdirectorio.path):
+                    if entrada.name.endswith(".pdf"):
+                        estado = entrada.stat()
+                        entradas.append((estado.st_mtime, estado.st_size, entrada.path))
+        total = sum(tamano for _, tamano, _ in entradas)
+        for _, tamano, ruta in sorted(entradas):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                #Otro proceso la ha expulsado a la vez
+                pass
+            total -= tamano
+
+    def limpiar(self):
+        """Método que vacía la caché y reinicia los contadores."""
+        shutil.rmtree(self.directorio, ignore_errors=True)
+        os.makedirs(self.directorio, exist_ok=True)
+        self.aciertos = self.fallos = 0
+
+    def estadisticas(self):
+        """Método que devuelve los aciertos, los fallos y la tasa de aciertos de esta instancia."""
+        consultas = self.aciertos + self.fallos
+        return {"aciertos": self.aciertos, "fallos": self.fallos,
+                "tasa_aciertos": self.aciertos / consultas if consultas else 0.0}
+
+
+def marcar_con_cache(cache: CacheSalidas, obtener_marcador, ruta_entrada_pdf: str, ruta_salida_pdf: str,
+                     parametros: dict):
+    """
+    Función que marca un pdf pasando por la caché: si ya se había marcado con los mismos parámetros se
+    reutiliza la salida guardada y, si no, se marca con el marcador y se guarda en la caché.
+
+    Parameters:
+    ----------
+    - cache (CacheSalidas): Caché de salidas.
+    - obtener_marcador (callable): Función sin argumentos que devuelve el MarcadorAgua de los parámetros.
+      Solo se llama si hay un fallo, para no preparar la marca de agua cuando todo viene de la caché.
+    - ruta_entrada_pdf (str): Ruta del pdf a marcar.
+    - ruta_salida_pdf (str): Ruta donde se guardará el pdf marcado.
+    - parametros (dict): Parámetros con los que se ha construido el marcador, para la clave.
+
+    Returns:
+    --------
+    - acierto (bool): True si la salida venía de la caché.
+    """
+
+    clave = cache.clave(ruta_entrada_pdf, parametros)
+    if cache.obtener(clave, ruta_salida_pdf):
+        return True
+    #Se marca en un fichero temporal nuevo y se sustituye la salida al terminar: así nunca se escribe dentro de
+    #un fichero enlazado con la caché y, si la salida es el propio pdf de entrada, no se toca hasta tener el resultado
+    temporal = f"{ruta_salida_pdf}.{os.getpid()}.marcando.tmp"
+    try:
+        obtener_marcador().aplicar(ruta_entrada_pdf, temporal)
+        os.replace(temporal, ruta_salida_pdf)
+    except BaseException:
+        if os.path.isfile(temporal):
+            os.remove(temporal)
+        raise
+    cache.guardar(clave, ruta_salida_pdf)
+    return False
@@ -0,0 +1,257 @@
+"""
+Modulo que contiene la interfaz de línea de comandos para añadir marcas de agua a varios pdfs sin
+interfaz gráfica. Pensado para su uso en procesos automáticos.
+
+Ejemplo:
+    python marcar_agua_cli.py "entrada/*.pdf" -o salida --texto "Confidencial" --procesos 4
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from marcar_agua_pdf import PERFILES_GUARDADO
+from utilidades_marca_agua import procesar_pdf
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+
+def _buscar_pdfs(entradas: list[str]):
+    """
+    Función que expande las entradas de la línea de comandos en una lista de pdfs.
+
+    Parameters:
+    ----------
+    - entradas (list[str]): Directorios, rutas de pdfs o patrones glob.
+
+    Returns:
+    --------
+    - rutas (list[str]): Rutas de los pdfs encontrados, sin repetir y ordenadas.
+    """
+
+    rutas = set()
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            #La extensión se compara sin distinguir mayúsculas, los escáneres suelen guardar ".PDF"
+            candidatas = (os.path.join(entrada, nombre) for nombre in os.listdir(entrada))
+        else:
+            candidatas = glob.glob(entrada)
+        rutas.update(ruta for ruta in candidatas if ruta.lower().endswith(".pdf") and os.path.isfile(ruta))
+    return sorted(rutas)
+
+
+#Fichero del directorio de salida donde se guarda con qué parámetros se ha marcado cada pdf
+FICHERO_HUELLAS = ".marcar_agua_cli.json"
+
+
+def _huella_parametros(parametros: dict):
+    """
+    Función que resume en un hash los parámetros de la marca de agua y la fuente elegida, para saber si
+    un pdf de salida se marcó con los mismos que se piden ahora.
+    """
+
+    descripcion = {"parametros": parametros, "fuente": os.environ.get("MARCA_AGUA_FUENTE", "")}
+    return hashlib.sha256(json.dumps(descripcion, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _leer_huellas(directorio_salida: str):
+    """Devuelve las huellas de parámetros de los pdfs del directorio de salida, vacías si no hay o no se pueden leer."""
+    try:
+        with open(os.path.join(directorio_salida, FICHERO_HUELLAS), encoding="utf-8") as fichero:
+            huellas = json.load(fichero)
+        return huellas if isinstance(huellas, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _guardar_huellas(directorio_salida: str, huellas: dict):
+    """Guarda las huellas de parámetros en el directorio de salida, sustituyendo el fichero de una vez."""
+    ruta = os.path.join(directorio_salida, FICHERO_HUELLAS)
+    with open(ruta + ".tmp", "w", encoding="utf-8") as fichero:
+        json.dump(huellas, fichero, indent=1)
+    os.replace(ruta + ".tmp", ruta)
+
+
+def _esta_actualizado(ruta_entrada: str, ruta_salida: str, ruta_imagen: str = None, huella: str = None,
+                      huella_salida: str = None):
+    """
+    Función que indica si el pdf de salida ya existe, se marcó con los mismos parámetros y es más reciente
+    que sus fuentes.
+
+    Parameters:
+    ----------
+    - ruta_entrada (str): Ruta del pdf original.
+    - ruta_salida (str): Ruta del pdf con la marca de agua.
+    - ruta_imagen (str): Ruta de la imagen de la marca de agua, si la hay.
+    - huella (str): Huella de los parámetros pedidos ahora (ver _huella_parametros).
+    - huella_salida (str): Huella con la que se marcó el pdf de salida. None si no se conoce.
+
+    Returns:
+    --------
+    - actualizado (bool): True si no hace falta volver a procesar el pdf.
+    """
+
+    if not os.path.isfile(ruta_salida) or huella != huella_salida:
+        return False
+    fecha_salida = os.path.getmtime(ruta_salida)
+    fuentes = [ruta_entrada] + ([ruta_imagen] if ruta_imagen and os.path.isfile(ruta_imagen) else [])
+    return all(os.path.getmtime(fuente) <= fecha_salida for fuente in fuentes)
+
+
+def _leer_color(texto: str):
+    """Convierte un color "R,G,B" de la línea de comandos en una tupla."""
+    try:
+        color = tuple(int(canal) for canal in texto.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Color no válido: {texto}")
+    if len(color) != 3 or not all(0 <= canal <= 255 for canal in color):
+        raise argparse.ArgumentTypeError(f"Color no válido: {texto}")
+    return color
+
+
+def _crear_parser():
+    """Crea el analizador de argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Añade una marca de agua en mosaico a uno o varios pdfs.")
+    parser.add_argument("entradas", nargs="+", help="Directorios, pdfs o patrones glob (entre comillas) a procesar.")
+    parser.add_argument("-o", "--salida", required=True, help="Directorio donde se guardarán los pdfs marcados.")
+    parser.add_argument("--texto", default="", help="Texto de la marca de agua.")
+    parser.add_argument("--imagen", default="", help="Imagen de la marca de agua. Si se indica, se ignora el texto.")
+    parser.add_argument("--tamano", type=int, default=16, help="Tamaño de la fuente o porcentaje de la imagen.")
+    parser.add_argument("--opacidad", type=int, default=100, help="Opacidad entre 0 y 255.")
+    parser.add_argument("--fuente", default="",
+                        help="Fichero o nombre de la fuente del texto. Por defecto, MARCA_AGUA_FUENTE o Arial/DejaVu Sans.")
+    parser.add_argument("--mayusculas", action="store_true", help="Pone el texto en mayúsculas.")
+    parser.add_argument("--color", type=_leer_color, default=(255, 0, 0), help="Color del texto como R,G,B.")
+    parser.add_argument("--blanco-y-negro", action="store_true", help="Convierte los pdfs a escala de grises.")
+    parser.add_argument("--espaciado-ancho", type=int, default=10, help="Separación horizontal entre teselas.")
+    parser.add_argument("--espaciado-alto", type=int, default=1, help="Separación vertical entre teselas.")
+    parser.add_argument("--modo-mosaico", choices=("imagen", "plantilla"), default="plantilla")
+    parser.add_argument("--motor", choices=("raster", "vectorial"), default="raster")
+    parser.add_argument("--perfil-guardado", choices=tuple(PERFILES_GUARDADO), default="equilibrado",
+                        help="Compromiso entre tiempo de guardado y tamaño del pdf de salida.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Copia cada pdf y añade la marca de agua al final, en su propia capa, sin reescribirlo.")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1,
+                        help="Número de pdfs que se procesan a la vez. Por defecto, uno por núcleo.")
+    parser.add_argument("--estadisticas", action="store_true",
+                        help="Muestra el tiempo de cada etapa y el número de teselas de cada pdf.")
+    parser.add_argument("--cache", help="Directorio de la caché de salidas. Los pdfs ya marcados con los mismos "
+                                        "parámetros se toman de ella sin volver a procesarlos. Se ignora con --estadisticas.")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Tamaño máximo de la caché en MB.")
+    parser.add_argument("--forzar", action="store_true", help="Procesa también los pdfs cuya salida está al día.")
+    return parser
+
+
+def main(argumentos: list[str] = None):
+    """
+    Función principal de la línea de comandos.
+
+    Parameters:
+    ----------
+    - argumentos (list[str]): Argumentos a analizar. Por defecto, los de sys.argv.
+
+    Returns:
+    --------
+    - codigo (int): 0 si todos los pdfs se han procesado correctamente, 1 en caso contrario.
+    """
+
+    args = _crear_parser().parse_args(argumentos)
+    if not args.texto.strip() and not os.path.isfile(args.imagen):
+        print("Debes indicar un texto o una imagen como marca de agua.", file=sys.stderr)
+        return 1
+
+    rutas = _buscar_pdfs(args.entradas)
+    if not rutas:
+        print("No se ha encontrado ningún pdf.", file=sys.stderr)
+        return 1
+    #Los pdfs se guardan con su nombre en el directorio de salida: dos con el mismo nombre se pisarían
+    por_salida = {}
+    for ruta in rutas:
+        por_salida.setdefault(os.path.normcase(os.path.basename(ruta)), []).append(ruta)
+    repetidos = [origenes for origenes in por_salida.values() if len(origenes) > 1]
+    if repetidos:
+        for origenes in repetidos:
+            print(f"Varios pdfs tendrían la misma salida: {', '.join(origenes)}", file=sys.stderr)
+        return 1
+    os.makedirs(args.salida, exist_ok=True)
+    #La fuente se pasa por el entorno para que la resuelva cada proceso
+    if args.fuente:
+        os.environ["MARCA_AGUA_FUENTE"] = args.fuente
+
+    parametros = {
+        "texto_marca_agua": args.texto,
+        "tamano_fuente": args.tamano,
+        "opacidad_texto": args.opacidad,
+        "texto_mayusculas": args.mayusculas,
+        "color_texto": args.color,
+        "blanco_y_negro": args.blanco_y_negro,
+        "ruta_imagen": args.imagen,
+        "espaciado_ancho": args.espaciado_ancho,
+        "espaciado_alto": args.espaciado_alto,
+        "modo_mosaico": args.modo_mosaico,
+        "motor": args.motor,
+        "perfil_guardado": None if args.incremental else args.perfil_guardado,
+        "incremental": args.incremental,
+    }
+
+    #Se descartan los pdfs cuya salida ya está al día y se marcó con los mismos parámetros
+    huella = _huella_parametros(parametros)
+    huellas = _leer_huellas(args.salida)
+    pendientes = []
+    for ruta in rutas:
+        ruta_salida = os.path.join(args.salida, os.path.basename(ruta))
+        if not args.forzar and _esta_actualizado(ruta, ruta_salida, args.imagen, huella,
+                                                 huellas.get(os.path.basename(ruta))):
+            print(f"{'al día':>10} | {ruta}")
+        else:
+            pendientes.append((ruta, ruta_salida))
+
+    inicio = time.perf_counter()
+    resultados = []
+    cache = (args.cache, args.cache_max_mb * 2**20) if args.cache else None
+    aciertos_cache = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.procesos)) as ejecutor:
+        futuros = [ejecutor.submit(procesar_pdf, ruta, ruta_salida, parametros, args.estadisticas, cache)
+                   for ruta, ruta_salida in pendientes]
+        for futuro in futuros:
+            ruta, num_paginas, segundos, error, resumen, acierto = futuro.result()
+            resultados.append((num_paginas, error))
+            if error is None:
+                huellas[os.path.basename(ruta)] = huella
+            aciertos_cache += acierto
+            if error:
+                print(f"{'error':>10} | {ruta} | {error}", file=sys.stderr)
+            else:
+                print(f"{segundos:>9.2f}s | {ruta} | {num_paginas} páginas{' (caché)' if acierto else ''}")
+            if resumen is not None:
+                etapas = ", ".join(f"{etapa} {segundos:.3f}s" for etapa, segundos in resumen["etapas"].items())
+                print(f"{'':>10} | {etapas} | {resumen['contadores'].get('teselas', 0)} teselas")
+    total_segundos = time.perf_counter() - inicio
+    if pendientes:
+        _guardar_huellas(args.salida, huellas)
+
+    #Resumen de rendimiento de todo el lote
+    correctos = sum(1 for _, error in resultados if error is None)
+    total_paginas = sum(num_paginas for num_paginas, _ in resultados)
+    print(f"Procesados: {correctos}, con error: {len(resultados) - correctos}, al día: {len(rutas) - len(pendientes)}")
+    if cache and resultados:
+        print(f"Caché: {aciertos_cache} aciertos de {len(resultados)} ({aciertos_cache / len(resultados):.0%})")
+    if total_segundos > 0 and resultados:
+        print(f"Tiempo total: {total_segundos:.2f}s | {correctos / total_segundos:.2f} pdfs/s | "
+              f"{total_paginas / total_segundos:.1f} páginas/s")
+    return 0 if correctos == len(resultados) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,19 @@ Modulo que contiene funciones para añadir una marca de agua en un pdf.
 """
 
 import os
+import math
+import shutil
 import fitz
 from PIL import Image, ImageDraw, ImageFont
 import io
+import time
+import hashlib
+import warnings
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 __author__ = "Adrian Mateos"
 __copyright__ = "Copyright 2025"
@@ -17,6 +27,221 @@ __email__ = "https://github.com/moraloamg"
 __status__ = "Completed"
 
 
+class ProcesoCancelado(Exception):
+    """Excepción que se lanza cuando la función de progreso pide cancelar el marcado de un pdf."""
+
+
+class Estadisticas:
+    """
+    Clase que recoge los tiempos por etapa y por página y los contadores de un marcado de agua.
+    Se pasa a anadir_marca_agua_a_pdf en el parámetro estadisticas, que la devuelve rellena.
+
+    Etapas: "marca_agua" (construcción), "png" (codificación), "gris", "plantillas", "mosaico",
+    "paralelo" (tiempo real del reparto entre procesos) y "guardado". Contadores: "paginas", "teselas",
+    "aciertos_cache" y "bytes_salida". En el modo paralelo las etapas de cada proceso se suman.
+
+    Parameters:
+    ----------
+    - al_registrar (callable): Función al_registrar(tipo, nombre, valor) que se llama con cada medida,
+      siendo tipo "etapa", "pagina" o "contador". Sirve para enviar las medidas a un sistema de métricas.
+      None por defecto.
+    """
+
+    def __init__(self, al_registrar = None):
+        self.etapas = {}
+        self.paginas = {}
+        self.contadores = {}
+        self.al_registrar = al_registrar
+
+    @contextmanager
+    def medir(self, etapa: str):
+        """Mide el tiempo del bloque with y lo suma a la etapa indicada."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.anadir_etapa(etapa, time.perf_counter() - inicio)
+
+    def anadir_etapa(self, etapa: str, segundos: float):
+        """Suma segundos a una etapa."""
+        self.etapas[etapa] = self.etapas.get(etapa, 0.0) + segundos
+        if self.al_registrar is not None:
+            self.al_registrar("etapa", etapa, segundos)
+
+    def anadir_pagina(self, numero: int, segundos: float):
+        """Registra los segundos empleados en una página (numerada desde 0)."""
+        self.paginas[numero] = self.paginas.get(numero, 0.0) + segundos
+        if self.al_registrar is not None:
+            self.al_registrar("pagina", numero, segundos)
+
+    def sumar(self, contador: str, cantidad: int = 1):
+        """Suma una cantidad a un contador."""
+        self.contadores[contador] = self.contadores.get(contador, 0) + cantidad
+        if self.al_registrar is not None:
+            self.al_registrar("contador", contador, cantidad)
+
+    def combinar(self, resumen: dict, desplazamiento: int = 0):
+        """
+        Añade las medidas de otro resumen, por ejemplo el de un proceso del modo paralelo.
+
+        Parameters:
+        ----------
+        - resumen (dict): Resumen devuelto por Estadisticas.resumen.
+        - desplazamiento (int): Se suma a los números de página del resumen. 0 por defecto.
+        """
+
+        for etapa, segundos in resumen["etapas"].items():
+            self.anadir_etapa(etapa, segundos)
+        for numero, segundos in resumen["paginas"].items():
+            self.anadir_pagina(numero + desplazamiento, segundos)
+        for contador, cantidad in resumen["contadores"].items():
+            self.sumar(contador, cantidad)
+
+    def resumen(self):
+        """Devuelve las medidas como diccionario, que se puede enviar entre procesos o guardar en JSON."""
+        return {"etapas": dict(self.etapas), "paginas": dict(self.paginas), "contadores": dict(self.contadores)}
+
+
+class _EstadisticasDesactivadas:
+    """Sustituto de Estadisticas que no mide nada, para que el marcado sin estadísticas no tenga coste."""
+
+    _contexto_nulo = nullcontext()
+
+    def medir(self, etapa: str):
+        return self._contexto_nulo
+
+    def anadir_etapa(self, etapa: str, segundos: float):
+        pass
+
+    def anadir_pagina(self, numero: int, segundos: float):
+        pass
+
+    def sumar(self, contador: str, cantidad: int = 1):
+        pass
+
+
+_SIN_ESTADISTICAS = _EstadisticasDesactivadas()
+
+
+def _en_memoria(origen):
+    """Indica si un pdf o una imagen se ha pasado en memoria (bytes, bytearray, memoryview o fichero abierto)."""
+    return isinstance(origen, (bytes, bytearray, memoryview)) or hasattr(origen, "read")
+
+
+def _leer_origen(origen):
+    """Devuelve el contenido de un pdf o una imagen pasado en memoria. Los bytes y bytearray no se copian."""
+    if isinstance(origen, (bytes, bytearray)):
+        return origen
+    if isinstance(origen, memoryview):
+        return origen.tobytes()
+    return origen.read()
+
+
+def _abrir_pdf(origen):
+    """Abre un pdf pasado como ruta o en memoria (ver _en_memoria)."""
+    if _en_memoria(origen):
+        return fitz.open(stream=_leer_origen(origen), filetype="pdf")
+    return fitz.open(origen)
+
+
+def _hay_imagen(ruta_imagen):
+    """Indica si se ha indicado una imagen de marca de agua, como ruta existente o en memoria."""
+    if _en_memoria(ruta_imagen):
+        return hasattr(ruta_imagen, "read") or len(ruta_imagen) > 0
+    return bool(ruta_imagen) and os.path.isfile(ruta_imagen)
+
+
+#Perfiles de guardado del pdf de salida, de más rápido a más pequeño. Cada uno se traduce en las
+#opciones de fitz.Document.save: recolección de objetos sin usar o duplicados (garbage), compresión
+#de flujos (deflate), flujos de objetos (use_objstms) y limpieza de los flujos de contenido (clean).
+PERFILES_GUARDADO = {
+    "rapido": {"garbage": 0, "deflate": False},
+    "equilibrado": {"garbage": 1, "deflate": True},
+    "minimo": {"garbage": 4, "deflate": True, "deflate_images": True, "deflate_fonts": True,
+               "use_objstms": 1, "clean": True},
+}
+
+
+#Páginas mínimas que recibe cada proceso del modo paralelo. Con menos, arrancar los procesos y enviar
+#las páginas convertidas cuesta más de lo que se ahorra, y el pdf se convierte en serie
+MIN_PAGINAS_POR_PROCESO = 100
+
+#Páginas de cada rango que se envía a un proceso en el modo paralelo
+PAGINAS_POR_RANGO_GRIS = 25
+
+#Tamaños de página distintos que guarda como mucho un MarcadorAgua en sus plantillas del mosaico. Al superarse,
+#las plantillas se vuelven a construir solo con los tamaños del documento que se está marcando
+MAX_TAMANOS_PLANTILLAS = 16
+
+
+#Nombre de la capa (Optional Content Group) en la que se añade la marca de agua en el guardado incremental
+CAPA_MARCA_AGUA = "Marca de agua"
+
+
+#Fuentes que se prueban, en orden, para la marca de agua de texto si no se ha configurado otra con
+#configurar_fuente o con la variable de entorno MARCA_AGUA_FUENTE (ruta a un fichero o nombre de la fuente).
+FUENTES_PREDETERMINADAS = ("arial.ttf", "Arial.ttf", "DejaVuSans.ttf", "LiberationSans-Regular.ttf", "FreeSans.ttf")
+
+#Fuente indicada con configurar_fuente. Tiene prioridad sobre la variable de entorno
+_fuente_configurada = [None]
+
+
+def configurar_fuente(fuente: str = None):
+    """
+    Función que cambia la fuente de las marcas de agua de texto.
+
+    Parameters:
+    ----------
+    - fuente (str): Ruta a un fichero de fuente o nombre de la fuente (por ejemplo "DejaVuSans").
+      Con None se vuelve a la variable de entorno MARCA_AGUA_FUENTE o a las fuentes predeterminadas.
+    """
+
+    _fuente_configurada[0] = fuente
+    _resolver_fuente.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def _resolver_fuente():
+    """
+    Función que busca una sola vez el fichero de la fuente de las marcas de agua de texto. PIL
+    recorre los directorios de fuentes del sistema en cada búsqueda fallida, por eso el resultado
+    se guarda y el resto de funciones cargan la fuente directamente desde su ruta.
+
+    Returns:
+    --------
+    - ruta (str): Ruta del fichero de la fuente, o None si no se encuentra ninguna.
+    """
+
+    candidatas = [fuente for fuente in (_fuente_configurada[0], os.environ.get("MARCA_AGUA_FUENTE")) if fuente]
+    for fuente in candidatas + list(FUENTES_PREDETERMINADAS):
+        try:
+            return os.path.abspath(ImageFont.truetype(fuente, 10).path)
+        except OSError:
+            continue
+    return None
+
+
+@lru_cache(maxsize=64)
+def _cargar_fuente(ruta_fuente: str, tamano: int):
+    """
+    Función que devuelve la fuente de PIL para una ruta y un tamaño. Si no hay fichero de fuente se
+    usa la fuente predeterminada de PIL respetando el tamaño (Pillow 10.1 o superior).
+    """
+
+    if ruta_fuente:
+        return ImageFont.truetype(ruta_fuente, tamano)
+    try:
+        return ImageFont.load_default(size=tamano)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=1024)
+def _medir_texto(ruta_fuente: str, tamano: int, texto: str):
+    """Función que devuelve el ancho y el alto del texto escrito con la fuente y el tamaño indicados."""
+    return ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox((0, 0), texto, font=_cargar_fuente(ruta_fuente, tamano))[2:4]
+
+
 def _crear_marca_agua(texto:str,
                     tamano_fuente_texto:int,
                     opacidad:int = 100,
@@ -45,17 +270,15 @@ def _crear_marca_agua(texto:str,
     - recuadro (PIL.Image): recuadro de la marca de agua con el texto centrado y rotado.
     """
 
-    #Se intenta cargar la fuente 'arial.ttf', si falla, usa la fuente predeterminada de PIL
-    try:
-        fuente = ImageFont.truetype("arial.ttf", tamano_fuente_texto)
-    except IOError:
-        fuente = ImageFont.load_default()
+    #La fuente se resuelve una sola vez y se reutiliza para cada tamaño
+    ruta_fuente = _resolver_fuente()
+    fuente = _cargar_fuente(ruta_fuente, tamano_fuente_texto)
 
     #Aplicamos mayúsculas o minúsculas según el parámetro
     texto = texto.upper() if mayusculas else texto.lower()
 
     #Obtenemos las dimensiones del texto
-    ancho_texto, alto_texto = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox((0, 0), texto, font=fuente)[2:4]
+    ancho_texto, alto_texto = _medir_texto(ruta_fuente, tamano_fuente_texto, texto)
 
     #Calculamos el margen automáticamente según el tamaño de la fuente
     margen_x = tamano_fuente_texto // 2  #Margen horizontal basado en el tamaño de la fuente
@@ -82,13 +305,34 @@ def _crear_marca_agua(texto:str,
     return recuadro
 
 
+@lru_cache(maxsize=256)
+def _tabla_opacidad(opacidad: int):
+    """
+    Función que devuelve la tabla de consulta que escala un canal alfa (0-255) según la opacidad (0-255).
+    Se calcula una sola vez por opacidad y PIL la aplica en C, sin llamar a Python por cada valor.
+
+    Parameters:
+    ----------
+    - opacidad (int): Opacidad entre 0 y 255, donde 255 deja el canal alfa como está.
+
+    Returns:
+    --------
+    - tabla (tuple[int, ...]): 256 valores de alfa resultantes.
+    """
+
+    opacidad = min(255, max(0, opacidad))
+    return tuple((valor * opacidad + 127) // 255 for valor in range(256))
+
+
 def _crear_marca_agua_imagen(ruta_imagen: str = None, tamano: int = 20, opacidad: int = 100):
     """
     Función que crea una marca de agua a partir de una imagen, permitiendo ajustar su tamaño y opacidad.
+    Las imágenes grandes se reducen primero de forma aproximada y barata (al decodificar en los JPEG
+    y con Image.reduce en el resto) y después con LANCZOS hasta el tamaño exacto.
 
     Parameters:
     ----------
-    - ruta_imagen (str): Ruta de la imagen que se usará como marca de agua.
+    - ruta_imagen (str | file): Ruta de la imagen que se usará como marca de agua, o fichero abierto.
     - tamano (int): Tamaño de la imagen en porcentaje respecto al original (recomendado entre 16 y 100).
     - opacidad (int): Opacidad de la imagen (recomendado entre 0 y 255, donde 255 es completamente opaco).
 
@@ -97,19 +341,26 @@ def _crear_marca_agua_imagen(ruta_imagen: str = None, tamano: int = 20, opacidad
     - imagen (PIL.Image): Imagen de la marca de agua ajustada.
     """
 
-    #Cargamos la imagen aseguramos el canal alfa
-    imagen = Image.open(ruta_imagen).convert("RGBA")
-    
-    #Ajustamos el tamaño de la imagen en función del porcentaje especificado
+    #Abrimos la imagen sin decodificarla todavía
+    imagen = Image.open(ruta_imagen)
+
+    #Calculamos el tamaño final en función del porcentaje especificado
     ancho_original, alto_original = imagen.size
-    nuevo_ancho = int(ancho_original * (tamano / 100))
-    nuevo_alto = int(alto_original * (tamano / 100))
-    imagen = imagen.resize((nuevo_ancho, nuevo_alto), Image.Resampling.LANCZOS)
+    nuevo_ancho = max(1, int(ancho_original * (tamano / 100)))
+    nuevo_alto = max(1, int(alto_original * (tamano / 100)))
+
+    #En los JPEG se pide al decodificador una versión reducida (1/2, 1/4 o 1/8) que siga siendo mayor que el tamaño final
+    if imagen.format == "JPEG":
+        imagen.draft("RGB", (nuevo_ancho, nuevo_alto))
+
+    #Cargamos la imagen asegurando el canal alfa y la llevamos al tamaño final. reducing_gap hace una
+    #primera reducción entera con Image.reduce y deja a LANCZOS solo el último tramo
+    imagen = imagen.convert("RGBA")
+    if imagen.size != (nuevo_ancho, nuevo_alto):
+        imagen = imagen.resize((nuevo_ancho, nuevo_alto), Image.Resampling.LANCZOS, reducing_gap=3.0)
 
-    #Aplicamos la opacidad modificando el canal alfa
-    r, g, b, a = imagen.split()
-    a = a.point(lambda p: p * (opacidad / 100))  # Ajustar la opacidad en base al porcentaje
-    imagen = Image.merge("RGBA", (r, g, b, a))
+    #Aplicamos la opacidad al canal alfa con una tabla de consulta
+    imagen.putalpha(imagen.getchannel("A").point(_tabla_opacidad(opacidad)))
 
     #Rotamos la imagen 45° y expandimos para evitar recortes
     imagen = imagen.rotate(45, expand=True)
@@ -117,6 +368,508 @@ def _crear_marca_agua_imagen(ruta_imagen: str = None, tamano: int = 20, opacidad
     return imagen
 
 
+def _crear_marca_agua_vectorial(texto:str,
+                                tamano_fuente_texto:int,
+                                opacidad:int = 100,
+                                mayusculas: bool = False,
+                                color: tuple[int, int, int] = (255, 0, 0)):
+    """
+    Función que crea la marca de agua de texto como un pdf de una sola página con el texto vectorial
+    rotado 45°. Es el equivalente vectorial de _crear_marca_agua: usa los mismos márgenes, de modo que
+    el recuadro tiene aproximadamente el mismo tamaño, pero el texto no se rasteriza y se mantiene
+    nítido a cualquier nivel de zoom.
+
+    Parameters:
+    ----------
+    - texto (str): Texto de la marca de agua.
+    - tamano_fuente_texto (int): Tamaño de la fuente (recomentado ente 16 y 40).
+    - opacidad (int): Opacidad del texto entre 0 y 255 (recomendado en 100).
+    - mayusculas (bool): Poner el texto en minúsculas con False o mayúsculas con True. False por defecto.
+    - color (tuple[int,int,int]): tupla que indica el color en tres dígitos. Rojo por defecto.
+
+    Returns:
+    --------
+    - sello (fitz.Document): documento de una página con la marca de agua centrada y rotada.
+    """
+
+    #Aplicamos mayúsculas o minúsculas según el parámetro
+    texto = texto.upper() if mayusculas else texto.lower()
+
+    #Obtenemos las dimensiones del texto con la fuente Helvetica integrada en los lectores de pdf
+    ancho_texto = fitz.get_text_length(texto, fontname="helv", fontsize=tamano_fuente_texto)
+    alto_texto = tamano_fuente_texto
+
+    #Calculamos el recuadro sin rotar con los mismos márgenes que la marca de agua rasterizada
+    ancho = ancho_texto + 2 * (tamano_fuente_texto // 2)
+    alto = alto_texto + 2 * (tamano_fuente_texto // 3)
+
+    #El recuadro rotado 45° ocupa (ancho + alto) * cos(45°) en ambas direcciones
+    lado = int((ancho + alto) * 0.7072) + 1
+    sello = fitz.open()
+    pagina = sello.new_page(width=lado, height=lado)
+    centro = fitz.Point(lado / 2, lado / 2)
+
+    #Dibujamos el texto centrado y lo rotamos 45° alrededor del centro del recuadro
+    pagina.insert_text(
+        (centro.x - ancho_texto / 2, centro.y + alto_texto * 0.35),
+        texto,
+        fontname="helv",
+        fontsize=tamano_fuente_texto,
+        color=tuple(canal / 255 for canal in color),
+        fill_opacity=opacidad / 255,
+        morph=(centro, fitz.Matrix(45)))
+
+    #Se reabre desde memoria para que show_pdf_page trabaje sobre un documento ya cerrado
+    return fitz.open("pdf", sello.tobytes())
+
+
+
+class CacheMarcasAgua:
+    """
+    Caché LRU de marcas de agua ya construidas, limitada por número de entradas y por bytes.
+    Cada entrada guarda la imagen PIL de la marca de agua y su codificación en PNG, de modo que
+    los trabajos repetidos y las vistas previas no vuelven a cargar la fuente, dibujar, rotar ni codificar.
+
+    Parameters:
+    ----------
+    - max_entradas (int): Número máximo de marcas de agua guardadas.
+    - max_bytes (int): Tamaño máximo aproximado de la caché en bytes (píxeles RGBA más PNG).
+    """
+
+    def __init__(self, max_entradas: int = 32, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.aciertos = 0
+        self.fallos = 0
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._candado = threading.Lock()
+
+    @staticmethod
+    def _tamano_entrada(imagen, bytes_png: bytes):
+        """Devuelve los bytes aproximados que ocupa una entrada."""
+        return imagen.width * imagen.height * len(imagen.getbands()) + len(bytes_png)
+
+    def obtener(self, clave: tuple):
+        """
+        Devuelve la entrada de la clave indicada y la marca como usada recientemente.
+
+        Returns:
+        --------
+        - entrada (tuple[PIL.Image, bytes] | None): Imagen y PNG de la marca de agua, None si no está.
+        """
+        with self._candado:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada
+
+    def guardar(self, clave: tuple, imagen, bytes_png: bytes):
+        """Guarda una entrada y descarta las menos usadas hasta volver a los límites."""
+        tamano = self._tamano_entrada(imagen, bytes_png)
+        if tamano > self.max_bytes:
+            return
+        with self._candado:
+            if clave in self._entradas:
+                self._bytes -= self._tamano_entrada(*self._entradas.pop(clave))
+            self._entradas[clave] = (imagen, bytes_png)
+            self._bytes += tamano
+            while len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes:
+                _, descartada = self._entradas.popitem(last=False)
+                self._bytes -= self._tamano_entrada(*descartada)
+
+    def limpiar(self):
+        """Vacía la caché y reinicia los contadores."""
+        with self._candado:
+            self._entradas.clear()
+            self._bytes = 0
+            self.aciertos = 0
+            self.fallos = 0
+
+    def estadisticas(self):
+        """
+        Devuelve el estado de la caché.
+
+        Returns:
+        --------
+        - estadisticas (dict): Aciertos, fallos, entradas y bytes ocupados.
+        """
+        with self._candado:
+            return {"aciertos": self.aciertos, "fallos": self.fallos,
+                    "entradas": len(self._entradas), "bytes": self._bytes}
+
+
+#Caché compartida por vista_previa_pdf y anadir_marca_agua_a_pdf
+cache_marcas_agua = CacheMarcasAgua()
+
+
+def _obtener_marca_agua(texto:str,
+                        tamano_fuente:int,
+                        opacidad:int,
+                        mayusculas:bool = False,
+                        color:tuple[int, int, int] = (255, 0, 0),
+                        ruta_imagen:str = None,
+                        estadisticas = _SIN_ESTADISTICAS):
+    """
+    Función que devuelve la marca de agua rasterizada (de texto o de imagen) pasando por la caché.
+    Las marcas de agua de imagen se identifican por su ruta y su fecha de modificación, de modo que
+    si el fichero cambia se vuelve a construir. Las de texto incluyen la fuente en uso.
+
+    Parameters:
+    ----------
+    - texto (str): Texto de la marca de agua.
+    - tamano_fuente (int): Tamaño de la fuente, o porcentaje de la imagen.
+    - opacidad (int): Opacidad de la marca de agua.
+    - mayusculas (bool): Poner el texto en minúsculas con False o mayúsculas con True. False por defecto.
+    - color (tuple[int,int,int]): tupla que indica el color en tres dígitos. Rojo por defecto.
+    - ruta_imagen (str | bytes | file): Ruta de la imagen o su contenido en memoria. Si existe, se usa la
+      imagen en lugar del texto. Las imágenes en memoria se identifican por el hash de su contenido.
+    - estadisticas (Estadisticas): Donde se registran los tiempos de construcción y codificación.
+
+    Returns:
+    --------
+    - imagen (PIL.Image): Marca de agua. Es compartida por la caché, no debe modificarse.
+    - bytes_png (bytes): Marca de agua codificada en PNG.
+    """
+
+    if _en_memoria(ruta_imagen) and _hay_imagen(ruta_imagen):
+        contenido = _leer_origen(ruta_imagen)
+        ruta_imagen = io.BytesIO(contenido)
+        clave = ("imagen", hashlib.sha256(contenido).hexdigest(), tamano_fuente, opacidad)
+    elif _hay_imagen(ruta_imagen):
+        clave = ("imagen", os.path.abspath(ruta_imagen), os.path.getmtime(ruta_imagen), tamano_fuente, opacidad)
+    else:
+        clave = ("texto", texto, tamano_fuente, opacidad, mayusculas, tuple(color), _resolver_fuente())
+
+    entrada = cache_marcas_agua.obtener(clave)
+    if entrada is not None:
+        estadisticas.sumar("aciertos_cache")
+        return entrada
+
+    with estadisticas.medir("marca_agua"):
+        if clave[0] == "imagen":
+            imagen = _crear_marca_agua_imagen(ruta_imagen, tamano_fuente, opacidad)
+        else:
+            imagen = _crear_marca_agua(texto, tamano_fuente, opacidad, mayusculas, color)
+    #Guarda la imagen en un buffer como PNG
+    with estadisticas.medir("png"):
+        bytes_imagen = io.BytesIO()
+        imagen.save(bytes_imagen, format="PNG")
+        bytes_png = bytes_imagen.getvalue()
+
+    cache_marcas_agua.guardar(clave, imagen, bytes_png)
+    return imagen, bytes_png
+
+
+@lru_cache(maxsize=256)
+def _disposicion_mosaico(ancho_pagina:float,
+                         alto_pagina:float,
+                         ancho_imagen:int,
+                         alto_imagen:int,
+                         espaciado_ancho:int,
+                         espaciado_alto:int):
+    """
+    Función que calcula las teselas del mosaico que se ven en una página del tamaño indicado, tal como
+    se muestra (ya girada y recortada por su cropbox). Solo se devuelven las teselas que empiezan dentro
+    de la página, las que quedarían fuera no se colocan. El resultado se guarda en caché por geometría,
+    y lo comparten el pdf de salida y la vista previa para que ambos coincidan.
+
+    Parameters:
+    ----------
+    - ancho_pagina (float): Ancho visible de la página en puntos, redondeado a dos decimales.
+    - alto_pagina (float): Alto visible de la página en puntos, redondeado a dos decimales.
+    - ancho_imagen (int): Ancho de la marca de agua.
+    - alto_imagen (int): Alto de la marca de agua.
+    - espaciado_ancho (int): Separación horizontal entre teselas.
+    - espaciado_alto (int): Separación vertical entre teselas.
+
+    Returns:
+    --------
+    - teselas (tuple[tuple[int, int, int, int]]): Rectángulos (x0, y0, x1, y1) de cada tesela, por columnas.
+    """
+
+    return tuple((x, y, x + ancho_imagen, y + alto_imagen)
+                 for x in range(0, math.ceil(ancho_pagina), ancho_imagen + espaciado_ancho)
+                 for y in range(0, math.ceil(alto_pagina), alto_imagen + espaciado_alto))
+
+
+def _matriz_insercion(pagina):
+    """
+    Función que devuelve la matriz que lleva un rectángulo de la página tal como se ve (con su giro y su
+    cropbox) a las coordenadas sin girar en las que PyMuPDF inserta el contenido.
+    """
+
+    matriz = pagina.derotation_matrix
+    if pagina.rotation % 360:
+        #En las páginas giradas PyMuPDF no descuenta el desplazamiento de la cropbox al insertar
+        matriz = matriz * fitz.Matrix(1, 0, 0, 1, pagina.cropbox.x0, pagina.cropbox.y1 - pagina.mediabox.y1)
+    return matriz
+
+
+def _colocar_mosaico(pagina,
+                     pix,
+                     xref:int,
+                     ancho_imagen:int,
+                     alto_imagen:int,
+                     espaciado_ancho:int,
+                     espaciado_alto:int,
+                     reutilizar_imagen:bool = True):
+    """
+    Función que coloca la marca de agua en mosaico sobre la parte visible de la página indicada, con las
+    teselas derechas aunque la página esté girada.
+
+    Parameters:
+    ----------
+    - pagina (fitz.Page): Página donde se colocará el mosaico.
+    - pix (fitz.Pixmap | fitz.Document): Imagen de la marca de agua, o documento de una página si es vectorial.
+    - xref (int): Referencia de la imagen si ya está insertada en el documento de la página, 0 si no lo está.
+    - ancho_imagen (int): Ancho de la marca de agua.
+    - alto_imagen (int): Alto de la marca de agua.
+    - espaciado_ancho (int): Separación horizontal entre teselas.
+    - espaciado_alto (int): Separación vertical entre teselas.
+    - reutilizar_imagen (bool): True reutiliza la imagen ya insertada a través de su xref. True por defecto.
+
+    Returns:
+    --------
+    - xref (int): Referencia de la imagen de la marca de agua en el documento de la página.
+    """
+
+    #Las teselas se calculan sobre la página tal como se ve y se llevan a las coordenadas de inserción,
+    #girando cada una con la página para que la marca de agua se lea derecha
+    matriz = _matriz_insercion(pagina)
+    giro = pagina.rotation
+    teselas = _disposicion_mosaico(round(pagina.rect.width, 2), round(pagina.rect.height, 2), ancho_imagen,
+                                   alto_imagen, espaciado_ancho, espaciado_alto)
+    for tesela in teselas:
+        rect = fitz.Rect(tesela) * matriz
+        #Inserta la imagen en la página. La primera vez se incrusta el pixmap y las siguientes
+        #teselas reutilizan el mismo objeto de imagen del documento a través de su xref
+        if isinstance(pix, fitz.Document):
+            #La marca vectorial se estampa como Form XObject, que PyMuPDF ya reutiliza entre colocaciones
+            xref = pagina.show_pdf_page(rect, pix, 0, overlay=True, rotate=giro)
+        elif reutilizar_imagen and xref:
+            pagina.insert_image(rect, xref=xref, overlay=True, rotate=giro)
+        else:
+            xref = pagina.insert_image(rect, pixmap=pix, overlay=True, rotate=giro)
+
+    return xref
+
+
+@lru_cache(maxsize=16)
+def _renderizar_pagina_base(ruta_entrada_pdf: str,
+                            fecha_modificacion: float,
+                            numero_pagina: int = 0,
+                            blanco_y_negro: bool = False,
+                            tamano_maximo: tuple[int, int] = None):
+    """
+    Función que renderiza una página del pdf, sin marca de agua, a la resolución de la vista previa.
+    El resultado se guarda en caché por ruta, fecha de modificación, página, escala de grises y tamaño,
+    de modo que al cambiar solo la marca de agua no se vuelve a abrir ni a renderizar el pdf.
+
+    Parameters:
+    ----------
+    - ruta_entrada_pdf (str | bytes): Ruta del pdf, o su contenido si se llama sin caché (__wrapped__).
+    - fecha_modificacion (float): Fecha de modificación del pdf. Solo se usa como parte de la clave de la caché.
+    - numero_pagina (int): Página a renderizar. 0 por defecto.
+    - blanco_y_negro (bool): True convierte la página a escala de grises. False por defecto.
+    - tamano_maximo (tuple[int,int]): Ancho y alto máximos en píxeles. None renderiza a 72 ppp.
+
+    Returns:
+    --------
+    - imagen (PIL.Image): Página renderizada en RGB. Es compartida por la caché, no debe modificarse.
+    - escala (float): Píxeles de la imagen por cada punto de la página.
+    """
+
+    with _abrir_pdf(ruta_entrada_pdf) as documento:
+        pagina = documento[numero_pagina]
+        escala = 1.0
+        if tamano_maximo:
+            escala = min(tamano_maximo[0] / pagina.rect.width, tamano_maximo[1] / pagina.rect.height)
+
+        #Renderizamos la página directamente a la escala de la vista previa, en gris si hace falta
+        espacio_color = fitz.csGRAY if blanco_y_negro else fitz.csRGB
+        pix = pagina.get_pixmap(matrix=fitz.Matrix(escala, escala), colorspace=espacio_color)
+        imagen = Image.frombytes("L" if blanco_y_negro else "RGB", [pix.width, pix.height], pix.samples)
+
+    return imagen.convert("RGB"), escala
+
+
+#Capas con el mosaico de la vista previa ya compuesto, por marca de agua, tamaño, escala y espaciado (ver _capa_mosaico).
+#Una entrada sin capa indica que esa combinación ya se ha pedido una vez
+MAX_CAPAS_VISTA_PREVIA = 8
+_capas_vista_previa = OrderedDict()
+_candado_capas_vista_previa = threading.Lock()
+
+
+def _teselas_vista_previa(marca_agua,
+                          tamano:tuple[int, int],
+                          escala:float,
+                          espaciado_ancho:int = 10,
+                          espaciado_alto:int = 1):
+    """
+    Función que devuelve la tesela a la escala de la vista previa y las posiciones en píxeles de las
+    teselas del mosaico, las mismas que en el pdf de salida.
+
+    Parameters:
+    ----------
+    - marca_agua (PIL.Image): Marca de agua en RGBA a 72 ppp, tal como la devuelve _obtener_marca_agua.
+    - tamano (tuple[int,int]): Ancho y alto en píxeles de la vista previa.
+    - escala (float): Píxeles de la vista previa por cada punto de la página.
+    - espaciado_ancho (int): Separación horizontal entre teselas, en puntos.
+    - espaciado_alto (int): Separación vertical entre teselas, en puntos.
+
+    Returns:
+    --------
+    - tesela (PIL.Image): Marca de agua escalada.
+    - posiciones (list[tuple[int,int]]): Esquina superior izquierda de cada tesela.
+    """
+
+    #Las teselas se calculan en puntos sobre la página tal como se ve y se llevan a píxeles de la vista previa
+    teselas = _disposicion_mosaico(round(tamano[0] / escala, 2), round(tamano[1] / escala, 2),
+                                   marca_agua.width, marca_agua.height, espaciado_ancho, espaciado_alto)
+    tesela = marca_agua
+    if escala != 1.0:
+        tesela = marca_agua.resize((max(1, round(marca_agua.width * escala)), max(1, round(marca_agua.height * escala))),
+                                   Image.Resampling.BILINEAR)
+    return tesela, [(round(x * escala), round(y * escala)) for x, y, _, _ in teselas]
+
+
+def _capa_mosaico(marca_agua,
+                  tamano:tuple[int, int],
+                  escala:float,
+                  espaciado_ancho:int = 10,
+                  espaciado_alto:int = 1):
+    """
+    Función que devuelve una capa RGBA transparente del tamaño de la vista previa con todo el mosaico ya
+    compuesto. Se compone una columna de teselas y se repite en cada columna, así se hacen filas + columnas
+    composiciones en lugar de filas × columnas. La capa se guarda en caché, de modo que al cambiar de página
+    (del mismo tamaño) o al pasar a gris solo queda componerla una vez sobre la página.
+    Construirla cuesta más que componer las teselas directamente sobre la página, por eso la primera vez que
+    se pide una combinación de marca de agua, tamaño y escala solo se anota y se devuelve None, y la capa se
+    construye la segunda vez, cuando ya es probable que se vuelva a usar.
+
+    Parameters:
+    ----------
+    - marca_agua (PIL.Image): Marca de agua en RGBA a 72 ppp, tal como la devuelve _obtener_marca_agua.
+    - tamano (tuple[int,int]): Ancho y alto en píxeles de la vista previa.
+    - escala (float): Píxeles de la vista previa por cada punto de la página.
+    - espaciado_ancho (int): Separación horizontal entre teselas, en puntos.
+    - espaciado_alto (int): Separación vertical entre teselas, en puntos.
+
+    Returns:
+    --------
+    - capa (PIL.Image): Capa RGBA con el mosaico, o None la primera vez. Es compartida por la caché, no debe
+      modificarse.
+    """
+
+    #La marca de agua se mantiene viva en la propia entrada, así su id no se puede repetir mientras esté en caché
+    clave = (id(marca_agua), tamano, round(escala, 6), espaciado_ancho, espaciado_alto)
+    with _candado_capas_vista_previa:
+        entrada = _capas_vista_previa.get(clave)
+        if entrada is None or entrada[0] is not marca_agua:
+            _capas_vista_previa[clave] = (marca_agua, None)
+            while len(_capas_vista_previa) > MAX_CAPAS_VISTA_PREVIA:
+                _capas_vista_previa.popitem(last=False)
+            return None
+        _capas_vista_previa.move_to_end(clave)
+        if entrada[1] is not None:
+            return entrada[1]
+
+    tesela, posiciones = _teselas_vista_previa(marca_agua, tamano, escala, espaciado_ancho, espaciado_alto)
+    capa = Image.new("RGBA", tamano, (0, 0, 0, 0))
+    if posiciones:
+        #Todas las columnas tienen las mismas filas, por eso basta con componer una columna
+        columna = Image.new("RGBA", (tesela.width, tamano[1]), (0, 0, 0, 0))
+        for y in sorted({y for _, y in posiciones}):
+            columna.alpha_composite(tesela, (0, y))
+        for x in sorted({x for x, _ in posiciones}):
+            capa.alpha_composite(columna, (x, 0))
+
+    with _candado_capas_vista_previa:
+        _capas_vista_previa[clave] = (marca_agua, capa)
+        while len(_capas_vista_previa) > MAX_CAPAS_VISTA_PREVIA:
+            _capas_vista_previa.popitem(last=False)
+    return capa
+
+
+def vista_previa_pdf_imagen(
+        ruta_entrada_pdf: str,
+        texto_marca_agua: str,
+        tamano_fuente: int,
+        opacidad_texto: int,
+        texto_mayusculas: bool = False,
+        color_texto: tuple[int, int, int] = (255, 0, 0),
+        blanco_y_negro: bool = False,
+        ruta_imagen: str = None,
+        tamano_maximo: tuple[int, int] = None,
+        numero_pagina: int = 0,
+        usar_cache: bool = True,
+        espaciado_ancho: int = 10,
+        espaciado_alto: int = 1):
+
+    """
+    Función que genera la vista previa de una página del pdf con la marca de agua y la devuelve como
+    imagen PIL en memoria, lista para mostrarse sin pasar por JPEG.
+    La página se renderiza una sola vez a la resolución de la vista previa (ver _renderizar_pagina_base)
+    y la marca de agua se compone de una vez con una capa del mosaico ya preparada (ver _capa_mosaico), o
+    tesela a tesela la primera vez que se pide esa marca de agua a ese tamaño.
+
+    Parameters:
+    ----------
+    - ruta_entrada_pdf (str | bytes | file): Ruta del pdf a marcar, o su contenido en memoria.
+    - texto_marca_agua (str): Texto saldrá en la marca de agua.
+    - tamano_fuente (int): Tamaño de la fuente (recomentado ente 16 y 40).
+    - opacidad_texto (int): Opacidad del texto (recomendado en 100).
+    - texto_mayusculas (bool): Poner el texto en minúsculas con False o mayúsculas con True. False por defecto.
+    - color_texto (tuple[int,int,int]): tupla que indica el color en tres dígitos. Rojo por defecto.
+    - blanco_y_negro (bool): True convierte el pdf a blanco y negro, False lo deja como está. False por defecto.
+    - ruta_imagen (str | bytes | file): Ruta de la imagen o su contenido en memoria. Si hay una imagen, se pondrá
+      la marca de agua con la imagen y no con el texto.
+    - tamano_maximo (tuple[int,int]): Ancho y alto máximos de la vista previa. None la genera a 72 ppp.
+    - numero_pagina (int): Página del pdf a mostrar. 0 por defecto.
+    - usar_cache (bool): False no usa ni llena las cachés de páginas y capas de la vista previa, para imágenes
+      que quien llama guarda por su cuenta (como las miniaturas de la interfaz) y que no deben expulsar de
+      ellas la página de la vista previa principal. True por defecto.
+    - espaciado_ancho (int): Separación horizontal entre teselas, la misma que se usará al marcar el pdf.
+    - espaciado_alto (int): Separación vertical entre teselas, la misma que se usará al marcar el pdf.
+
+    Returns:
+    --------
+    - imagen (PIL.Image): Vista previa en RGB.
+    """
+
+    #Página sin marca de agua, ya renderizada si no ha cambiado desde la última vista previa. Los pdfs en
+    #memoria no pasan por la caché, que los mantendría vivos
+    if _en_memoria(ruta_entrada_pdf):
+        base, escala = _renderizar_pagina_base.__wrapped__(_leer_origen(ruta_entrada_pdf), 0, numero_pagina,
+                                                           blanco_y_negro, tamano_maximo)
+    elif not usar_cache:
+        base, escala = _renderizar_pagina_base.__wrapped__(ruta_entrada_pdf, 0, numero_pagina, blanco_y_negro,
+                                                           tamano_maximo)
+    else:
+        base, escala = _renderizar_pagina_base(ruta_entrada_pdf, os.path.getmtime(ruta_entrada_pdf), numero_pagina,
+                                               blanco_y_negro, tamano_maximo)
+
+    #Si hay una imagen, la marca de agua es la imagen, si no, es el texto (ya construida si está en caché)
+    marca_agua, _ = _obtener_marca_agua(texto_marca_agua, tamano_fuente, opacidad_texto, texto_mayusculas,
+                                        color_texto, ruta_imagen)
+
+    #Aplicamos todo el mosaico sobre la página con una sola composición
+    capa = _capa_mosaico(marca_agua, base.size, escala, espaciado_ancho, espaciado_alto) if usar_cache else None
+    if capa is not None:
+        return Image.alpha_composite(base.convert("RGBA"), capa).convert("RGB")
+
+    #Primera vez con esta marca de agua y tamaño (o sin caché): se pegan las teselas directamente, sin construir la capa.
+    #Sin caché la página es propia y se puede modificar
+    imagen = base.copy() if usar_cache else base
+    tesela, posiciones = _teselas_vista_previa(marca_agua, base.size, escala, espaciado_ancho, espaciado_alto)
+    for posicion in posiciones:
+        imagen.paste(tesela, posicion, tesela)
+    return imagen
+
 
 def vista_previa_pdf(
         ruta_entrada_pdf: str,
@@ -126,67 +879,1092 @@ def vista_previa_pdf(
         texto_mayusculas: bool = False,
         color_texto: tuple[int, int, int] = (255, 0, 0),
         blanco_y_negro: bool = False,
-        ruta_imagen: str = None):
+        ruta_imagen: str = None,
+        espaciado_ancho: int = 10,
+        espaciado_alto: int = 1):
     
     """
     Función que genera una vista previa del pdf. Hace una captura de la primera página y añade la marca
     de agua, para luego ser enviada a la interfaz gráfica.
     Si hay una ruta de una imagen en su respectiva variable, se devolverá una marca de agua con dicha imagen,
     en caso contrario, se devolverá una marca de agua con un texto.
+    Para mostrarla directamente en pantalla es preferible vista_previa_pdf_imagen, que no pasa por JPEG.
 
     Parameters:
     ----------
-    - ruta_entrada_pdf (str): Ruta del pdf a marcar.
+    - ruta_entrada_pdf (str | bytes | file): Ruta del pdf a marcar, o su contenido en memoria.
     - texto_marca_agua (str): Texto saldrá en la marca de agua.
-    - ruta_imagen (str): Ruta de la imagen de la marca de agua.
     - tamano_fuente (int): Tamaño de la fuente (recomentado ente 16 y 40).
     - opacidad_texto (int): Opacidad del texto (recomendado en 100).
     - texto_mayusculas (bool): Poner el texto en minúsculas con False o mayúsculas con True. False por defecto.
     - color_texto (tuple[int,int,int]): tupla que indica el color en tres dígitos. Rojo por defecto.
     - blanco_y_negro (bool): True convierte el pdf a blanco y negro, False lo deja como está. False por defecto.
-    - ruta_imagen (str): Ruta de la imagen. Si hay una ruta, se pondrá la marca de agua con la imagen y no con el texto.
+    - ruta_imagen (str | bytes | file): Ruta de la imagen o su contenido en memoria. Si hay una imagen, se pondrá
+      la marca de agua con la imagen y no con el texto.
+    - espaciado_ancho (int): Separación horizontal entre teselas, la misma que se usará al marcar el pdf.
+    - espaciado_alto (int): Separación vertical entre teselas, la misma que se usará al marcar el pdf.
 
     Returns:
     --------
     - buffer_imagen (BytesIO): Imagen guardada en memoria.
     """
-    
-    #Seleccionamos la primera página del pdf
-    documento = fitz.open(ruta_entrada_pdf)
-    pagina = documento[0]
-
-    #Convertimos la primera página a imagen a una imagen
-    pix = pagina.get_pixmap()
-    imagen = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-    #Convertimos la imagen a blanco y negro si está la correspondiente opción activada
-    if blanco_y_negro:
-        #Convertimos solo la imagen del PDF a escala de grises antes de aplicar la marca de agua
-        imagen = imagen.convert("L").convert("RGB")  #"L" convierte a gris, luego "RGB" para mantener el formato
-
-    #Si hay una marca de agua, la añadimos, si no, añadimos texto
-    if not os.path.isfile(ruta_imagen): 
-        #Creamos la marca de agua de texto en color
-        marca_agua = _crear_marca_agua(texto_marca_agua, tamano_fuente, opacidad_texto, texto_mayusculas, color_texto)
-    else:
-        #Creamos la marca de agua con imagen si hay imagen
-        marca_agua = _crear_marca_agua_imagen(ruta_imagen, tamano_fuente, opacidad_texto)
 
-    #Aplicamos la marca de agua en la imagen
-    for x in range(0, imagen.width, marca_agua.width + 10):
-        for y in range(0, imagen.height, marca_agua.height + 1):
-            imagen.paste(marca_agua, (x, y), marca_agua)
+    imagen = vista_previa_pdf_imagen(ruta_entrada_pdf, texto_marca_agua, tamano_fuente, opacidad_texto,
+                                     texto_mayusculas, color_texto, blanco_y_negro, ruta_imagen,
+                                     espaciado_ancho=espaciado_ancho, espaciado_alto=espaciado_alto)
 
     #Guardamos la imagen final en un buffer
     buffer_imagen = io.BytesIO()
     imagen.save(buffer_imagen, format="JPEG", quality=50)
     buffer_imagen.seek(0)
-
-    #cerramos el documento y retornamos la imagen guardada en memoria
-    documento.close()
     return buffer_imagen
 
 
+#Caracteres que delimitan los tokens de un flujo de contenido pdf
+_DELIMITADORES_PDF = b"()<>[]{}/%"
+_ESPACIOS_PDF = b" \t\r\n\f\x00"
+
+
+def _tokens_contenido(contenido:bytes):
+    """
+    Función que divide un flujo de contenido pdf en tokens. Tiene en cuenta cadenas con paréntesis anidados,
+    cadenas hexadecimales, comentarios e imágenes en línea (BI ... ID ... EI), cuyos datos binarios se saltan.
+
+    Parameters:
+    ----------
+    - contenido (bytes): Flujo de contenido ya descomprimido.
+
+    Returns:
+    --------
+    - tokens (generator[tuple[int, int, bytes]]): Posición de inicio, de fin y el token.
+    """
+
+    i, n = 0, len(contenido)
+    while i < n:
+        c = contenido[i]
+        if c in _ESPACIOS_PDF:
+            i += 1
+        elif c == 0x25:  #"%" comentario hasta fin de línea
+            while i < n and contenido[i] not in b"\r\n":
+                i += 1
+        elif c == 0x28:  #"(" cadena literal, con paréntesis anidados y escapes
+            inicio, profundidad = i, 0
+            while i < n:
+                if contenido[i] == 0x5C:
+                    i += 2
+                    continue
+                if contenido[i] == 0x28:
+                    profundidad += 1
+                elif contenido[i] == 0x29:
+                    profundidad -= 1
+                    if profundidad == 0:
+                        break
+                i += 1
+            i += 1
+            yield inicio, i, contenido[inicio:i]
+        elif c == 0x3C and contenido[i:i + 2] != b"<<":  #"<" cadena hexadecimal
+            fin = contenido.find(b">", i)
+            fin = n if fin < 0 else fin + 1
+            yield i, fin, contenido[i:fin]
+            i = fin
+        elif contenido[i:i + 2] in (b"<<", b">>"):
+            yield i, i + 2, contenido[i:i + 2]
+            i += 2
+        elif c in b"[]{}":
+            yield i, i + 1, contenido[i:i + 1]
+            i += 1
+        else:
+            inicio = i
+            i += 1
+            while i < n and contenido[i] not in _ESPACIOS_PDF and contenido[i] not in _DELIMITADORES_PDF:
+                i += 1
+            token = contenido[inicio:i]
+            yield inicio, i, token
+            if token == b"ID":
+                #Datos binarios de una imagen en línea: se saltan hasta el EI que la cierra
+                fin = i + 1
+                while True:
+                    fin = contenido.find(b"EI", fin)
+                    if fin < 0:
+                        i = n
+                        break
+                    if contenido[fin - 1] in _ESPACIOS_PDF and (fin + 2 >= n or contenido[fin + 2] in _ESPACIOS_PDF):
+                        i = fin
+                        break
+                    fin += 2
+
+
+def _es_numero(token:bytes):
+    """Indica si un token de un flujo de contenido es un número."""
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def _a_gris(valores:list[float]):
+    """Convierte una lista de componentes RGB (3) o CMYK (4) entre 0 y 1 a un nivel de gris entre 0 y 1."""
+    if len(valores) == 3:
+        r, g, b = valores
+        gris = 0.3 * r + 0.59 * g + 0.11 * b
+    else:
+        c, m, y, k = valores
+        gris = 1 - min(1.0, 0.3 * c + 0.59 * m + 0.11 * y + k)
+    return min(1.0, max(0.0, gris))
+
+
+def _tipo_espacio_color(documento, xref_recursos:int, nombre:bytes, cache:dict):
+    """
+    Función que averigua si un espacio de color, por su nombre en un flujo de contenido, es RGB o CMYK.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento al que pertenece el flujo.
+    - xref_recursos (int): xref de la página o Form XObject que contiene los recursos del flujo.
+    - nombre (bytes): Nombre del espacio de color, con la barra inicial.
+    - cache (dict): Resultados ya calculados para no volver a leer el pdf.
+
+    Returns:
+    --------
+    - tipo (int): 3 si es RGB, 4 si es CMYK, 0 si es cualquier otro.
+    """
+
+    clave = (xref_recursos, nombre)
+    if clave in cache:
+        return cache[clave]
+
+    tipo = 0
+    if nombre in (b"/DeviceRGB", b"/RGB", b"/CalRGB"):
+        tipo = 3
+    elif nombre in (b"/DeviceCMYK", b"/CMYK"):
+        tipo = 4
+    elif xref_recursos:
+        clase, valor = documento.xref_get_key(xref_recursos, "Resources/ColorSpace/" + nombre[1:].decode("latin-1"))
+        if clase == "xref":
+            xref_espacio = int(valor.split()[0])
+            valor = documento.xref_object(xref_espacio, compressed=True)
+        if "/DeviceRGB" in valor or "/CalRGB" in valor:
+            tipo = 3
+        elif "/DeviceCMYK" in valor:
+            tipo = 4
+        elif "/ICCBased" in valor:
+            #El número de componentes está en la clave /N del perfil ICC
+            xref_icc = int(valor.split("/ICCBased")[1].split()[0])
+            componentes = documento.xref_get_key(xref_icc, "N")[1]
+            tipo = {"3": 3, "4": 4}.get(componentes, 0)
+    cache[clave] = tipo
+    return tipo
+
+
+def _convertir_contenido_a_gris(documento, contenido:bytes, xref_recursos:int, cache:dict):
+    """
+    Función que reescribe los operadores de color de un flujo de contenido para que usen escala de grises.
+    Los operadores rg/RG y k/K se convierten en g/G. Los espacios de color RGB o CMYK seleccionados con
+    cs/CS se sustituyen por /DeviceGray, junto con los colores que se fijan después con sc/scn/SC/SCN.
+    El resto del flujo (texto, trazados, imágenes) queda intacto, por lo que la página sigue siendo vectorial.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento al que pertenece el flujo.
+    - contenido (bytes): Flujo de contenido ya descomprimido.
+    - xref_recursos (int): xref de la página o Form XObject que contiene los recursos del flujo.
+    - cache (dict): Caché de tipos de espacio de color compartida entre flujos.
+
+    Returns:
+    --------
+    - contenido (bytes): Flujo de contenido en escala de grises.
+    """
+
+    cambios = []
+    operandos = []
+    #Componentes del espacio de color actual de relleno y de trazo (0 si no se convierte), con su pila q/Q
+    relleno, trazo = 0, 0
+    pila = []
+
+    for inicio, fin, token in _tokens_contenido(contenido):
+        es_operador = token[:1] not in b"/([<" and not _es_numero(token) and token not in (b"true", b"false", b"null")
+        if token in (b"[", b"]", b"<<", b">>", b"{", b"}") or not es_operador:
+            operandos.append((inicio, fin, token))
+            continue
+
+        numeros = [float(t) for _, _, t in operandos if _es_numero(t)]
+        inicio_operandos = operandos[0][0] if operandos else inicio
+        if token in (b"rg", b"RG", b"k", b"K") and len(numeros) == (3 if token in (b"rg", b"RG") else 4):
+            operador = b"g" if token in (b"rg", b"k") else b"G"
+            cambios.append((inicio_operandos, fin, b"%.4g %s" % (_a_gris(numeros), operador)))
+        elif token in (b"cs", b"CS") and operandos and operandos[-1][2][:1] == b"/":
+            componentes = _tipo_espacio_color(documento, xref_recursos, operandos[-1][2], cache)
+            if token == b"cs":
+                relleno = componentes
+            else:
+                trazo = componentes
+            if componentes:
+                cambios.append((inicio_operandos, fin, b"/DeviceGray " + token))
+        elif token in (b"sc", b"scn", b"SC", b"SCN"):
+            componentes = relleno if token in (b"sc", b"scn") else trazo
+            if componentes and len(numeros) == componentes == len(operandos):
+                cambios.append((inicio_operandos, fin, b"%.4g %s" % (_a_gris(numeros), token)))
+        elif token == b"q":
+            pila.append((relleno, trazo))
+        elif token == b"Q" and pila:
+            relleno, trazo = pila.pop()
+        operandos = []
+
+    #Se aplican los cambios sobre el flujo original, manteniendo el resto de bytes tal cual
+    partes = []
+    anterior = 0
+    for inicio, fin, reemplazo in cambios:
+        partes.append(contenido[anterior:inicio])
+        partes.append(reemplazo)
+        anterior = fin
+    partes.append(contenido[anterior:])
+    return b"".join(partes)
+
+
+def _imagen_a_gris(documento, xref:int):
+    """
+    Función que recodifica una imagen del documento en escala de grises, conservando su máscara.
+    Las imágenes JPEG se vuelven a guardar como JPEG y el resto se comprimen con Flate.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento al que pertenece la imagen. No se modifica.
+    - xref (int): xref de la imagen.
+
+    Returns:
+    --------
+    - cambio (tuple): Cambio de la imagen como en _aplicar_cambios, o None si no hay que convertirla.
+    """
+
+    if documento.xref_get_key(xref, "ImageMask")[1] == "true":
+        return None
+    pix = fitz.Pixmap(documento, xref)
+    if pix.n - pix.alpha < 3:
+        return None
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    gris = fitz.Pixmap(fitz.csGRAY, pix)
+
+    claves = [("ColorSpace", "/DeviceGray"), ("BitsPerComponent", "8"), ("DecodeParms", "null"), ("Decode", "null")]
+    if documento.xref_get_key(xref, "Filter")[1] == "/DCTDecode":
+        return xref, gris.tobytes("jpeg"), False, [("Filter", "/DCTDecode")] + claves
+    return xref, gris.samples, True, claves
+
+
+def _cambios_gris(documento, paginas:range = None):
+    """
+    Función que calcula, sin modificar el documento, los cambios que lo convierten a escala de grises sin
+    rasterizar sus páginas. Reescribe los operadores de color de los flujos de contenido de las páginas y
+    de sus Form XObjects y recodifica cada imagen una sola vez aunque se use en varias páginas. El texto
+    sigue siendo seleccionable y el coste depende del número de imágenes distintas, no de la superficie
+    de las páginas.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento a convertir.
+    - paginas (range): Números de las páginas a convertir. None convierte todas.
+
+    Returns:
+    --------
+    - cambios (list[tuple]): Cambios de cada flujo e imagen, como en _aplicar_cambios.
+    """
+
+    #Flujos de contenido, con el xref del objeto que contiene sus recursos, e imágenes sin repetir
+    flujos = {}
+    imagenes = set()
+    for numero in range(len(documento)) if paginas is None else paginas:
+        pagina = documento[numero]
+        for xref in pagina.get_contents():
+            flujos.setdefault(xref, pagina.xref)
+        for xref_form, *_ in pagina.get_xobjects():
+            flujos.setdefault(xref_form, xref_form)
+        imagenes.update(imagen[0] for imagen in pagina.get_images(full=True))
+
+    cambios = []
+    cache = {}
+    for xref, xref_recursos in flujos.items():
+        contenido = documento.xref_stream(xref)
+        if contenido:
+            cambios.append((xref, _convertir_contenido_a_gris(documento, contenido, xref_recursos, cache), True, []))
+    for xref in sorted(imagenes):
+        cambio = _imagen_a_gris(documento, xref)
+        if cambio is not None:
+            cambios.append(cambio)
+    return cambios
+
+
+def _aplicar_cambios(documento, cambios):
+    """
+    Función que aplica al documento cambios de flujos calculados, por ejemplo, en otro proceso.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento a modificar.
+    - cambios (iterable[tuple]): Tuplas (xref, datos, comprimir, claves) con el nuevo contenido del flujo, si
+      se debe comprimir con Flate y la lista de pares (clave, valor) que se fijan después en su diccionario.
+    """
+
+    for xref, datos, comprimir, claves in cambios:
+        documento.update_stream(xref, datos, compress=comprimir)
+        for clave, valor in claves:
+            documento.xref_set_key(xref, clave, valor)
+
+
+def _convertir_documento_a_gris(documento, paginas:range = None):
+    """
+    Función que convierte un documento a escala de grises sin rasterizar sus páginas (ver _cambios_gris).
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento a convertir. Se modifica en memoria.
+    - paginas (range): Números de las páginas a convertir. None convierte todas.
+    """
+
+    _aplicar_cambios(documento, _cambios_gris(documento, paginas))
+
+
+def _renderizar_pagina_gris(pagina, dpi_gris:int = 72):
+    """Función que devuelve una imagen de la página tal como se ve, en escala de grises y sin transparencia."""
+    pix_gris = pagina.get_pixmap(colorspace=fitz.csGRAY, dpi=dpi_gris)  # Convertir a escala de grises
+    return fitz.Pixmap(pix_gris, 0)  # Crear un nuevo Pixmap en gris
+
+
+def _tapar_pagina_con_imagen(pagina, img_gris):
+    """Función que tapa una página con una imagen suya, como la de _renderizar_pagina_gris."""
+    #El pixmap es la página tal como se ve, así que se inserta girado con ella
+    pagina.insert_image(pagina.rect * _matriz_insercion(pagina), pixmap=img_gris, overlay=True,
+                        rotate=pagina.rotation)  # Sobrescribir en gris
+
+
+def _convertir_pagina_a_gris_raster(pagina, dpi_gris:int = 72):
+    """Función que tapa una página con una imagen suya en escala de grises a la resolución indicada."""
+    _tapar_pagina_con_imagen(pagina, _renderizar_pagina_gris(pagina, dpi_gris))
+
+
+def _dibujar_mosaico_plantilla(pagina,
+                               pix,
+                               xref:int,
+                               ancho_imagen:int,
+                               alto_imagen:int,
+                               espaciado_ancho:int,
+                               espaciado_alto:int):
+    """
+    Función que dibuja el mosaico de una página de plantilla (sin girar ni recortar) con un único flujo
+    de contenido. La imagen se inserta solo en la primera tesela y el resto se escriben directamente como
+    operadores que dibujan ese mismo objeto de imagen, en lugar de llamar a insert_image en cada tesela,
+    que añade un flujo y un recurso nuevos por llamada.
+
+    Parameters:
+    ----------
+    - pagina (fitz.Page): Página de la plantilla.
+    - pix (fitz.Pixmap): Imagen de la marca de agua.
+    - xref (int): Referencia de la imagen si ya está insertada en el documento de la plantilla, 0 si no lo está.
+    - ancho_imagen (int): Ancho de la marca de agua.
+    - alto_imagen (int): Alto de la marca de agua.
+    - espaciado_ancho (int): Separación horizontal entre teselas.
+    - espaciado_alto (int): Separación vertical entre teselas.
+
+    Returns:
+    --------
+    - xref (int): Referencia de la imagen de la marca de agua en el documento de la plantilla.
+    """
+
+    alto_pagina = round(pagina.rect.height, 2)
+    teselas = _disposicion_mosaico(round(pagina.rect.width, 2), alto_pagina, ancho_imagen, alto_imagen,
+                                   espaciado_ancho, espaciado_alto)
+    if not teselas:
+        return xref
+    primera = fitz.Rect(teselas[0])
+    xref = pagina.insert_image(primera, xref=xref) if xref else pagina.insert_image(primera, pixmap=pix)
+    nombre = next(imagen[7] for imagen in pagina.get_images() if imagen[0] == xref)
+    #El flujo que ha creado insert_image se sustituye por el de todas las teselas (el eje y del pdf va hacia arriba)
+    contenido = "".join(f"q {x1 - x0} 0 0 {y1 - y0} {x0} {alto_pagina - y1:g} cm /{nombre} Do Q\n"
+                        for x0, y0, x1, y1 in teselas)
+    pagina.parent.update_stream(pagina.get_contents()[-1], contenido.encode("ascii"))
+    return xref
+
+
+def _crear_plantillas(tamanos,
+                      pix,
+                      ancho_imagen:int,
+                      alto_imagen:int,
+                      espaciado_ancho:int,
+                      espaciado_alto:int,
+                      reutilizar_imagen:bool = True,
+                      plantillas = None):
+    """
+    Función que dibuja el mosaico completo en un documento auxiliar con una página por cada tamaño de
+    página, para estamparlo después en cada página con una sola colocación.
+
+    Parameters:
+    ----------
+    - tamanos (iterable[tuple[float, float]]): Tamaños de página (ancho, alto) redondeados a dos decimales.
+    - pix (fitz.Pixmap | fitz.Document): Imagen de la marca de agua, o documento de una página si es vectorial.
+    - ancho_imagen (int): Ancho de la marca de agua.
+    - alto_imagen (int): Alto de la marca de agua.
+    - espaciado_ancho (int): Separación horizontal entre teselas.
+    - espaciado_alto (int): Separación vertical entre teselas.
+    - reutilizar_imagen (bool): True reutiliza la imagen ya insertada a través de su xref. True por defecto.
+    - plantillas (tuple[fitz.Document, dict]): Plantillas ya construidas que se amplían con los tamaños
+      que falten. No se modifican. None por defecto.
+
+    Returns:
+    --------
+    - plantillas (tuple[fitz.Document, dict]): Documento de plantillas y número de página de cada tamaño.
+    """
+
+    documento_plantillas = fitz.open("pdf", plantillas[0].tobytes()) if plantillas else fitz.open()
+    paginas_plantilla = dict(plantillas[1]) if plantillas else {}
+    xref_plantilla = 0
+    for clave in tamanos:
+        if clave not in paginas_plantilla:
+            pagina_plantilla = documento_plantillas.new_page(width=clave[0], height=clave[1])
+            if reutilizar_imagen and not isinstance(pix, fitz.Document):
+                xref_plantilla = _dibujar_mosaico_plantilla(pagina_plantilla, pix, xref_plantilla, ancho_imagen,
+                                                            alto_imagen, espaciado_ancho, espaciado_alto)
+            else:
+                xref_plantilla = _colocar_mosaico(pagina_plantilla, pix, xref_plantilla, ancho_imagen, alto_imagen,
+                                                  espaciado_ancho, espaciado_alto, reutilizar_imagen)
+            paginas_plantilla[clave] = pagina_plantilla.number
+    #Las plantillas se reabren desde memoria para que show_pdf_page trabaje sobre un documento ya cerrado
+    bytes_plantillas = documento_plantillas.tobytes()
+    documento_plantillas.close()
+    return fitz.open("pdf", bytes_plantillas), paginas_plantilla
+
+
+def _tamanos_pagina(documento, paginas:range):
+    """Devuelve los tamaños visibles (ancho, alto) distintos de las páginas indicadas, redondeados y en orden de aparición."""
+    return dict.fromkeys((round(documento[numero].rect.width, 2), round(documento[numero].rect.height, 2))
+                         for numero in paginas)
+
+
+def _marcar_paginas(documento,
+                    pix,
+                    ancho_imagen:int,
+                    alto_imagen:int,
+                    espaciado_ancho:int = 10,
+                    espaciado_alto:int = 1,
+                    blanco_y_negro:bool = False,
+                    reutilizar_imagen:bool = True,
+                    modo_mosaico:str = "imagen",
+                    modo_gris:str = "vectorial",
+                    dpi_gris:int = 72,
+                    progreso = None,
+                    paginas:range = None,
+                    estadisticas = _SIN_ESTADISTICAS,
+                    plantillas = None,
+                    capa:int = 0):
+    """
+    Función que aplica la marca de agua en mosaico a las páginas de un documento ya abierto.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento a marcar. Se modifica en memoria.
+    - pix (fitz.Pixmap | fitz.Document): Imagen de la marca de agua, o documento de una página si es vectorial.
+    - ancho_imagen (int): Ancho de la marca de agua.
+    - alto_imagen (int): Alto de la marca de agua.
+    - espaciado_ancho (int): Separación horizontal entre teselas.
+    - espaciado_alto (int): Separación vertical entre teselas.
+    - blanco_y_negro (bool): True convierte las páginas a escala de grises. False por defecto.
+    - reutilizar_imagen (bool): True reutiliza la imagen ya insertada a través de su xref. True por defecto.
+    - modo_mosaico (str): "imagen" o "plantilla", ver anadir_marca_agua_a_pdf. "imagen" por defecto.
+    - modo_gris (str): "vectorial" o "raster", ver anadir_marca_agua_a_pdf. "vectorial" por defecto.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster". 72 por defecto.
+    - progreso (callable): Función progreso(paginas_hechas, total) que se llama tras cada página.
+      Si devuelve False se lanza ProcesoCancelado. None por defecto.
+    - paginas (range): Números de las páginas a marcar. None marca todas.
+    - estadisticas (Estadisticas): Donde se registran los tiempos por etapa y por página y las teselas.
+    - plantillas (tuple[fitz.Document, dict]): Plantillas del modo "plantilla" ya construidas para todos los
+      tamaños de página, como las de MarcadorAgua. No se cierran. None las construye para este documento.
+    - capa (int): Referencia (xref) de la capa opcional en la que se estampa el mosaico en modo "plantilla".
+      0 lo estampa sin capa.
+    """
+
+    if paginas is None:
+        paginas = range(len(documento))
+
+    #La conversión vectorial se hace sobre todas las páginas antes de añadir la marca de agua
+    if blanco_y_negro and modo_gris == "vectorial":
+        with estadisticas.medir("gris"):
+            _convertir_documento_a_gris(documento, paginas)
+
+    #Referencia (xref) de la imagen una vez insertada en el documento, 0 mientras no se haya insertado
+    xref_marca_agua = 0
+
+    #En modo plantilla el mosaico se dibuja en un documento auxiliar con una página por cada tamaño
+    plantillas_propias = plantillas is None
+    if modo_mosaico == "plantilla" and plantillas_propias:
+        #Se construye el mosaico una sola vez por cada tamaño de página distinto
+        with estadisticas.medir("plantillas"):
+            plantillas = _crear_plantillas(_tamanos_pagina(documento, paginas), pix, ancho_imagen, alto_imagen,
+                                           espaciado_ancho, espaciado_alto, reutilizar_imagen)
+    documento_plantillas, paginas_plantilla = plantillas or (None, None)
+    
+    
+    #Itera sobre cada página del PDF
+    for numero in paginas:
+        inicio_pagina = time.perf_counter()
+        pagina = documento[numero]
+
+        # Si el parámetro blanco_y_negro es True en modo raster, sustituye la página por una imagen en gris
+        if blanco_y_negro and modo_gris == "raster":
+            with estadisticas.medir("gris"):
+                _convertir_pagina_a_gris_raster(pagina, dpi_gris)
+
+        #Obtiene dimensiones de la página tal como se ve, ya girada y recortada
+        clave = (round(pagina.rect.width, 2), round(pagina.rect.height, 2))
+
+        with estadisticas.medir("mosaico"):
+            if modo_mosaico == "plantilla":
+                #Estampa el mosaico completo con una única colocación (Form XObject reutilizado entre páginas).
+                #La plantilla está dibujada derecha, así que se gira con la página
+                pagina.show_pdf_page(pagina.rect * _matriz_insercion(pagina), documento_plantillas,
+                                     paginas_plantilla[clave], overlay=True, rotate=pagina.rotation, oc=capa)
+            else:
+                xref_marca_agua = _colocar_mosaico(pagina, pix, xref_marca_agua, ancho_imagen, alto_imagen,
+                                                   espaciado_ancho, espaciado_alto, reutilizar_imagen)
+
+        #Teselas visibles de la página, las mismas que coloca _colocar_mosaico
+        estadisticas.sumar("teselas", len(_disposicion_mosaico(*clave, ancho_imagen, alto_imagen,
+                                                               espaciado_ancho, espaciado_alto)))
+        estadisticas.sumar("paginas")
+        estadisticas.anadir_pagina(numero, time.perf_counter() - inicio_pagina)
+
+        #Informa del avance y comprueba si se ha pedido cancelar entre página y página
+        if progreso is not None and progreso(pagina.number + 1, len(documento)) is False:
+            if plantillas_propias and documento_plantillas is not None:
+                documento_plantillas.close()
+            raise ProcesoCancelado("Marcado de agua cancelado")
+
+    if plantillas_propias and documento_plantillas is not None:
+        documento_plantillas.close()
+
+
+def _gris_rango_paginas(ruta_entrada_pdf:str,
+                        desde:int,
+                        hasta:int,
+                        modo_gris:str,
+                        dpi_gris:int,
+                        medir:bool = False):
+    """
+    Función que se ejecuta en cada proceso del modo paralelo. Abre el pdf y calcula la conversión a
+    escala de grises de un rango de páginas sin modificarlo, para que se aplique en el documento original.
+
+    Parameters:
+    ----------
+    - ruta_entrada_pdf (str | bytes): Ruta del pdf a marcar, o su contenido.
+    - desde (int): Primera página del rango (incluida).
+    - hasta (int): Última página del rango (excluida).
+    - modo_gris (str): "vectorial" o "raster", ver anadir_marca_agua_a_pdf.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster".
+    - medir (bool): True recoge las estadísticas del rango. False por defecto.
+
+    Returns:
+    --------
+    - cambios (list): En modo "vectorial", los cambios de _cambios_gris. En modo "raster", una tupla
+      (número de página, ancho, alto, muestras de la imagen en gris) por página.
+    - resumen (dict): Resumen de las estadísticas del rango, o None si medir es False.
+    """
+
+    estadisticas = Estadisticas() if medir else _SIN_ESTADISTICAS
+    with _abrir_pdf(ruta_entrada_pdf) as documento, estadisticas.medir("gris"):
+        if modo_gris == "vectorial":
+            cambios = _cambios_gris(documento, range(desde, hasta))
+        else:
+            cambios = []
+            for numero in range(desde, hasta):
+                img_gris = _renderizar_pagina_gris(documento[numero], dpi_gris)
+                cambios.append((numero, img_gris.width, img_gris.height, img_gris.samples))
+    return cambios, estadisticas.resumen() if medir else None
+
+
+def _convertir_a_gris_en_paralelo(documento,
+                                  ruta_entrada_pdf:str,
+                                  num_procesos:int,
+                                  modo_gris:str,
+                                  dpi_gris:int,
+                                  progreso = None,
+                                  estadisticas = _SIN_ESTADISTICAS):
+    """
+    Función que reparte la conversión a escala de grises, la parte costosa del marcado, entre varios
+    procesos por rangos de páginas, y aplica sus resultados en orden sobre el documento original. Los
+    procesos no devuelven páginas sino solo los flujos e imágenes convertidos, así que el documento
+    conserva todo lo demás (enlaces, destinos, anotaciones, recursos compartidos) igual que en serie.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento original ya abierto. Se modifica en memoria.
+    - ruta_entrada_pdf (str | bytes): Ruta del pdf, o su contenido, que abre cada proceso.
+    - num_procesos (int): Número de procesos a utilizar.
+    - modo_gris (str): "vectorial" o "raster", ver anadir_marca_agua_a_pdf.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster".
+    - progreso (callable): Igual que en _marcar_paginas, pero se llama al terminar cada rango. None por defecto.
+    - estadisticas (Estadisticas): Donde se combinan las estadísticas de todos los procesos.
+    """
+
+    num_paginas = len(documento)
+    #Rangos pequeños para no tener en memoria la conversión de muchas páginas a la vez, con como mucho dos
+    #rangos por proceso enviados por delante
+    rangos = deque((desde, min(desde + PAGINAS_POR_RANGO_GRIS, num_paginas))
+                   for desde in range(0, num_paginas, PAGINAS_POR_RANGO_GRIS))
+    medir = estadisticas is not _SIN_ESTADISTICAS
+    convertidos = set()
+    futuros = deque()
+    with ProcessPoolExecutor(max_workers=num_procesos) as ejecutor:
+        while rangos or futuros:
+            while rangos and len(futuros) < 2 * num_procesos:
+                desde, hasta = rangos.popleft()
+                futuros.append((ejecutor.submit(_gris_rango_paginas, ruta_entrada_pdf, desde, hasta, modo_gris,
+                                                dpi_gris, medir), hasta))
+            futuro, hasta = futuros.popleft()
+            cambios, resumen = futuro.result()
+            if modo_gris == "vectorial":
+                #Los flujos e imágenes compartidos entre rangos se convierten en varios procesos, se aplican una vez
+                _aplicar_cambios(documento, [cambio for cambio in cambios if cambio[0] not in convertidos])
+                convertidos.update(cambio[0] for cambio in cambios)
+            else:
+                for numero, ancho, alto, muestras in cambios:
+                    _tapar_pagina_con_imagen(documento[numero], fitz.Pixmap(fitz.csGRAY, ancho, alto, muestras, False))
+            if resumen is not None:
+                estadisticas.combinar(resumen)
+            if progreso is not None and progreso(hasta, num_paginas) is False:
+                for pendiente, _ in futuros:
+                    pendiente.cancel()
+                raise ProcesoCancelado("Marcado de agua cancelado")
+
+
+def _copiar_para_guardado_incremental(ruta_entrada_pdf:str, ruta_salida_pdf:str):
+    """
+    Función que copia el pdf original en la ruta de salida y lo deja listo para añadirle cambios con
+    guardados incrementales. La salida debe ser un fichero nuevo (un temporal que luego sustituye al
+    destino): añadir cambios a un fichero existente modificaría también sus enlaces duros, como los
+    que reparte la caché de salidas.
+    """
+
+    shutil.copyfile(ruta_entrada_pdf, ruta_salida_pdf)
+    with fitz.open(ruta_salida_pdf) as documento:
+        #Un pdf que se ha tenido que reparar al abrirlo no admite guardados incrementales: se reescribe una vez
+        if not documento.can_save_incrementally():
+            documento.save(ruta_salida_pdf + ".tmp")
+    if os.path.isfile(ruta_salida_pdf + ".tmp"):
+        os.replace(ruta_salida_pdf + ".tmp", ruta_salida_pdf)
+
+
+def _retirar_capas_marca_agua(documento):
+    """
+    Función que retira las marcas de agua añadidas con guardado incremental: vacía los Form XObject de
+    las capas CAPA_MARCA_AGUA activas y las desactiva. Solo modifica esos objetos, así que al guardar de
+    forma incremental se añade muy poco al fichero.
+
+    Parameters:
+    ----------
+    - documento (fitz.Document): Documento abierto. Se modifica en memoria.
+
+    Returns:
+    --------
+    - retiradas (int): Número de capas retiradas.
+    """
+
+    capas = {xref for xref, capa in documento.get_ocgs().items() if capa["name"] == CAPA_MARCA_AGUA and capa["on"]}
+    if not capas:
+        return 0
+    for xref in range(1, documento.xref_length()):
+        tipo, valor = documento.xref_get_key(xref, "OC")
+        if tipo == "xref" and int(valor.split()[0]) in capas:
+            documento.update_stream(xref, b"")
+            documento.xref_set_key(xref, "Resources", "<<>>")
+    estado = documento.get_layer()
+    documento.set_layer(-1, on=[xref for xref in estado.get("on", []) if xref not in capas],
+                        off=sorted(set(estado.get("off", [])) | capas))
+    return len(capas)
+
+
+def retirar_marca_agua(ruta_pdf:str):
+    """
+    Función que quita de un pdf la marca de agua añadida con guardado incremental, añadiendo el cambio al
+    final del fichero en lugar de reescribirlo.
+
+    Parameters:
+    ----------
+    - ruta_pdf (str): Ruta del pdf. Se sustituye por una copia con el cambio añadido al final.
+
+    Returns:
+    --------
+    - retiradas (int): Número de capas de marca de agua retiradas. 0 si no tenía ninguna.
+    """
+
+    #Como en MarcadorAgua._aplicar_incremental, el cambio se añade a una copia que sustituye al pdf al terminar
+    ruta_temporal = f"{os.fspath(ruta_pdf)}.{os.getpid()}.tmp"
+    try:
+        _copiar_para_guardado_incremental(ruta_pdf, ruta_temporal)
+        with fitz.open(ruta_temporal) as documento:
+            retiradas = _retirar_capas_marca_agua(documento)
+            if retiradas:
+                documento.saveIncr()
+        if retiradas:
+            os.replace(ruta_temporal, ruta_pdf)
+    finally:
+        if os.path.isfile(ruta_temporal):
+            os.remove(ruta_temporal)
+    return retiradas
+
+
+def _marcar_por_bloques(ruta_entrada_pdf:str,
+                        ruta_salida_pdf:str,
+                        paginas_por_bloque:int,
+                        pix,
+                        ancho_imagen:int,
+                        alto_imagen:int,
+                        opciones:dict,
+                        progreso = None,
+                        estadisticas = _SIN_ESTADISTICAS,
+                        obtener_plantillas = None):
+    """
+    Función que marca un pdf por bloques de páginas con memoria acotada. Copia el pdf original en la
+    ruta de salida y, por cada bloque, lo abre, marca solo esas páginas, añade los cambios al final del
+    fichero con un guardado incremental y lo cierra. Así nunca hay más de un bloque de páginas
+    modificadas en memoria, sea cual sea la longitud del documento.
+
+    Parameters:
+    ----------
+    - ruta_entrada_pdf (str): Ruta del pdf a marcar.
+    - ruta_salida_pdf (str): Ruta donde se guardará el pdf marcado.
+    - paginas_por_bloque (int): Número máximo de páginas que se procesan antes de escribirlas en disco.
+    - pix (fitz.Pixmap | fitz.Document): Imagen de la marca de agua, o documento de una página si es vectorial.
+    - ancho_imagen (int): Ancho de la marca de agua.
+    - alto_imagen (int): Alto de la marca de agua.
+    - opciones (dict): Resto de parámetros de _marcar_paginas.
+    - progreso (callable): Igual que en _marcar_paginas. None por defecto.
+    - estadisticas (Estadisticas): Donde se registran los tiempos, incluidos los guardados de cada bloque.
+    - obtener_plantillas (callable): Función obtener_plantillas(documento, paginas) que devuelve las plantillas
+      ya construidas para el bloque (ver _marcar_paginas). None las construye en cada bloque.
+    """
+
+    _copiar_para_guardado_incremental(ruta_entrada_pdf, ruta_salida_pdf)
+    with fitz.open(ruta_salida_pdf) as documento:
+        num_paginas = len(documento)
+
+    for desde in range(0, num_paginas, paginas_por_bloque):
+        with fitz.open(ruta_salida_pdf) as documento:
+            bloque = range(desde, min(desde + paginas_por_bloque, num_paginas))
+            plantillas = obtener_plantillas(documento, bloque) if obtener_plantillas is not None else None
+            _marcar_paginas(documento, pix, ancho_imagen, alto_imagen, progreso=progreso, paginas=bloque,
+                            estadisticas=estadisticas, plantillas=plantillas, **opciones)
+            with estadisticas.medir("guardado"):
+                documento.saveIncr()
+        #Libera las imágenes y fuentes que MuPDF mantiene en su caché interna tras cerrar el bloque
+        fitz.TOOLS.store_shrink(100)
+
+
+class MarcadorAgua:
+    """
+    Clase que prepara una marca de agua una sola vez para aplicarla a muchos documentos. Guarda la
+    marca de agua ya construida (imagen y PNG, o pdf si es vectorial) y las plantillas del mosaico de
+    cada tamaño de página que va encontrando, de modo que cada documento solo cuesta el trabajo de
+    sus páginas. PyMuPDF no admite que varios hilos lo usen a la vez, así que cada marcador se usa
+    desde un único hilo; para marcar en paralelo se crea un marcador en cada proceso.
+
+    Parameters:
+    ----------
+    - texto_marca_agua (str): Texto saldrá en la marca de agua.
+    - tamano_fuente (int): Tamaño de la fuente (recomentado ente 16 y 40), o porcentaje de la imagen.
+    - opacidad_texto (int): Opacidad de la marca de agua entre 0 y 255.
+    - texto_mayusculas (bool): Poner el texto en minúsculas con False o mayúsculas con True. False por defecto.
+    - color_texto (tuple[int,int,int]): tupla que indica el color en tres dígitos. Rojo por defecto.
+    - blanco_y_negro (bool): True convierte los pdfs a escala de grises. False por defecto.
+    - ruta_imagen (str | bytes | file): Ruta de la imagen o su contenido en memoria. Si existe, se usa la
+      imagen en lugar del texto.
+    - espaciado_ancho (int): Separación horizontal entre teselas.
+    - espaciado_alto (int): Separación vertical entre teselas.
+    - reutilizar_imagen (bool): Ver anadir_marca_agua_a_pdf. True por defecto.
+    - modo_mosaico (str): Ver anadir_marca_agua_a_pdf. "plantilla" por defecto, ya que es el modo en el que
+      las plantillas guardadas ahorran trabajo en cada documento.
+    - motor (str): "raster" o "vectorial", ver anadir_marca_agua_a_pdf. "raster" por defecto.
+    - modo_gris (str): "vectorial" o "raster", ver anadir_marca_agua_a_pdf. "vectorial" por defecto.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster". 72 por defecto.
+    - perfil_guardado (str): Perfil de PERFILES_GUARDADO de los pdfs de salida. None por defecto.
+    - estadisticas (Estadisticas): Donde se registra la construcción de la marca de agua. None por defecto.
+    - incremental (bool): Ver anadir_marca_agua_a_pdf. False por defecto.
+    """
+
+    def __init__(self,
+                 texto_marca_agua:str,
+                 tamano_fuente:int,
+                 opacidad_texto:int,
+                 texto_mayusculas:bool = False,
+                 color_texto: tuple[int, int, int] = (255, 0, 0),
+                 blanco_y_negro: bool = False,
+                 ruta_imagen:str = None,
+                 espaciado_ancho:int = 10,
+                 espaciado_alto:int = 1,
+                 reutilizar_imagen:bool = True,
+                 modo_mosaico:str = "plantilla",
+                 motor:str = "raster",
+                 modo_gris:str = "vectorial",
+                 dpi_gris:int = 72,
+                 perfil_guardado:str = None,
+                 estadisticas:Estadisticas = None,
+                 incremental:bool = False):
+
+        if motor not in ("raster", "vectorial"):
+            raise ValueError(f"Motor de marca de agua no válido: {motor}")
+        if modo_mosaico not in ("imagen", "plantilla"):
+            raise ValueError(f"Modo de mosaico no válido: {modo_mosaico}")
+        if modo_gris not in ("vectorial", "raster"):
+            raise ValueError(f"Modo de gris no válido: {modo_gris}")
+        if perfil_guardado is not None and perfil_guardado not in PERFILES_GUARDADO:
+            raise ValueError(f"Perfil de guardado no válido: {perfil_guardado}")
+        if incremental:
+            #La capa se retira vaciando los Form XObject del modo plantilla, y la conversión a gris
+            #reescribiría el documento entero
+            if modo_mosaico != "plantilla":
+                raise ValueError("El guardado incremental requiere el modo de mosaico \"plantilla\"")
+            if blanco_y_negro:
+                raise ValueError("El guardado incremental no se puede combinar con blanco_y_negro")
+            if perfil_guardado is not None:
+                raise ValueError("El guardado incremental no se puede combinar con un perfil de guardado")
+        medidas = estadisticas if estadisticas is not None else _SIN_ESTADISTICAS
+
+        self.marca_vectorial = motor == "vectorial" and not _hay_imagen(ruta_imagen)
+        if self.marca_vectorial:
+            #El texto vectorial no pasa por PIL ni por PNG, se estampa directamente como pdf
+            with medidas.medir("marca_agua"):
+                self.pix = _crear_marca_agua_vectorial(texto_marca_agua, tamano_fuente, opacidad_texto,
+                                                       texto_mayusculas, color_texto)
+            self.bytes_marca = self.pix.tobytes()
+            self.ancho_imagen, self.alto_imagen = int(self.pix[0].rect.width), int(self.pix[0].rect.height)
+        else:
+            #Obtiene la imagen de la marca de agua y su PNG, ya construidos si están en la caché
+            imagen_marca_agua, self.bytes_marca = _obtener_marca_agua(texto_marca_agua, tamano_fuente, opacidad_texto,
+                                                                      texto_mayusculas, color_texto, ruta_imagen,
+                                                                      medidas)
+            #Convierte la imagen en un Pixmap de PyMuPDF
+            self.pix = fitz.Pixmap(self.bytes_marca)
+            self.ancho_imagen, self.alto_imagen = imagen_marca_agua.size
+
+        #Opciones del mosaico comunes al procesado en serie y en paralelo
+        self.opciones = {
+            "espaciado_ancho": espaciado_ancho,
+            "espaciado_alto": espaciado_alto,
+            "blanco_y_negro": blanco_y_negro,
+            "reutilizar_imagen": reutilizar_imagen,
+            "modo_mosaico": modo_mosaico,
+            "modo_gris": modo_gris,
+            "dpi_gris": dpi_gris,
+        }
+        self.perfil_guardado = perfil_guardado
+        self.incremental = incremental
+
+        #Plantillas del mosaico de los tamaños vistos hasta ahora, como mucho MAX_TAMANOS_PLANTILLAS
+        self._plantillas = None
+
+    def _obtener_plantillas(self, documento, paginas:range = None, estadisticas = _SIN_ESTADISTICAS):
+        """
+        Método que devuelve las plantillas del mosaico para las páginas indicadas del documento,
+        construyendo solo las de los tamaños de página que todavía no se habían visto.
+        """
+
+        if self.opciones["modo_mosaico"] != "plantilla":
+            return None
+        tamanos = _tamanos_pagina(documento, paginas if paginas is not None else range(len(documento)))
+        anteriores = self._plantillas
+        if anteriores is None or any(clave not in anteriores[1] for clave in tamanos):
+            #Si con los tamaños nuevos se supera el máximo, se empieza de cero con los del documento actual
+            if anteriores is not None and len(set(anteriores[1]) | set(tamanos)) > MAX_TAMANOS_PLANTILLAS:
+                anteriores[0].close()
+                anteriores = self._plantillas = None
+            with estadisticas.medir("plantillas"):
+                nuevas = _crear_plantillas(tamanos, self.pix, self.ancho_imagen, self.alto_imagen,
+                                           self.opciones["espaciado_ancho"], self.opciones["espaciado_alto"],
+                                           self.opciones["reutilizar_imagen"], anteriores)
+            #El documento sustituido ya no lo usa nadie: el marcador se usa desde un solo hilo y los documentos
+            #marcados antes con él ya están cerrados (el de un bloque anterior también)
+            if anteriores is not None:
+                anteriores[0].close()
+            self._plantillas = nuevas
+        return self._plantillas
+
+    def aplicar(self,
+                ruta_entrada_pdf:str,
+                ruta_salida_pdf:str,
+                num_procesos:int = 1,
+                progreso = None,
+                paginas_por_bloque:int = None,
+                estadisticas:Estadisticas = None):
+        """
+        Método que aplica la marca de agua a un pdf y lo guarda.
+
+        Parameters:
+        ----------
+        - ruta_entrada_pdf (str | bytes | file): Ruta del pdf a marcar, o su contenido en memoria.
+        - ruta_salida_pdf (str | file): Ruta donde se guardará el pdf marcado, o fichero abierto para escritura.
+        - num_procesos (int): Procesos para la conversión a gris de blanco_y_negro, el mosaico se estampa
+          siempre en serie. Ver anadir_marca_agua_a_pdf. 1 por defecto.
+        - progreso (callable): Ver anadir_marca_agua_a_pdf. None por defecto.
+        - paginas_por_bloque (int): Ver anadir_marca_agua_a_pdf. None por defecto.
+        - estadisticas (Estadisticas): Ver anadir_marca_agua_a_pdf. None por defecto.
+
+        Returns:
+        --------
+        - estadisticas (Estadisticas): La misma instancia recibida, ya rellena, o None si no se ha pasado ninguna.
+        """
+
+        if paginas_por_bloque and num_procesos > 1:
+            raise ValueError("El procesado por bloques no se puede combinar con varios procesos")
+        if paginas_por_bloque and self.perfil_guardado is not None:
+            raise ValueError("El procesado por bloques no se puede combinar con un perfil de guardado")
+        salida_en_fichero = isinstance(ruta_salida_pdf, (str, os.PathLike))
+        if paginas_por_bloque and (_en_memoria(ruta_entrada_pdf) or not salida_en_fichero):
+            raise ValueError("El procesado por bloques necesita rutas de entrada y salida")
+        if self.incremental and (num_procesos > 1 or paginas_por_bloque):
+            raise ValueError("El guardado incremental no se puede combinar con varios procesos ni con bloques")
+        if self.incremental and (_en_memoria(ruta_entrada_pdf) or not salida_en_fichero):
+            raise ValueError("El guardado incremental necesita rutas de entrada y salida")
+        medidas = estadisticas if estadisticas is not None else _SIN_ESTADISTICAS
+        if self.incremental:
+            self._aplicar_incremental(ruta_entrada_pdf, ruta_salida_pdf, progreso, medidas)
+            return estadisticas
+
+        #Un pdf en memoria se lee una sola vez, los procesos del modo paralelo reciben su contenido
+        if _en_memoria(ruta_entrada_pdf):
+            ruta_entrada_pdf = _leer_origen(ruta_entrada_pdf)
+
+        #Abre el PDF de entrada con PyMuPDF. En el procesado por bloques se abre más adelante, bloque a bloque
+        documento = None if paginas_por_bloque else _abrir_pdf(ruta_entrada_pdf)
+        #El pdf se escribe en un fichero temporal junto a la salida y solo la sustituye al terminar, de modo que
+        #un fallo nunca deja la salida a medias ni borra el original cuando la salida es el propio pdf de entrada
+        ruta_temporal = f"{os.fspath(ruta_salida_pdf)}.{os.getpid()}.tmp" if salida_en_fichero else None
+        opciones_guardado = PERFILES_GUARDADO.get(self.perfil_guardado, {})
+        #Solo se reparte entre procesos la conversión a gris, con al menos MIN_PAGINAS_POR_PROCESO páginas por
+        #proceso. Estampar el mosaico ya preparado es más rápido en serie que enviar las páginas a otro proceso
+        procesos = 1
+        if documento is not None and self.opciones["blanco_y_negro"]:
+            procesos = min(num_procesos, len(documento) // MIN_PAGINAS_POR_PROCESO)
+        if num_procesos > 1 and procesos <= 1:
+            warnings.warn(f"num_procesos={num_procesos} no tiene efecto: solo se reparte entre procesos la conversión "
+                          f"a gris de blanco_y_negro, con al menos {MIN_PAGINAS_POR_PROCESO} páginas por proceso",
+                          RuntimeWarning, stacklevel=2)
+        try:
+            try:
+                if paginas_por_bloque:
+                    #El pdf temporal se va escribiendo bloque a bloque desde el principio
+                    _marcar_por_bloques(ruta_entrada_pdf, ruta_temporal, paginas_por_bloque, self.pix,
+                                        self.ancho_imagen, self.alto_imagen, self.opciones, progreso, medidas,
+                                        lambda documento, paginas: self._obtener_plantillas(documento, paginas, medidas))
+                elif procesos > 1:
+                    with medidas.medir("paralelo"):
+                        _convertir_a_gris_en_paralelo(documento, ruta_entrada_pdf, procesos, self.opciones["modo_gris"],
+                                                      self.opciones["dpi_gris"], progreso, medidas)
+                    self._marcar_documento(documento, None, medidas, blanco_y_negro=False)
+                else:
+                    self._marcar_documento(documento, progreso, medidas)
+
+                #Guarda el PDF modificado con la marca de agua
+                if documento is not None and not salida_en_fichero:
+                    with medidas.medir("guardado"):
+                        bytes_marcado = documento.tobytes(**opciones_guardado)
+                        ruta_salida_pdf.write(bytes_marcado)
+                    medidas.sumar("bytes_salida", len(bytes_marcado))
+                elif documento is not None:
+                    with medidas.medir("guardado"):
+                        documento.save(ruta_temporal, **opciones_guardado)
+            finally:
+                if documento is not None:
+                    documento.close()
+            #La salida se sustituye con el documento ya cerrado, que en Windows no se puede reemplazar abierto
+            if ruta_temporal is not None:
+                os.replace(ruta_temporal, ruta_salida_pdf)
+                medidas.sumar("bytes_salida", os.path.getsize(ruta_salida_pdf))
+        except BaseException:
+            #Solo se borra el fichero temporal, nunca la salida. Si se cancela antes de escribirlo, no existe
+            if ruta_temporal is not None and os.path.isfile(ruta_temporal):
+                os.remove(ruta_temporal)
+            raise
+        return estadisticas
+
+    def _aplicar_incremental(self, ruta_entrada_pdf:str, ruta_salida_pdf:str, progreso, estadisticas):
+        """
+        Método que copia el pdf original y le añade la marca de agua al final con un guardado incremental,
+        en su propia capa opcional. Si el pdf ya tenía una marca de agua añadida así, se retira antes, de
+        modo que cambiar la marca de agua tampoco reescribe el documento.
+        """
+
+        #Se copia y se añade la marca de agua en un fichero temporal que solo sustituye a la salida al terminar,
+        #como en aplicar: la salida anterior (que puede ser el propio pdf de entrada o un enlace duro a la caché)
+        #no se modifica ni se borra si algo falla
+        ruta_temporal = f"{os.fspath(ruta_salida_pdf)}.{os.getpid()}.tmp"
+        try:
+            _copiar_para_guardado_incremental(ruta_entrada_pdf, ruta_temporal)
+            bytes_previos = os.path.getsize(ruta_temporal)
+            with fitz.open(ruta_temporal) as documento:
+                _retirar_capas_marca_agua(documento)
+                capa = documento.add_ocg(CAPA_MARCA_AGUA, on=True)
+                plantillas = self._obtener_plantillas(documento, estadisticas=estadisticas)
+                _marcar_paginas(documento, self.pix, self.ancho_imagen, self.alto_imagen, progreso=progreso,
+                                estadisticas=estadisticas, plantillas=plantillas, capa=capa, **self.opciones)
+                with estadisticas.medir("guardado"):
+                    documento.save(ruta_temporal, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=True)
+            os.replace(ruta_temporal, ruta_salida_pdf)
+        except BaseException:
+            if os.path.isfile(ruta_temporal):
+                os.remove(ruta_temporal)
+            raise
+        bytes_salida = os.path.getsize(ruta_salida_pdf)
+        estadisticas.sumar("bytes_salida", bytes_salida)
+        estadisticas.sumar("bytes_anadidos", bytes_salida - bytes_previos)
+
+    def aplicar_bytes(self, bytes_pdf, progreso = None, estadisticas:Estadisticas = None):
+        """
+        Método que aplica la marca de agua a un pdf en memoria, sin pasar por disco.
+
+        Parameters:
+        ----------
+        - bytes_pdf (bytes | bytearray | memoryview | file): Contenido del pdf a marcar.
+        - progreso (callable): Ver anadir_marca_agua_a_pdf. None por defecto.
+        - estadisticas (Estadisticas): Ver anadir_marca_agua_a_pdf. None por defecto.
+
+        Returns:
+        --------
+        - bytes_marcado (bytes): Contenido del pdf con la marca de agua.
+        """
+
+        if self.incremental:
+            raise ValueError("El guardado incremental necesita rutas de entrada y salida")
+        medidas = estadisticas if estadisticas is not None else _SIN_ESTADISTICAS
+        with _abrir_pdf(bytes_pdf) as documento:
+            self._marcar_documento(documento, progreso, medidas)
+            with medidas.medir("guardado"):
+                bytes_marcado = documento.tobytes(**PERFILES_GUARDADO.get(self.perfil_guardado, {}))
+        medidas.sumar("bytes_salida", len(bytes_marcado))
+        return bytes_marcado
+
+    def _marcar_documento(self, documento, progreso, estadisticas, **opciones):
+        """
+        Método que marca en memoria todas las páginas de un documento ya abierto. Las opciones indicadas
+        sustituyen a las del marcador, por ejemplo blanco_y_negro=False si ya se ha convertido a gris.
+        """
+
+        plantillas = self._obtener_plantillas(documento, estadisticas=estadisticas)
+        _marcar_paginas(documento, self.pix, self.ancho_imagen, self.alto_imagen, progreso=progreso,
+                        estadisticas=estadisticas, plantillas=plantillas, **dict(self.opciones, **opciones))
+
+    def cerrar(self):
+        """Método que libera la marca de agua y las plantillas. El objeto no se puede usar después."""
+        if self._plantillas is not None:
+            self._plantillas[0].close()
+        self._plantillas = None
+        if self.marca_vectorial and self.pix is not None:
+            self.pix.close()
+        self.pix = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excepcion):
+        self.cerrar()
+
+
 def anadir_marca_agua_a_pdf(
         ruta_entrada_pdf:str,
         ruta_salida_pdf:str,
@@ -198,7 +1976,18 @@ def anadir_marca_agua_a_pdf(
         blanco_y_negro: bool = False,
         ruta_imagen:str = None,
         espaciado_ancho:int = 10,
-        espaciado_alto:int = 1):
+        espaciado_alto:int = 1,
+        reutilizar_imagen:bool = True,
+        modo_mosaico:str = "imagen",
+        motor:str = "raster",
+        num_procesos:int = 1,
+        modo_gris:str = "vectorial",
+        dpi_gris:int = 72,
+        progreso = None,
+        paginas_por_bloque:int = None,
+        perfil_guardado:str = None,
+        estadisticas:Estadisticas = None,
+        incremental:bool = False):
     
     """
     Función que repite una marca de agua en mosaico a cada página de un PDF.
@@ -208,71 +1997,109 @@ def anadir_marca_agua_a_pdf(
 
     Parameters:
     ----------
-    - ruta_entrada_pdf (str): Ruta del pdf a marcar.
-    - ruta_salida_pdf (str): Ruta donde queremos guardar el pdf una vez modificado.
+    - ruta_entrada_pdf (str | bytes | file): Ruta del pdf a marcar, o su contenido en memoria.
+    - ruta_salida_pdf (str | file): Ruta donde queremos guardar el pdf una vez modificado, o fichero abierto
+      para escritura.
     - texto_marca_agua (str): Texto saldrá en la marca de agua.
     - tamano_fuente (int): Tamaño de la fuente (recomentado ente 16 y 40).
     - opacidad_texto (int): Opacidad del texto (recomendado en 100).
     - texto_mayusculas (bool): Poner el texto en minúsculas con False o mayúsculas con True. False por defecto.
     - color_texto (tuple[int,int,int]): tupla que indica el color en tres dígitos. Rojo por defecto.
     - blanco_y_negro (bool): True convierte el pdf a blanco y negro, False lo deja como está. False por defecto.
-    - ruta_imagen (str): Ruta de la imagen. Si hay una ruta, se pondrá la marca de agua con la imagen y no con el texto.
+    - ruta_imagen (str | bytes | file): Ruta de la imagen o su contenido en memoria. Si hay una imagen, se pondrá
+      la marca de agua con la imagen y no con el texto.
     - espaciado_ancho (int): Separación horizontal del texto dispuesto en la marca de agua.
     - espaciado_alto (int): Separación vertical del texto dispuesto en la marca de agua.
+    - reutilizar_imagen (bool): True inserta la imagen de la marca de agua una sola vez en el documento
+      y el resto de teselas referencian ese mismo objeto (xref). False la inserta en cada tesela. True por defecto.
+    - modo_mosaico (str): "imagen" coloca cada tesela directamente en la página. "plantilla" dibuja el mosaico
+      completo una vez por cada tamaño de página y lo estampa en cada página con una sola colocación. "imagen" por defecto.
+    - motor (str): "raster" dibuja el texto como imagen con PIL. "vectorial" escribe el texto como texto del pdf,
+      más ligero y nítido con zoom. Las marcas de agua con imagen siempre usan "raster". "raster" por defecto.
+    - num_procesos (int): Número máximo de procesos entre los que se reparte por rangos de páginas la conversión
+      a gris de blanco_y_negro, que se aplica después en el documento original, igual que en serie. Solo se
+      paraleliza esa conversión: la marca de agua se estampa siempre en serie. Cada proceso recibe al menos
+      MIN_PAGINAS_POR_PROCESO páginas; con menos, o sin blanco_y_negro, el pdf se procesa en un solo proceso y
+      se emite un RuntimeWarning. 1 por defecto.
+    - modo_gris (str): Cómo se aplica blanco_y_negro. "vectorial" reescribe los colores de los flujos de contenido
+      y de las imágenes, manteniendo el texto y los vectores. "raster" sustituye cada página por una imagen
+      en gris. "vectorial" por defecto.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster". 72 por defecto.
+    - progreso (callable): Función progreso(paginas_hechas, total) que se llama tras cada página (tras cada
+      rango convertido a gris si se usan varios procesos). Si devuelve False se detiene el proceso, no se deja ningún pdf de salida
+      a medias y se lanza ProcesoCancelado. None por defecto.
+    - paginas_por_bloque (int): Si se indica, el pdf se procesa y se escribe en disco por bloques de este número
+      de páginas mediante guardados incrementales, de modo que la memoria no crece con la longitud del documento.
+      No se puede combinar con num_procesos > 1 ni con entradas o salidas en memoria. None por defecto
+      (todo el documento en memoria).
+    - perfil_guardado (str): Perfil de PERFILES_GUARDADO con el que se guarda el pdf: "rapido", "equilibrado"
+      o "minimo". No se puede combinar con paginas_por_bloque, ya que los guardados incrementales no
+      reescriben el documento. None por defecto (opciones por defecto de PyMuPDF).
+    - estadisticas (Estadisticas): Si se indica, se rellena con los tiempos por etapa y por página y los
+      contadores del marcado. None por defecto (sin medidas ni coste añadido).
+    - incremental (bool): True copia el pdf original y añade la marca de agua al final con un guardado
+      incremental, en la capa opcional CAPA_MARCA_AGUA, de modo que el documento no se vuelve a generar y
+      solo se añade lo que ocupa la marca de agua. La copia se hace en un fichero temporal que sustituye a la
+      salida al terminar. Si el pdf ya tenía una marca de agua añadida así se sustituye, y retirar_marca_agua la quita
+      del mismo modo. La entrada y la salida pueden ser el mismo fichero. Requiere rutas, modo_mosaico
+      "plantilla" y un solo proceso, y no admite blanco_y_negro, bloques ni perfil de guardado. False por defecto.
 
     Returns:
     --------
-    - pdf con la marca de agua.
+    - estadisticas (Estadisticas): La misma instancia recibida, ya rellena, o None si no se ha pasado ninguna.
+      El pdf con la marca de agua se guarda en ruta_salida_pdf.
     """
 
-    #Abre el PDF de entrada con PyMuPDF
-    documento = fitz.open(ruta_entrada_pdf)
-    #Crea la imagen de la marca de agua
-    if not os.path.isfile(ruta_imagen):
-        imagen_marca_agua = _crear_marca_agua(texto_marca_agua, tamano_fuente, opacidad_texto, texto_mayusculas, color_texto)
-    else:
-        imagen_marca_agua = _crear_marca_agua_imagen(ruta_imagen,tamano_fuente, opacidad_texto)
-    #Crea un buffer en memoria para almacenar la imagen
-    bytes_imagen = io.BytesIO()
-    #Guarda la imagen en el buffer como PNG
-    imagen_marca_agua.save(bytes_imagen, format="PNG")
-    #Vuelve al inicio del buffer para su lectura
-    bytes_imagen.seek(0)
-    #Convierte la imagen en un Pixmap de PyMuPDF
-    pix = fitz.Pixmap(bytes_imagen.read())
-    
-    
-    #Itera sobre cada página del PDF
-    for pagina in documento:
-
-        # Si el parámetro blanco_y_negro es True, convierte la página a escala de grises
-        if blanco_y_negro:
-            pix_gris = pagina.get_pixmap(colorspace=fitz.csGRAY)  # Convertir a escala de grises
-            img_gris = fitz.Pixmap(pix_gris, 0)  # Crear un nuevo Pixmap en gris
-            pagina.insert_image(pagina.rect, pixmap=img_gris, overlay=True)  # Sobrescribir en gris
-
-        #Obtiene dimensiones de la página
-        ancho_pagina, alto_pagina = pagina.rect.width, pagina.rect.height
-        #Obtiene dimensiones de la imagen de la marca de agua
-        ancho_imagen, alto_imagen = imagen_marca_agua.size
-        
-        #Itera sobre la página y posicionar la marca de agua en mosaico
-        #Bucle horizontal
-        for x in range(0, int(ancho_pagina), ancho_imagen + espaciado_ancho):
-            #Bucle vertical 
-            for y in range(0, int(alto_pagina), alto_imagen + espaciado_alto):
-                #Crea un rectángulo en la posición deseada
-                rect = fitz.Rect(x, y, x + ancho_imagen, y + alto_imagen)
-                #Inserta la imagen en la página
-                pagina.insert_image(rect, pixmap=pix, overlay=True)
-    
+    #Se valida antes de construir la marca de agua para no hacer trabajo inútil
+    if paginas_por_bloque and num_procesos > 1:
+        raise ValueError("El procesado por bloques no se puede combinar con varios procesos")
+    if paginas_por_bloque and perfil_guardado is not None:
+        raise ValueError("El procesado por bloques no se puede combinar con un perfil de guardado")
+
+    #Toda la preparación se delega en MarcadorAgua, que aquí se usa para un único documento
+    with MarcadorAgua(texto_marca_agua, tamano_fuente, opacidad_texto, texto_mayusculas, color_texto,
+                      blanco_y_negro, ruta_imagen, espaciado_ancho, espaciado_alto, reutilizar_imagen,
+                      modo_mosaico, motor, modo_gris, dpi_gris, perfil_guardado, estadisticas, incremental) as marcador:
+        marcador.aplicar(ruta_entrada_pdf, ruta_salida_pdf, num_procesos, progreso, paginas_por_bloque, estadisticas)
 
-    #Guarda el PDF modificado con la marca de agua
-    documento.save(ruta_salida_pdf)
-    #Cierra el documentoumento
-    documento.close()
     #Mensaje de confirmación
-    print(f"Marca de agua añadida a {ruta_salida_pdf}")
+    if isinstance(ruta_salida_pdf, (str, os.PathLike)):
+        print(f"Marca de agua añadida a {ruta_salida_pdf}")
+    return estadisticas
+
+
+def anadir_marca_agua_a_bytes(
+        pdf,
+        texto_marca_agua:str,
+        tamano_fuente:int,
+        opacidad_texto:int,
+        progreso = None,
+        estadisticas:Estadisticas = None,
+        **opciones):
+
+    """
+    Función equivalente a anadir_marca_agua_a_pdf que trabaja solo en memoria: recibe el pdf y devuelve
+    el pdf marcado sin escribir ningún fichero, para servicios que reciben los pdfs por red.
+
+    Parameters:
+    ----------
+    - pdf (bytes | bytearray | memoryview | file): Contenido del pdf a marcar.
+    - texto_marca_agua (str): Texto saldrá en la marca de agua.
+    - tamano_fuente (int): Tamaño de la fuente (recomentado ente 16 y 40).
+    - opacidad_texto (int): Opacidad del texto (recomendado en 100).
+    - progreso (callable): Ver anadir_marca_agua_a_pdf. None por defecto.
+    - estadisticas (Estadisticas): Ver anadir_marca_agua_a_pdf. None por defecto.
+    - opciones: Resto de parámetros de MarcadorAgua (texto_mayusculas, color_texto, ruta_imagen, que también
+      puede ser el contenido de la imagen, etc.).
+
+    Returns:
+    --------
+    - bytes_marcado (bytes): Contenido del pdf con la marca de agua.
+    """
+
+    with MarcadorAgua(texto_marca_agua, tamano_fuente, opacidad_texto, estadisticas=estadisticas,
+                      **opciones) as marcador:
+        return marcador.aplicar_bytes(pdf, progreso, estadisticas)
 
 #------------------------------- FIN DEL CODIGO ---------------------------------------
 
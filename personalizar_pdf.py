@@ -0,0 +1,328 @@
+"""
+Modulo que contiene la generación de muchas variantes de un mismo pdf, cada una con la marca de agua
+de un destinatario distinto. El pdf se lee, se convierte a escala de grises y se coloca el mosaico en
+cada página una sola vez; en cada variante solo se construye la marca de agua de su texto y se cambia
+el contenido del mosaico, que comparten todas las páginas del mismo tamaño.
+
+Ejemplo:
+    python personalizar_pdf.py contrato.pdf destinatarios.txt -o salida --tamano 20 --procesos 4
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import fitz
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from marcar_agua_pdf import (MarcadorAgua, PERFILES_GUARDADO, _abrir_pdf, _convertir_documento_a_gris,
+                             _convertir_pagina_a_gris_raster, _crear_plantillas, _matriz_insercion,
+                             _tamanos_pagina)
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+#Disposición del pdf ya preparado, opciones y directorio de salida de cada proceso, fijados por _iniciar_proceso
+_trabajo = None
+
+
+def _preparar_fuente(pdf, blanco_y_negro:bool = False, modo_gris:str = "vectorial", dpi_gris:int = 72):
+    """
+    Función que lee el pdf de origen y, si hace falta, lo convierte a escala de grises. Es la parte común
+    a todas las variantes, por eso se hace una sola vez.
+
+    Parameters:
+    ----------
+    - pdf (str | bytes | file): Ruta del pdf o su contenido en memoria.
+    - blanco_y_negro (bool): True convierte el pdf a escala de grises. False por defecto.
+    - modo_gris (str): "vectorial" o "raster", ver anadir_marca_agua_a_pdf. "vectorial" por defecto.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster". 72 por defecto.
+
+    Returns:
+    --------
+    - bytes_pdf (bytes): Contenido del pdf listo para marcar.
+    """
+
+    with _abrir_pdf(pdf) as documento:
+        if blanco_y_negro:
+            if modo_gris == "vectorial":
+                _convertir_documento_a_gris(documento)
+            else:
+                for pagina in documento:
+                    _convertir_pagina_a_gris_raster(pagina, dpi_gris)
+        return documento.tobytes(**PERFILES_GUARDADO["equilibrado"])
+
+
+def _preparar_disposicion(bytes_pdf:bytes):
+    """
+    Función que coloca en cada página del pdf preparado un mosaico vacío, con una sola colocación por
+    página como en el modo "plantilla". Todas las páginas del mismo tamaño comparten el Form XObject
+    del mosaico, así que cada variante solo tiene que rellenar uno por tamaño de página.
+
+    Parameters:
+    ----------
+    - bytes_pdf (bytes): Contenido del pdf listo para marcar.
+
+    Returns:
+    --------
+    - disposicion (tuple[bytes, dict]): Contenido del pdf con los mosaicos vacíos y referencia (xref) del
+      Form XObject del mosaico de cada tamaño de página.
+    """
+
+    with fitz.open("pdf", bytes_pdf) as documento:
+        with fitz.open() as huecos:
+            paginas_hueco = {clave: huecos.new_page(width=clave[0], height=clave[1]).number
+                             for clave in _tamanos_pagina(documento, range(len(documento)))}
+            bytes_huecos = huecos.tobytes()
+        formularios = {}
+        with fitz.open("pdf", bytes_huecos) as huecos:
+            for pagina in documento:
+                clave = (round(pagina.rect.width, 2), round(pagina.rect.height, 2))
+                #show_pdf_page devuelve el Form XObject con el contenido de la página de origen, el mismo para
+                #todas las colocaciones de esa página
+                formularios[clave] = pagina.show_pdf_page(pagina.rect * _matriz_insercion(pagina), huecos,
+                                                          paginas_hueco[clave], overlay=True, rotate=pagina.rotation)
+        #Se guarda sin recolección de objetos para que las referencias de los Form XObject no cambien
+        return documento.tobytes(), formularios
+
+
+def _estampar_variante(disposicion:tuple, marcador:MarcadorAgua):
+    """
+    Función que rellena los mosaicos vacíos de la disposición con las plantillas de la marca de agua del
+    marcador, sin volver a recorrer las páginas.
+
+    Parameters:
+    ----------
+    - disposicion (tuple[bytes, dict]): Pdf con los mosaicos vacíos, ver _preparar_disposicion.
+    - marcador (MarcadorAgua): Marcador en modo "plantilla" con la marca de agua de la variante.
+
+    Returns:
+    --------
+    - bytes_variante (bytes): Contenido del pdf marcado.
+    """
+
+    bytes_disposicion, formularios = disposicion
+    plantillas, paginas_plantilla = _crear_plantillas(formularios, marcador.pix, marcador.ancho_imagen,
+                                                      marcador.alto_imagen, marcador.opciones["espaciado_ancho"],
+                                                      marcador.opciones["espaciado_alto"],
+                                                      marcador.opciones["reutilizar_imagen"])
+    with plantillas, fitz.open("pdf", bytes_disposicion) as documento:
+        #Se copian las plantillas al final del documento para traer sus imágenes y fuentes, y el contenido
+        #y los recursos de cada una pasan al Form XObject del mosaico de su tamaño
+        primera = len(documento)
+        documento.insert_pdf(plantillas)
+        sobrantes = []
+        for clave, xref in formularios.items():
+            pagina = documento[primera + paginas_plantilla[clave]]
+            documento.update_stream(xref, pagina.read_contents())
+            documento.xref_set_key(xref, "Resources", documento.xref_get_key(pagina.xref, "Resources")[1])
+            sobrantes += [pagina.xref, *pagina.get_contents()]
+        documento.delete_pages(range(primera, len(documento)))
+        #Las páginas copiadas y sus flujos ya no se usan, y sin recolección de objetos se guardarían igualmente
+        for xref in sobrantes:
+            documento.update_object(xref, "null")
+        return documento.tobytes(**PERFILES_GUARDADO.get(marcador.perfil_guardado, {}))
+
+
+def _nombre_variante(indice:int, texto:str):
+    """Devuelve el nombre del pdf de una variante: su número y el texto sin caracteres problemáticos."""
+    limpio = re.sub(r"[^\w\-]+", "_", texto).strip("_")[:60]
+    return f"{indice:04d}_{limpio}.pdf" if limpio else f"{indice:04d}.pdf"
+
+
+def _generar_variante(disposicion:tuple, opciones:dict, directorio_salida:str, indice:int, texto:str):
+    """
+    Función que genera una variante: construye la marca de agua del texto y la estampa en el pdf preparado.
+
+    Parameters:
+    ----------
+    - disposicion (tuple[bytes, dict]): Pdf preparado y Form XObject de cada tamaño de página, ver
+      _preparar_disposicion. Si no hay Form XObject (None) el mosaico se coloca página a página.
+    - opciones (dict): Parámetros de MarcadorAgua comunes a todas las variantes.
+    - directorio_salida (str): Directorio donde se guarda la variante, None para devolverla.
+    - indice (int): Número de la variante.
+    - texto (str): Texto de la marca de agua.
+
+    Returns:
+    --------
+    - resultado (tuple[int, str, bytes, str]): Índice, texto, contenido del pdf marcado y mensaje de error
+      (None si no hay). Si hay directorio de salida o error el contenido es None, para no enviarlo de
+      vuelta entre procesos.
+    """
+
+    try:
+        bytes_pdf, formularios = disposicion
+        with MarcadorAgua(texto, **opciones) as marcador:
+            if formularios is None:
+                bytes_variante = marcador.aplicar_bytes(bytes_pdf)
+            else:
+                bytes_variante = _estampar_variante(disposicion, marcador)
+        if directorio_salida is None:
+            return indice, texto, bytes_variante, None
+        with open(os.path.join(directorio_salida, _nombre_variante(indice, texto)), "wb") as fichero:
+            fichero.write(bytes_variante)
+        return indice, texto, None, None
+    except Exception as e:
+        return indice, texto, None, str(e)
+
+
+def _iniciar_proceso(disposicion:tuple, opciones:dict, directorio_salida:str):
+    """Recibe una sola vez en cada proceso el pdf preparado y las opciones comunes a todas las variantes."""
+    global _trabajo
+    _trabajo = (disposicion, opciones, directorio_salida)
+
+
+def _generar_variante_en_proceso(indice:int, texto:str):
+    """Genera una variante con el trabajo recibido por _iniciar_proceso."""
+    return _generar_variante(*_trabajo, indice, texto)
+
+
+def generar_variantes(pdf,
+                      textos,
+                      tamano_fuente:int,
+                      opacidad_texto:int,
+                      directorio_salida:str = None,
+                      al_generar = None,
+                      num_procesos:int = 1,
+                      blanco_y_negro:bool = False,
+                      modo_gris:str = "vectorial",
+                      dpi_gris:int = 72,
+                      **opciones):
+    """
+    Función que genera una variante del pdf por cada texto, cada una con su propia marca de agua. El pdf
+    se lee, se pasa a escala de grises y se coloca el mosaico en cada página una sola vez; cada variante
+    solo construye la marca de agua de su texto, una plantilla por tamaño de página y el guardado. Las
+    variantes se guardan en un directorio o se van entregando a una función a medida que están listas,
+    sin acumularlas en memoria. Una variante que falla no detiene las demás: se anota en los errores.
+
+    Parameters:
+    ----------
+    - pdf (str | bytes | file): Ruta del pdf de origen o su contenido en memoria.
+    - textos (iterable[str]): Texto de la marca de agua de cada variante, por ejemplo el nombre del destinatario.
+    - tamano_fuente (int): Tamaño de la fuente (recomentado ente 16 y 40).
+    - opacidad_texto (int): Opacidad de la marca de agua entre 0 y 255.
+    - directorio_salida (str): Directorio donde se guardan las variantes como "0000_texto.pdf". Se crea si no existe.
+    - al_generar (callable): Función al_generar(indice, texto, bytes_pdf) que recibe en orden cada variante
+      generada. Se debe indicar esta o directorio_salida, no las dos.
+    - num_procesos (int): Número de procesos que generan variantes a la vez. 1 por defecto.
+    - blanco_y_negro (bool): True convierte el pdf a escala de grises. False por defecto.
+    - modo_gris (str): "vectorial" o "raster", ver anadir_marca_agua_a_pdf. "vectorial" por defecto.
+    - dpi_gris (int): Resolución de las páginas en el modo de gris "raster". 72 por defecto.
+    - opciones: Resto de parámetros de MarcadorAgua (color_texto, texto_mayusculas, espaciado_ancho...).
+      Con modo_mosaico="imagen" el mosaico se coloca página a página en cada variante.
+
+    Returns:
+    --------
+    - resumen (dict): Número de variantes generadas, errores como (indice, texto, mensaje), segundos
+      totales y variantes por segundo.
+    """
+
+    if (directorio_salida is None) == (al_generar is None):
+        raise ValueError("Se debe indicar un directorio de salida o una función al_generar, y solo una de ellas")
+    if modo_gris not in ("vectorial", "raster"):
+        raise ValueError(f"Modo de gris no válido: {modo_gris}")
+    if directorio_salida is not None:
+        os.makedirs(directorio_salida, exist_ok=True)
+
+    inicio = time.perf_counter()
+    bytes_pdf = _preparar_fuente(pdf, blanco_y_negro, modo_gris, dpi_gris)
+    opciones = dict(opciones, tamano_fuente=tamano_fuente, opacidad_texto=opacidad_texto)
+    if opciones.get("modo_mosaico", "plantilla") == "plantilla" and not opciones.get("incremental"):
+        disposicion = _preparar_disposicion(bytes_pdf)
+    else:
+        disposicion = (bytes_pdf, None)
+
+    variantes = 0
+    errores = []
+
+    def entregar(indice, texto, bytes_variante, error):
+        nonlocal variantes
+        if error is not None:
+            errores.append((indice, texto, error))
+            return
+        variantes += 1
+        if al_generar is not None:
+            al_generar(indice, texto, bytes_variante)
+
+    if num_procesos <= 1:
+        for indice, texto in enumerate(textos):
+            entregar(*_generar_variante(disposicion, opciones, directorio_salida, indice, texto))
+    else:
+        #Los textos se envían a medida que terminan las variantes, con como mucho dos por proceso por delante,
+        #así no se leen todos de golpe ni se acumulan en memoria las variantes que esperan su turno
+        pendientes = enumerate(textos)
+        futuros = deque()
+        with ProcessPoolExecutor(max_workers=num_procesos, initializer=_iniciar_proceso,
+                                 initargs=(disposicion, opciones, directorio_salida)) as ejecutor:
+            while True:
+                while len(futuros) < 2 * num_procesos:
+                    siguiente = next(pendientes, None)
+                    if siguiente is None:
+                        break
+                    futuros.append(ejecutor.submit(_generar_variante_en_proceso, *siguiente))
+                if not futuros:
+                    break
+                entregar(*futuros.popleft().result())
+
+    segundos = time.perf_counter() - inicio
+    return {"variantes": variantes, "errores": errores, "segundos": segundos,
+            "variantes_por_segundo": variantes / segundos if segundos > 0 else 0.0}
+
+
+def _crear_parser():
+    """Crea el analizador de argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Genera una copia del pdf por destinatario, cada una con su "
+                                                 "nombre como marca de agua.")
+    parser.add_argument("pdf", help="Pdf de origen.")
+    parser.add_argument("destinatarios", help="Fichero de texto con un destinatario por línea.")
+    parser.add_argument("-o", "--salida", required=True, help="Directorio donde se guardarán las variantes.")
+    parser.add_argument("--tamano", type=int, default=16, help="Tamaño de la fuente.")
+    parser.add_argument("--opacidad", type=int, default=100, help="Opacidad entre 0 y 255.")
+    parser.add_argument("--mayusculas", action="store_true", help="Pone el texto en mayúsculas.")
+    parser.add_argument("--blanco-y-negro", action="store_true", help="Convierte el pdf a escala de grises.")
+    parser.add_argument("--perfil-guardado", choices=tuple(PERFILES_GUARDADO), default="equilibrado",
+                        help="Compromiso entre tiempo de guardado y tamaño de cada variante.")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1,
+                        help="Número de variantes que se generan a la vez. Por defecto, una por núcleo.")
+    return parser
+
+
+def main(argumentos: list[str] = None):
+    """
+    Función principal de la línea de comandos.
+
+    Parameters:
+    ----------
+    - argumentos (list[str]): Argumentos a analizar. Por defecto, los de sys.argv.
+
+    Returns:
+    --------
+    - codigo (int): 0 si se han generado todas las variantes, 1 en caso contrario.
+    """
+
+    args = _crear_parser().parse_args(argumentos)
+    with open(args.destinatarios, encoding="utf-8") as fichero:
+        textos = [linea.strip() for linea in fichero if linea.strip()]
+    if not textos:
+        print("No hay ningún destinatario.", file=sys.stderr)
+        return 1
+
+    resumen = generar_variantes(args.pdf, textos, args.tamano, args.opacidad, directorio_salida=args.salida,
+                                num_procesos=args.procesos, blanco_y_negro=args.blanco_y_negro,
+                                texto_mayusculas=args.mayusculas, perfil_guardado=args.perfil_guardado)
+    for indice, texto, error in resumen["errores"]:
+        print(f"{'error':>10} | {indice:04d} {texto} | {error}", file=sys.stderr)
+    print(f"Variantes: {resumen['variantes']}, con error: {len(resumen['errores'])} | "
+          f"Tiempo total: {resumen['segundos']:.2f}s | {resumen['variantes_por_segundo']:.1f} variantes/s")
+    return 0 if resumen["variantes"] == len(textos) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
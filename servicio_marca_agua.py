@@ -0,0 +1,355 @@
+"""
+Modulo que contiene un servicio HTTP local para añadir marcas de agua a pdfs recibidos por red.
+Escucha en un puerto TCP o en un socket Unix, procesa los pdfs en un conjunto acotado de procesos
+y rechaza las peticiones con 503 cuando la cola está llena, en lugar de acumularlas.
+
+Ejemplo:
+    python servicio_marca_agua.py --puerto 8080 --procesos 4 --cola 16
+    curl --data-binary @factura.pdf "http://localhost:8080/marcar?texto=Confidencial&tamano=30" -o marcada.pdf
+    curl http://localhost:8080/estadisticas
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import multiprocessing
+import fitz
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit, parse_qs
+from marcar_agua_pdf import MarcadorAgua, PERFILES_GUARDADO
+from utilidades_marca_agua import percentiles_ms
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+
+#Tamaño de los trozos en los que se envía el pdf marcado
+TAMANO_TROZO = 64 * 1024
+
+#Segundos que se espera a recibir la cabecera o el pdf de una petición antes de abandonarla
+TIEMPO_LECTURA = 30
+
+#Número de peticiones recientes con las que se calculan los percentiles de latencia
+MUESTRAS_LATENCIA = 1000
+
+_MENSAJES_HTTP = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                  408: "Request Timeout", 411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error",
+                  503: "Service Unavailable"}
+
+#Marcas de agua ya preparadas en cada proceso, por parámetros. Se descartan las menos usadas
+_marcadores = OrderedDict()
+_MAX_MARCADORES = 8
+
+
+def _marcar_en_proceso(bytes_pdf: bytes, parametros: dict):
+    """
+    Función que se ejecuta en los procesos del servicio y marca un pdf en memoria. La marca de agua
+    se prepara una sola vez por proceso para cada combinación de parámetros.
+
+    Parameters:
+    ----------
+    - bytes_pdf (bytes): Contenido del pdf.
+    - parametros (dict): Parámetros de MarcadorAgua.
+
+    Returns:
+    --------
+    - bytes_marcado (bytes): Contenido del pdf con la marca de agua. Lanza ValueError si los parámetros
+      no son válidos o si el contenido no es un pdf.
+    """
+
+    clave = tuple(sorted(parametros.items()))
+    marcador = _marcadores.get(clave)
+    if marcador is None:
+        marcador = MarcadorAgua(**parametros)
+        _marcadores[clave] = marcador
+        if len(_marcadores) > _MAX_MARCADORES:
+            _marcadores.popitem(last=False)[1].cerrar()
+    else:
+        _marcadores.move_to_end(clave)
+    try:
+        return marcador.aplicar_bytes(bytes_pdf)
+    except fitz.FileDataError as e:
+        #Se devuelve como ValueError, que el servicio traduce a 400, porque el error es del pdf recibido
+        raise ValueError(f"El contenido recibido no es un pdf válido: {e}") from None
+
+
+def _leer_parametros(consulta: str):
+    """
+    Función que convierte la consulta de la URL en los parámetros de MarcadorAgua.
+
+    Parameters:
+    ----------
+    - consulta (str): Parte de la URL tras el "?", por ejemplo "texto=Confidencial&tamano=30".
+
+    Returns:
+    --------
+    - parametros (dict): Parámetros de MarcadorAgua. Lanza ValueError si alguno no es válido.
+    """
+
+    valores = {clave: lista[-1] for clave, lista in parse_qs(consulta).items()}
+    texto = valores.get("texto", "")
+    if not texto.strip():
+        raise ValueError("Falta el parámetro texto")
+    color = tuple(int(canal) for canal in valores.get("color", "255,0,0").split(","))
+    if len(color) != 3 or not all(0 <= canal <= 255 for canal in color):
+        raise ValueError(f"Color no válido: {valores['color']}")
+    perfil = valores.get("perfil", "equilibrado")
+    if perfil not in PERFILES_GUARDADO:
+        raise ValueError(f"Perfil de guardado no válido: {perfil}")
+    modo_mosaico = valores.get("modo_mosaico", "plantilla")
+    if modo_mosaico not in ("imagen", "plantilla"):
+        raise ValueError(f"Modo de mosaico no válido: {modo_mosaico}")
+    motor = valores.get("motor", "raster")
+    if motor not in ("raster", "vectorial"):
+        raise ValueError(f"Motor de marca de agua no válido: {motor}")
+    return {
+        "texto_marca_agua": texto,
+        "tamano_fuente": int(valores.get("tamano", 16)),
+        "opacidad_texto": int(valores.get("opacidad", 100)),
+        "texto_mayusculas": valores.get("mayusculas", "0") in ("1", "true", "si"),
+        "color_texto": color,
+        "blanco_y_negro": valores.get("blanco_y_negro", "0") in ("1", "true", "si"),
+        "espaciado_ancho": int(valores.get("espaciado_ancho", 10)),
+        "espaciado_alto": int(valores.get("espaciado_alto", 1)),
+        "modo_mosaico": modo_mosaico,
+        "motor": motor,
+        "perfil_guardado": perfil,
+    }
+
+
+class ServicioMarcaAgua:
+    """
+    Clase que implementa el servicio. Como mucho procesa a la vez tantos pdfs como procesos, deja
+    esperando otros max_cola y responde 503 al resto sin llegar a leer el pdf.
+
+    Parameters:
+    ----------
+    - procesos (int): Número de procesos que marcan pdfs. 2 por defecto.
+    - max_cola (int): Peticiones que pueden esperar a un proceso libre. 8 por defecto.
+    - max_bytes (int): Tamaño máximo del pdf recibido. 100 MB por defecto.
+    - tiempo_lectura (float): Segundos para recibir la cabecera y el pdf. TIEMPO_LECTURA por defecto.
+    """
+
+    def __init__(self, procesos: int = 2, max_cola: int = 8, max_bytes: int = 100 * 2**20,
+                 tiempo_lectura: float = TIEMPO_LECTURA):
+        self.procesos = procesos
+        self.max_cola = max_cola
+        self.max_bytes = max_bytes
+        self.tiempo_lectura = tiempo_lectura
+        self.ejecutor = None
+        self.servidor = None
+        #Deja pasar al ejecutor tantas peticiones como procesos, el resto esperan su turno en la cola
+        self.turnos = None
+        #Peticiones admitidas que todavía no han terminado (en cola o en proceso)
+        self.admitidas = 0
+        self.en_proceso = 0
+        self.contadores = {"completadas": 0, "rechazadas": 0, "errores": 0}
+        self.latencias = deque(maxlen=MUESTRAS_LATENCIA)
+        self.tiempos_proceso = deque(maxlen=MUESTRAS_LATENCIA)
+
+    async def iniciar(self, host: str = "127.0.0.1", puerto: int = 8080, ruta_socket: str = None):
+        """
+        Método que arranca los procesos y empieza a escuchar.
+
+        Parameters:
+        ----------
+        - host (str): Dirección en la que se escucha. Solo local por defecto.
+        - puerto (int): Puerto TCP. 8080 por defecto.
+        - ruta_socket (str): Si se indica, se escucha en este socket Unix en lugar de en TCP.
+        """
+
+        self.ejecutor = self._crear_ejecutor()
+        self.turnos = asyncio.Semaphore(self.procesos)
+        if ruta_socket:
+            self.servidor = await asyncio.start_unix_server(self._atender, path=ruta_socket)
+        else:
+            self.servidor = await asyncio.start_server(self._atender, host, puerto)
+
+    def _crear_ejecutor(self):
+        """Crea el conjunto de procesos que marcan los pdfs."""
+        #Los procesos se crean con spawn para que no hereden los sockets abiertos del servicio: con fork, las
+        #conexiones no se cerrarían del todo mientras vivan los procesos
+        return ProcessPoolExecutor(max_workers=self.procesos, mp_context=multiprocessing.get_context("spawn"))
+
+    async def cerrar(self):
+        """Método que deja de aceptar conexiones y espera a que terminen los procesos."""
+        if self.servidor is not None:
+            self.servidor.close()
+            await self.servidor.wait_closed()
+        if self.ejecutor is not None:
+            self.ejecutor.shutdown(wait=True)
+
+    def estadisticas(self):
+        """
+        Método que devuelve el estado del servicio: peticiones en cola y en proceso, contadores y
+        percentiles de latencia (total y solo de proceso) en milisegundos sobre las últimas peticiones.
+        """
+
+        return {
+            "en_cola": self.admitidas - self.en_proceso,
+            "en_proceso": self.en_proceso,
+            "procesos": self.procesos,
+            "max_cola": self.max_cola,
+            **self.contadores,
+            "latencia_ms": percentiles_ms(self.latencias),
+            "proceso_ms": percentiles_ms(self.tiempos_proceso),
+        }
+
+    async def _responder(self, escritor, estado: int, cuerpo: bytes = b"", tipo: str = "application/json",
+                         cabeceras: dict = None):
+        """Envía una respuesta HTTP completa. El cuerpo se escribe por trozos respetando el ritmo del cliente."""
+        lineas = [f"HTTP/1.1 {estado} {_MENSAJES_HTTP[estado]}", f"Content-Type: {tipo}",
+                  f"Content-Length: {len(cuerpo)}", "Connection: close"]
+        lineas += [f"{nombre}: {valor}" for nombre, valor in (cabeceras or {}).items()]
+        escritor.write(("\r\n".join(lineas) + "\r\n\r\n").encode("latin-1"))
+        vista = memoryview(cuerpo)
+        for inicio in range(0, len(vista), TAMANO_TROZO):
+            escritor.write(vista[inicio:inicio + TAMANO_TROZO])
+            await escritor.drain()
+        await escritor.drain()
+
+    async def _responder_error(self, escritor, estado: int, mensaje: str, cabeceras: dict = None):
+        """Envía un error con su mensaje en JSON."""
+        await self._responder(escritor, estado, json.dumps({"error": mensaje}, ensure_ascii=False).encode("utf-8"),
+                              cabeceras=cabeceras)
+
+    async def _atender(self, lector, escritor):
+        """Atiende una conexión: una única petición HTTP, tras la que se cierra la conexión."""
+        try:
+            try:
+                cabecera = await asyncio.wait_for(lector.readuntil(b"\r\n\r\n"), self.tiempo_lectura)
+                linea, *lineas_cabecera = cabecera.decode("latin-1").split("\r\n")
+                metodo, url, _ = linea.split(" ", 2)
+            except asyncio.TimeoutError:
+                await self._responder_error(escritor, 408, "No se ha recibido la petición a tiempo")
+                return
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                await self._responder_error(escritor, 400, "Petición HTTP no válida")
+                return
+            cabeceras = {}
+            for linea_cabecera in lineas_cabecera:
+                if ":" in linea_cabecera:
+                    nombre, valor = linea_cabecera.split(":", 1)
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+            ruta = urlsplit(url)
+
+            if ruta.path == "/estadisticas":
+                await self._responder(escritor, 200, json.dumps(self.estadisticas()).encode("utf-8"))
+            elif ruta.path != "/marcar":
+                await self._responder_error(escritor, 404, f"Ruta desconocida: {ruta.path}")
+            elif metodo != "POST":
+                await self._responder_error(escritor, 405, "Solo se admite POST", {"Allow": "POST"})
+            else:
+                await self._marcar(lector, escritor, ruta.query, cabeceras)
+        except ConnectionError:
+            pass
+        finally:
+            escritor.close()
+
+    async def _marcar(self, lector, escritor, consulta: str, cabeceras: dict):
+        """Atiende una petición de marcado: admisión, lectura del pdf, proceso y envío del resultado."""
+        try:
+            parametros = _leer_parametros(consulta)
+        except ValueError as e:
+            await self._responder_error(escritor, 400, str(e))
+            return
+        if not cabeceras.get("content-length", "").isdigit():
+            await self._responder_error(escritor, 411, "Falta la cabecera Content-Length")
+            return
+        longitud = int(cabeceras["content-length"])
+        if longitud > self.max_bytes:
+            await self._responder_error(escritor, 413, f"El pdf supera {self.max_bytes} bytes")
+            return
+        #Control de admisión: si ya hay una petición por proceso y la cola está llena se rechaza sin leer el pdf
+        if self.admitidas >= self.procesos + self.max_cola:
+            self.contadores["rechazadas"] += 1
+            await self._responder_error(escritor, 503, "Servicio saturado, inténtalo más tarde", {"Retry-After": "1"})
+            return
+
+        self.admitidas += 1
+        inicio = time.perf_counter()
+        try:
+            #Un cliente lento no puede retener la plaza más de tiempo_lectura segundos
+            bytes_pdf = await asyncio.wait_for(lector.readexactly(longitud), self.tiempo_lectura)
+            async with self.turnos:
+                self.en_proceso += 1
+                ejecutor = self.ejecutor
+                try:
+                    inicio_proceso = time.perf_counter()
+                    bytes_marcado = await asyncio.get_running_loop().run_in_executor(ejecutor, _marcar_en_proceso,
+                                                                                     bytes_pdf, parametros)
+                    self.tiempos_proceso.append(time.perf_counter() - inicio_proceso)
+                finally:
+                    self.en_proceso -= 1
+        except asyncio.IncompleteReadError:
+            self.contadores["errores"] += 1
+            return
+        except asyncio.TimeoutError:
+            self.contadores["errores"] += 1
+            await self._responder_error(escritor, 408, "No se ha recibido el pdf a tiempo")
+            return
+        except ValueError as e:
+            self.contadores["errores"] += 1
+            await self._responder_error(escritor, 400, str(e))
+            return
+        except BrokenProcessPool:
+            #Un proceso ha caído (por ejemplo, con un pdf que rompe MuPDF): el conjunto ya no admite trabajos y
+            #se sustituye por uno nuevo, solo una vez aunque fallen a la vez varias peticiones
+            self.contadores["errores"] += 1
+            if ejecutor is self.ejecutor:
+                ejecutor.shutdown(wait=False)
+                self.ejecutor = self._crear_ejecutor()
+            await self._responder_error(escritor, 500, "Un proceso de marcado ha terminado de forma inesperada")
+            return
+        except Exception as e:
+            self.contadores["errores"] += 1
+            await self._responder_error(escritor, 500, str(e))
+            return
+        finally:
+            self.admitidas -= 1
+
+        await self._responder(escritor, 200, bytes_marcado, "application/pdf")
+        self.contadores["completadas"] += 1
+        self.latencias.append(time.perf_counter() - inicio)
+
+
+def _crear_parser():
+    """Crea el analizador de argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Servicio HTTP local que añade marcas de agua a pdfs.")
+    parser.add_argument("--host", default="127.0.0.1", help="Dirección en la que se escucha.")
+    parser.add_argument("--puerto", type=int, default=8080)
+    parser.add_argument("--socket", help="Escucha en este socket Unix en lugar de en TCP.")
+    parser.add_argument("--procesos", type=int, default=2, help="Pdfs que se procesan a la vez.")
+    parser.add_argument("--cola", type=int, default=8, help="Peticiones que pueden esperar antes de rechazar con 503.")
+    parser.add_argument("--max-mb", type=int, default=100, help="Tamaño máximo del pdf recibido en MB.")
+    parser.add_argument("--tiempo-lectura", type=float, default=TIEMPO_LECTURA,
+                        help="Segundos para recibir la petición antes de responder 408.")
+    return parser
+
+
+async def _servir(args):
+    """Arranca el servicio con los argumentos de la línea de comandos y lo mantiene hasta que se interrumpe."""
+    servicio = ServicioMarcaAgua(args.procesos, args.cola, args.max_mb * 2**20, args.tiempo_lectura)
+    await servicio.iniciar(args.host, args.puerto, args.socket)
+    print(f"Escuchando en {args.socket or f'http://{args.host}:{args.puerto}'}")
+    try:
+        await servicio.servidor.serve_forever()
+    finally:
+        await servicio.cerrar()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_servir(_crear_parser().parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(0)
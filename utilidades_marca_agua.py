@@ -0,0 +1,84 @@
+"""
+Modulo que contiene las utilidades comunes a la línea de comandos, el servicio HTTP y la vigilancia de
+carpetas: el marcado de un pdf dentro de un proceso del conjunto de procesos, que reutiliza la marca de
+agua y la caché de salidas del proceso, y los percentiles de los tiempos de las estadísticas.
+"""
+
+import time
+import fitz
+from marcar_agua_pdf import MarcadorAgua, Estadisticas
+from cache_salidas import CacheSalidas, marcar_con_cache
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+#Marca de agua y caché de salidas de cada proceso. Se preparan con el primer pdf y se reutilizan para el resto
+_marcador = None
+_cache = None
+
+
+def _obtener_marcador(parametros: dict):
+    """Devuelve la marca de agua del proceso, preparándola la primera vez."""
+    global _marcador
+    if _marcador is None:
+        _marcador = MarcadorAgua(**parametros)
+    return _marcador
+
+
+def procesar_pdf(ruta_entrada: str, ruta_salida: str, parametros: dict, medir: bool = False,
+                 cache: tuple[str, int] = None):
+    """
+    Función que se ejecuta en cada proceso y marca un único pdf con la marca de agua del proceso.
+
+    Parameters:
+    ----------
+    - ruta_entrada (str): Ruta del pdf original.
+    - ruta_salida (str): Ruta del pdf con la marca de agua.
+    - parametros (dict): Parámetros de MarcadorAgua. Son los mismos en todas las llamadas de una ejecución.
+    - medir (bool): True devuelve también las estadísticas del marcado. False por defecto.
+    - cache (tuple[str, int]): Directorio y tamaño máximo en bytes de la caché de salidas. None no la usa.
+
+    Returns:
+    --------
+    - resultado (tuple[str, int, float, str, dict, bool]): Ruta, páginas, segundos, mensaje de error (None si
+      no hay), resumen de las estadísticas (None si no se han pedido) y si la salida venía de la caché.
+    """
+
+    global _cache
+    inicio = time.perf_counter()
+    try:
+        with fitz.open(ruta_entrada) as documento:
+            num_paginas = len(documento)
+        if cache is not None and not medir:
+            if _cache is None:
+                _cache = CacheSalidas(*cache)
+            acierto = marcar_con_cache(_cache, lambda: _obtener_marcador(parametros), ruta_entrada, ruta_salida,
+                                       parametros)
+            return ruta_entrada, num_paginas, time.perf_counter() - inicio, None, None, acierto
+        estadisticas = _obtener_marcador(parametros).aplicar(ruta_entrada, ruta_salida,
+                                                             estadisticas=Estadisticas() if medir else None)
+        resumen = estadisticas.resumen() if estadisticas is not None else None
+        return ruta_entrada, num_paginas, time.perf_counter() - inicio, None, resumen, False
+    except Exception as e:
+        #No se borra nada: el marcado escribe en un fichero temporal y solo sustituye la salida si termina,
+        #así que la salida anterior (o el propio pdf de entrada, si es el mismo fichero) sigue intacta
+        return ruta_entrada, 0, time.perf_counter() - inicio, str(e), None, False
+
+
+def percentiles_ms(segundos):
+    """
+    Función que devuelve los percentiles 50, 90 y 99 en milisegundos de una serie de tiempos en segundos,
+    por el método del rango más cercano. Son None si todavía no hay tiempos.
+    """
+
+    valores = sorted(segundos)
+    if not valores:
+        return {"p50": None, "p90": None, "p99": None}
+    return {f"p{percentil}": valores[max(0, -(-percentil * len(valores) // 100) - 1)] * 1000
+            for percentil in (50, 90, 99)}
@@ -0,0 +1,623 @@
+"""
+Modulo que contiene la vigilancia de una carpeta en la que los escáneres dejan pdfs. Cada pdf que termina
+de escribirse se marca con un perfil guardado en JSON en un conjunto acotado de procesos, y después el
+original se mueve a "hechos" o a "fallidos". El estado de cada pdf se guarda en disco, de modo que al
+reiniciar no se vuelve a procesar ni se pierde ninguno, y un fichero de estado informa de los pdfs
+pendientes y del rendimiento.
+
+En Linux los pdfs nuevos se detectan con inotify; en otros sistemas, o en carpetas de red donde inotify
+no ve lo que escriben otros equipos (usar --sondeo), se recorre la carpeta cada pocos segundos.
+
+Ejemplo:
+    python vigilar_carpeta.py /srv/escaner --perfil perfil.json --destino /srv/marcados --procesos 4
+
+Con perfil.json, por ejemplo:
+    {"texto_marca_agua": "Confidencial", "tamano_fuente": 30, "opacidad_texto": 100, "color_texto": [255, 0, 0]}
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import shutil
+import signal
+import socket
+import struct
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from marcar_agua_pdf import MarcadorAgua
+from utilidades_marca_agua import procesar_pdf, percentiles_ms
+
+__author__ = "Adrian Mateos"
+__copyright__ = "Copyright 2025"
+__credits__ = []
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = ""
+__email__ = "https://github.com/moraloamg"
+__status__ = "Completed"
+
+
+#Eventos de inotify (ver inotify(7)). Un pdf está completo al cerrarse tras escribirlo o al moverse a la carpeta
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+_CABECERA_EVENTO = struct.Struct("iIII")
+
+#Cada cuánto se recorre la carpeta entera aunque se use inotify, por si se ha perdido algún evento
+SEGUNDOS_REVISION = 30.0
+
+#Segundos que un pdf estable sin "%%EOF" al final espera antes de procesarse igualmente (y seguramente fallar)
+ESPERA_MAXIMA_EOF = 60.0
+
+#Veces que se intenta un pdf que se interrumpe (proceso caído o servicio detenido) antes de darlo por fallido
+MAX_INTENTOS = 3
+
+#Ventana en segundos sobre la que se calcula el rendimiento del fichero de estado
+VENTANA_RENDIMIENTO = 600.0
+
+#Cada cuánto se reescribe el fichero de estado
+SEGUNDOS_ESTADO = 1.0
+
+
+class _Inotify:
+    """
+    Clase que vigila un directorio con inotify a través de ctypes. Lanza OSError si el sistema no lo
+    permite (no es Linux, no hay libc o se ha alcanzado el límite de vigilancias).
+    """
+
+    modo = "inotify"
+
+    def __init__(self, directorio: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify no está disponible")
+        #IN_NONBLOCK e IN_CLOEXEC valen lo mismo que O_NONBLOCK y O_CLOEXEC
+        self.fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "No se ha podido iniciar inotify")
+        if inotify_add_watch(self.fd, os.fsencode(directorio), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            codigo = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(codigo, f"No se ha podido vigilar {directorio}")
+
+    def leer(self):
+        """
+        Método que lee los eventos pendientes.
+
+        Returns:
+        --------
+        - eventos (dict[str, bool]): Nombre de cada fichero afectado y si ya está completo (cerrado tras
+          escribirlo o movido a la carpeta). None si se han perdido eventos y hay que revisar la carpeta.
+        """
+
+        eventos = {}
+        while True:
+            try:
+                datos = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return eventos
+            posicion = 0
+            while posicion < len(datos):
+                _, mascara, _, longitud = _CABECERA_EVENTO.unpack_from(datos, posicion)
+                posicion += _CABECERA_EVENTO.size
+                nombre = os.fsdecode(datos[posicion:posicion + longitud].rstrip(b"\0"))
+                posicion += longitud
+                if mascara & IN_Q_OVERFLOW:
+                    return None
+                if nombre:
+                    eventos[nombre] = eventos.get(nombre, False) or bool(mascara & (IN_CLOSE_WRITE | IN_MOVED_TO))
+
+    def cerrar(self):
+        """Método que deja de vigilar el directorio."""
+        os.close(self.fd)
+
+
+class _Sondeo:
+    """Clase que sustituye a _Inotify cuando no está disponible: no avisa de nada y la carpeta se recorre entera."""
+
+    modo = "sondeo"
+    fd = None
+
+    def leer(self):
+        return None
+
+    def cerrar(self):
+        pass
+
+
+def _escribir_json(ruta: str, datos: dict):
+    """Escribe un JSON de una vez: en un fichero temporal que luego sustituye al anterior, para no dejarlo a medias."""
+    temporal = ruta + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as fichero:
+        json.dump(datos, fichero, ensure_ascii=False, indent=1)
+        fichero.flush()
+        os.fsync(fichero.fileno())
+    os.replace(temporal, ruta)
+
+
+def _ruta_libre(directorio: str, nombre: str, reservadas=()):
+    """Devuelve una ruta del directorio con ese nombre que no exista ni esté reservada, añadiendo _1, _2... si hace falta."""
+    base, extension = os.path.splitext(nombre)
+    ruta = os.path.join(directorio, nombre)
+    numero = 1
+    while os.path.lexists(ruta) or ruta in reservadas:
+        ruta = os.path.join(directorio, f"{base}_{numero}{extension}")
+        numero += 1
+    return ruta
+
+
+def _pdf_terminado(ruta: str):
+    """Indica si el fichero acaba en "%%EOF", como todo pdf completo (se admite basura tras la marca)."""
+    with open(ruta, "rb") as fichero:
+        fichero.seek(max(0, os.path.getsize(ruta) - 1024))
+        return b"%%EOF" in fichero.read()
+
+
+def _ignorar_interrupcion():
+    """Hace que los procesos de marcado ignoren Ctrl+C, para que sea la vigilancia quien decida cuándo parar."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def leer_perfil(ruta_perfil: str):
+    """
+    Función que lee un perfil de marca de agua en JSON y lo convierte en los parámetros de MarcadorAgua.
+    Las claves son los parámetros de MarcadorAgua; el color se puede escribir como lista, una ruta_imagen
+    relativa se toma desde la carpeta del perfil y la clave opcional "fuente" equivale a MARCA_AGUA_FUENTE.
+
+    Parameters:
+    ----------
+    - ruta_perfil (str): Ruta del fichero JSON.
+
+    Returns:
+    --------
+    - parametros (dict): Parámetros de MarcadorAgua. Lanza ValueError si el perfil no es válido.
+    """
+
+    with open(ruta_perfil, encoding="utf-8") as fichero:
+        parametros = json.load(fichero)
+    if not isinstance(parametros, dict):
+        raise ValueError("El perfil debe ser un objeto JSON")
+    fuente = parametros.pop("fuente", None)
+    if fuente:
+        #La fuente se pasa por el entorno para que la resuelva cada proceso
+        os.environ["MARCA_AGUA_FUENTE"] = fuente
+    if "color_texto" in parametros:
+        parametros["color_texto"] = tuple(parametros["color_texto"])
+    if parametros.get("ruta_imagen"):
+        parametros["ruta_imagen"] = os.path.join(os.path.dirname(os.path.abspath(ruta_perfil)), parametros["ruta_imagen"])
+    elif not str(parametros.get("texto_marca_agua", "")).strip():
+        raise ValueError("El perfil debe indicar texto_marca_agua o ruta_imagen")
+
+    #Se construye la marca de agua una vez para detectar los errores al arrancar y no con el primer pdf
+    try:
+        with MarcadorAgua(**parametros):
+            pass
+    except TypeError as e:
+        raise ValueError(f"Perfil no válido: {e}")
+    return parametros
+
+
+class VigilanteCarpeta:
+    """
+    Clase que vigila la carpeta de entrada y marca los pdfs que van llegando. En el directorio de destino
+    se crean:
+    - en_proceso/: pdfs recogidos de la entrada que todavía no han terminado.
+    - marcados/: pdfs con la marca de agua, con el nombre del original.
+    - hechos/ y fallidos/: originales ya procesados, y los que han fallado junto a un ".error.txt".
+    - trabajos.json: estado de los pdfs de en_proceso, con el que se retoman al reiniciar.
+    - estado.json: pdfs en espera y en proceso, totales y rendimiento, reescrito cada segundo.
+
+    Un pdf se da por terminado de escribir cuando inotify avisa de que se ha cerrado o movido a la carpeta
+    y no ha cambiado después, o cuando lleva segundos_estable sin cambiar de tamaño ni de fecha. En ambos
+    casos tiene que acabar en "%%EOF" (salvo que lleve ESPERA_MAXIMA_EOF así, y entonces se intenta).
+
+    Parameters:
+    ----------
+    - directorio_entrada (str): Carpeta en la que se dejan los pdfs.
+    - directorio_destino (str): Carpeta donde se crean las carpetas y ficheros de arriba.
+    - parametros (dict): Parámetros de MarcadorAgua, por ejemplo los de leer_perfil.
+    - procesos (int): Número de pdfs que se marcan a la vez. 2 por defecto.
+    - segundos_estable (float): Segundos sin cambios tras los que un pdf se da por escrito. 2 por defecto.
+    - sondeo (bool): True recorre la carpeta cada intervalo_sondeo segundos aunque haya inotify. False por defecto.
+    - intervalo_sondeo (float): Segundos entre recorridos de la carpeta sin inotify. 2 por defecto.
+    - al_terminar (callable): Función al_terminar(nombre, paginas, segundos, error) llamada con cada pdf
+      terminado. error es None si se ha marcado correctamente.
+    """
+
+    def __init__(self,
+                 directorio_entrada: str,
+                 directorio_destino: str,
+                 parametros: dict,
+                 procesos: int = 2,
+                 segundos_estable: float = 2.0,
+                 sondeo: bool = False,
+                 intervalo_sondeo: float = 2.0,
+                 al_terminar = None):
+
+        self.entrada = os.path.abspath(directorio_entrada)
+        self.parametros = parametros
+        self.procesos = max(1, procesos)
+        #Pdfs enviados a la vez: dos por proceso para que ninguno espere, el resto se quedan en la entrada
+        self.max_en_vuelo = 2 * self.procesos
+        self.segundos_estable = segundos_estable
+        self.intervalo_sondeo = intervalo_sondeo
+        self.al_terminar = al_terminar
+        directorio_destino = os.path.abspath(directorio_destino)
+        self.carpetas = {nombre: os.path.join(directorio_destino, nombre)
+                         for nombre in ("en_proceso", "marcados", "hechos", "fallidos")}
+        for carpeta in self.carpetas.values():
+            os.makedirs(carpeta, exist_ok=True)
+        self.ruta_trabajos = os.path.join(directorio_destino, "trabajos.json")
+        self.ruta_estado = os.path.join(directorio_destino, "estado.json")
+
+        self.observador = _Sondeo()
+        if not sondeo:
+            try:
+                self.observador = _Inotify(self.entrada)
+            except OSError:
+                pass
+        #Pdfs vistos en la entrada: nombre -> [firma (tamaño, fecha), momento del último cambio, completo]
+        self.candidatos = {}
+        #Pdfs recogidos en en_proceso, por su nombre allí, como se guardan en trabajos.json
+        self.trabajos = {}
+        self.totales = {"completados": 0, "fallidos": 0, "paginas": 0}
+        self.pendientes = deque()
+        self.futuros = {}
+        self.ejecutor = None
+        self.detenido = False
+        self.inicio = time.time()
+        self.recientes = deque()
+        self.tiempos_proceso = deque(maxlen=1000)
+        self.ultimo_error = None
+        #Los procesos avisan al terminar por este par de sockets, para no esperar al siguiente recorrido
+        self._aviso_lectura, self._aviso_escritura = socket.socketpair()
+        self._aviso_lectura.setblocking(False)
+
+    def detener(self):
+        """Método que pide parar: no se recogen más pdfs y se termina en cuanto acaban los que están en proceso."""
+        self.detenido = True
+        try:
+            self._aviso_escritura.send(b"\0")
+        except OSError:
+            pass
+
+    def ejecutar(self):
+        """Método que vigila la carpeta hasta que se llama a detener, y después espera a los pdfs en proceso."""
+        self.ejecutor = self._crear_ejecutor()
+        try:
+            self._recuperar()
+            self._revisar_entrada(None)
+            ultima_revision = ultimo_estado = time.monotonic()
+            while not self.detenido or self.futuros:
+                if not self.detenido:
+                    self._enviar()
+                lectura = [self._aviso_lectura] + ([self.observador.fd] if self.observador.fd is not None else [])
+                espera = min(0.5, self.segundos_estable / 2) if self.candidatos else SEGUNDOS_ESTADO
+                listos, _, _ = select.select(lectura, [], [], espera)
+                if self._aviso_lectura in listos:
+                    try:
+                        while self._aviso_lectura.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                self._recoger()
+
+                ahora = time.monotonic()
+                periodo = self.intervalo_sondeo if self.observador.fd is None else SEGUNDOS_REVISION
+                if ahora - ultima_revision >= periodo:
+                    self._revisar_entrada(None)
+                    ultima_revision = ahora
+                elif self.observador.fd in listos:
+                    eventos = self.observador.leer()
+                    self._revisar_entrada(eventos)
+                    if eventos is None:
+                        ultima_revision = ahora
+                else:
+                    self._revisar_entrada({})
+                if ahora - ultimo_estado >= SEGUNDOS_ESTADO:
+                    self._escribir_estado()
+                    ultimo_estado = ahora
+        finally:
+            self.ejecutor.shutdown(wait=True, cancel_futures=True)
+            self.observador.cerrar()
+            self._aviso_lectura.close()
+            self._aviso_escritura.close()
+            self._escribir_estado()
+
+    def _crear_ejecutor(self):
+        """Crea el conjunto de procesos que marcan los pdfs."""
+        return ProcessPoolExecutor(max_workers=self.procesos, initializer=_ignorar_interrupcion)
+
+    def _guardar_trabajos(self):
+        """Guarda en disco el estado de los pdfs de en_proceso y los totales."""
+        _escribir_json(self.ruta_trabajos, {"totales": self.totales, "trabajos": self.trabajos})
+
+    def _recuperar(self):
+        """
+        Método que retoma lo que quedó a medias en la ejecución anterior: los pdfs ya marcados solo se
+        mueven a hechos, el resto se vuelven a procesar, y los pdfs de en_proceso sin estado (recogidos
+        justo antes de pararse) se procesan como nuevos.
+        """
+
+        if os.path.isfile(self.ruta_trabajos):
+            try:
+                with open(self.ruta_trabajos, encoding="utf-8") as fichero:
+                    guardado = json.load(fichero)
+                self.totales.update(guardado["totales"])
+                self.trabajos = guardado["trabajos"]
+            except (ValueError, KeyError, TypeError) as e:
+                #Los pdfs siguen en en_proceso, así que no se pierde ninguno aunque el estado no se pueda leer
+                print(f"No se ha podido leer {self.ruta_trabajos}, se retoman los pdfs de en_proceso: {e}",
+                      file=sys.stderr)
+                self.trabajos = {}
+
+        for entrada in os.scandir(self.carpetas["marcados"]):
+            if entrada.name.endswith(".parcial"):
+                os.remove(entrada.path)
+        presentes = set(os.listdir(self.carpetas["en_proceso"]))
+        for clave in list(self.trabajos):
+            if clave not in presentes:
+                del self.trabajos[clave]
+        for clave in sorted(presentes - set(self.trabajos)):
+            self.trabajos[clave] = {"original": clave, "salida": self._reservar_salida(clave),
+                                    "estado": "pendiente", "intentos": 0}
+        for clave, trabajo in list(self.trabajos.items()):
+            if trabajo["estado"] == "marcado" and os.path.isfile(trabajo["salida"]):
+                self._finalizar(clave, trabajo.get("paginas", 0), 0.0, None)
+            else:
+                trabajo["estado"] = "pendiente"
+                self.pendientes.append(clave)
+        self._guardar_trabajos()
+
+    def _reservar_salida(self, nombre: str):
+        """Elige la ruta del pdf marcado sin pisar otra salida ni la de un pdf pendiente."""
+        return _ruta_libre(self.carpetas["marcados"], nombre, {trabajo["salida"] for trabajo in self.trabajos.values()})
+
+    def _revisar_entrada(self, eventos):
+        """
+        Método que actualiza los pdfs vistos en la entrada.
+
+        Parameters:
+        ----------
+        - eventos (dict[str, bool]): Eventos de inotify. Además de estos se comprueban los candidatos ya
+          conocidos. None recorre la carpeta entera.
+        """
+
+        ahora = time.monotonic()
+        if eventos is None:
+            eventos = {}
+            try:
+                nombres = os.listdir(self.entrada)
+            except OSError:
+                nombres = []
+            for nombre in set(self.candidatos) - set(nombres):
+                del self.candidatos[nombre]
+        else:
+            nombres = []
+        for nombre in set(nombres) | set(eventos) | set(self.candidatos):
+            if not nombre.lower().endswith(".pdf") or nombre.startswith((".", "~")):
+                continue
+            try:
+                estado = os.stat(os.path.join(self.entrada, nombre))
+            except OSError:
+                self.candidatos.pop(nombre, None)
+                continue
+            firma = (estado.st_size, estado.st_mtime_ns)
+            candidato = self.candidatos.get(nombre)
+            if candidato is None or candidato[0] != firma:
+                self.candidatos[nombre] = candidato = [firma, ahora, False]
+            if eventos.get(nombre):
+                candidato[2] = True
+
+    def _listos(self):
+        """Devuelve los candidatos que ya han terminado de escribirse, los más antiguos primero."""
+        ahora = time.monotonic()
+        listos = []
+        for nombre, (_, cambio, completo) in self.candidatos.items():
+            quieto = ahora - cambio
+            if not (completo or quieto >= self.segundos_estable):
+                continue
+            try:
+                terminado = _pdf_terminado(os.path.join(self.entrada, nombre))
+            except OSError:
+                continue
+            if terminado or quieto >= ESPERA_MAXIMA_EOF:
+                listos.append((cambio, nombre))
+        return [nombre for _, nombre in sorted(listos)]
+
+    def _enviar(self):
+        """Recoge de la entrada los pdfs listos y los envía a los procesos, sin pasar de max_en_vuelo."""
+        if len(self.pendientes) + len(self.futuros) < self.max_en_vuelo:
+            for nombre in self._listos()[:self.max_en_vuelo - len(self.pendientes) - len(self.futuros)]:
+                ruta_en_proceso = _ruta_libre(self.carpetas["en_proceso"], nombre)
+                try:
+                    shutil.move(os.path.join(self.entrada, nombre), ruta_en_proceso)
+                except OSError:
+                    #Todavía abierto por el escáner en sistemas que no permiten moverlo: se reintenta después
+                    continue
+                del self.candidatos[nombre]
+                clave = os.path.basename(ruta_en_proceso)
+                self.trabajos[clave] = {"original": nombre, "salida": self._reservar_salida(nombre),
+                                        "estado": "pendiente", "intentos": 0}
+                self.pendientes.append(clave)
+
+        cambios = False
+        while self.pendientes and len(self.futuros) < self.max_en_vuelo:
+            clave = self.pendientes.popleft()
+            trabajo = self.trabajos[clave]
+            if trabajo["intentos"] >= MAX_INTENTOS:
+                self._finalizar(clave, 0, 0.0, f"Se ha interrumpido {trabajo['intentos']} veces sin terminar")
+                continue
+            trabajo["intentos"] += 1
+            cambios = True
+            try:
+                futuro = self.ejecutor.submit(procesar_pdf, os.path.join(self.carpetas["en_proceso"], clave),
+                                              trabajo["salida"] + ".parcial", self.parametros)
+            except BrokenProcessPool:
+                trabajo["intentos"] -= 1
+                self.pendientes.appendleft(clave)
+                self.ejecutor = self._crear_ejecutor()
+                break
+            futuro.add_done_callback(self._avisar)
+            self.futuros[futuro] = clave
+        if cambios:
+            #Los intentos se guardan antes de procesar, para no repetir sin fin un pdf que tumba el servicio
+            self._guardar_trabajos()
+
+    def _avisar(self, _):
+        """Despierta a ejecutar cuando termina un pdf. Se llama desde el hilo del ejecutor."""
+        try:
+            self._aviso_escritura.send(b"\0")
+        except OSError:
+            pass
+
+    def _recoger(self):
+        """Método que finaliza los pdfs que han terminado de procesarse."""
+        roto = False
+        for futuro in [futuro for futuro in self.futuros if futuro.done()]:
+            clave = self.futuros.pop(futuro)
+            try:
+                _, paginas, segundos, error, _, _ = futuro.result()
+            except BrokenProcessPool:
+                #Un proceso ha caído (por ejemplo, con un pdf que rompe MuPDF) y no se sabe con cuál: se
+                #reintentan todos los que estaban en marcha
+                roto = True
+                self.pendientes.appendleft(clave)
+                continue
+            except Exception as e:
+                paginas, segundos, error = 0, 0.0, str(e)
+            self._finalizar(clave, paginas, segundos, error)
+        if roto:
+            self.ejecutor.shutdown(wait=False)
+            self.ejecutor = self._crear_ejecutor()
+
+    def _finalizar(self, clave: str, paginas: int, segundos: float, error: str):
+        """
+        Método que termina un pdf: deja el pdf marcado en su sitio y mueve el original a hechos, o a fallidos
+        junto a su error. Cada paso se guarda en trabajos.json antes de dar el siguiente.
+        """
+
+        trabajo = self.trabajos[clave]
+        ruta_en_proceso = os.path.join(self.carpetas["en_proceso"], clave)
+        if error is None:
+            if trabajo["estado"] != "marcado":
+                os.replace(trabajo["salida"] + ".parcial", trabajo["salida"])
+                trabajo.update(estado="marcado", paginas=paginas)
+                self._guardar_trabajos()
+            shutil.move(ruta_en_proceso, _ruta_libre(self.carpetas["hechos"], trabajo["original"]))
+            self.totales["completados"] += 1
+            self.totales["paginas"] += paginas
+            self.recientes.append((time.time(), paginas))
+            self.tiempos_proceso.append(segundos)
+        else:
+            ruta_fallido = _ruta_libre(self.carpetas["fallidos"], trabajo["original"])
+            shutil.move(ruta_en_proceso, ruta_fallido)
+            with open(ruta_fallido + ".error.txt", "w", encoding="utf-8") as fichero:
+                fichero.write(error + "\n")
+            self.totales["fallidos"] += 1
+            self.ultimo_error = {"pdf": trabajo["original"], "error": error,
+                                 "fecha": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        del self.trabajos[clave]
+        self._guardar_trabajos()
+        if self.al_terminar is not None:
+            self.al_terminar(trabajo["original"], paginas, segundos, error)
+
+    def estado(self):
+        """
+        Método que devuelve el estado de la vigilancia: pdfs en espera en la entrada (escribiéndose o esperando
+        un proceso libre), pendientes y en proceso, totales desde el primer arranque y rendimiento de los
+        últimos VENTANA_RENDIMIENTO segundos.
+        """
+
+        ahora = time.time()
+        while self.recientes and ahora - self.recientes[0][0] > VENTANA_RENDIMIENTO:
+            self.recientes.popleft()
+        ventana = max(1e-9, min(VENTANA_RENDIMIENTO, ahora - self.inicio))
+        return {
+            "actualizado": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "deteccion": self.observador.modo,
+            "detenido": self.detenido,
+            "en_espera": len(self.candidatos),
+            "pendientes": len(self.pendientes),
+            "en_proceso": len(self.futuros),
+            **self.totales,
+            "pdfs_por_minuto": len(self.recientes) * 60 / ventana,
+            "paginas_por_segundo": sum(paginas for _, paginas in self.recientes) / ventana,
+            "proceso_ms": percentiles_ms(self.tiempos_proceso),
+            "ultimo_error": self.ultimo_error,
+        }
+
+    def _escribir_estado(self):
+        """Escribe el estado en estado.json."""
+        try:
+            _escribir_json(self.ruta_estado, self.estado())
+        except OSError as e:
+            print(f"No se ha podido escribir {self.ruta_estado}: {e}", file=sys.stderr)
+
+
+def _crear_parser():
+    """Crea el analizador de argumentos de la línea de comandos."""
+    parser = argparse.ArgumentParser(description="Vigila una carpeta y añade una marca de agua a los pdfs que llegan.")
+    parser.add_argument("entrada", help="Carpeta en la que se dejan los pdfs.")
+    parser.add_argument("--perfil", required=True, help="Perfil de la marca de agua en JSON.")
+    parser.add_argument("--destino", required=True,
+                        help="Carpeta donde se crean marcados, hechos, fallidos y los ficheros de estado.")
+    parser.add_argument("--procesos", type=int, default=2, help="Pdfs que se procesan a la vez.")
+    parser.add_argument("--estable", type=float, default=2.0,
+                        help="Segundos sin cambios tras los que un pdf se da por escrito.")
+    parser.add_argument("--sondeo", action="store_true",
+                        help="Recorre la carpeta periódicamente en lugar de usar inotify (carpetas de red).")
+    parser.add_argument("--intervalo", type=float, default=2.0, help="Segundos entre recorridos de la carpeta.")
+    return parser
+
+
+def main(argumentos: list[str] = None):
+    """
+    Función principal de la línea de comandos. Vigila la carpeta hasta recibir Ctrl+C o SIGTERM.
+
+    Parameters:
+    ----------
+    - argumentos (list[str]): Argumentos a analizar. Por defecto, los de sys.argv.
+
+    Returns:
+    --------
+    - codigo (int): 0 si se ha detenido normalmente, 1 si no se ha podido arrancar.
+    """
+
+    args = _crear_parser().parse_args(argumentos)
+    if not os.path.isdir(args.entrada):
+        print(f"No existe la carpeta {args.entrada}", file=sys.stderr)
+        return 1
+    try:
+        parametros = leer_perfil(args.perfil)
+    except (OSError, ValueError) as e:
+        print(f"No se ha podido leer el perfil: {e}", file=sys.stderr)
+        return 1
+
+    def al_terminar(nombre, paginas, segundos, error):
+        if error:
+            print(f"{'error':>10} | {nombre} | {error}", file=sys.stderr)
+        else:
+            print(f"{segundos:>9.2f}s | {nombre} | {paginas} páginas")
+
+    vigilante = VigilanteCarpeta(args.entrada, args.destino, parametros, args.procesos, args.estable, args.sondeo,
+                                 args.intervalo, al_terminar)
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(senal, lambda *_: vigilante.detener())
+    print(f"Vigilando {vigilante.entrada} ({vigilante.observador.modo}), estado en {vigilante.ruta_estado}")
+    vigilante.ejecutar()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())